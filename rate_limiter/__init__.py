@@ -1,5 +1,6 @@
 from .sync_rate_limiter import RateLimiter as SyncRateLimiter
 from .async_rate_limiter import RateLimiter as ASyncRateLimiter
+from .gcra_rate_limiter import SyncRateLimiter as SyncGCRARateLimiter, ASyncRateLimiter as ASyncGCRARateLimiter
 
-__all__ = ['SyncRateLimiter', 'ASyncRateLimiter']
+__all__ = ['SyncRateLimiter', 'ASyncRateLimiter', 'SyncGCRARateLimiter', 'ASyncGCRARateLimiter']
 __version__ = '0.1.11'
@@ -0,0 +1,123 @@
+import logging
+from functools import partial
+from typing import Dict, List
+
+from .async_rate_limiter import RateLimiter, reserve_all, release_all
+from .limiter_cache import LimiterCache
+from .limiter_context import GLOBAL_LIMITERS, GET_LIMITERS_RET_TYPE, LimiterServices, PER_USER_LIMITER_CACHE_SIZE, \
+    _PER_USER_LIMITER_CONTEXT_RETURN_TYPE, _create_limiter, _create_per_user_contexts, get_limiters_context_with_added_limiters
+
+
+# asyncio version of `limiter_context`, using the same GLOBAL_LIMITERS / PER_USER_LIMITERS tables.  Everything here runs
+# on the event loop so no locks are needed, and each context acquires all of its limiters in a single step.
+
+_GET_LIMITERS_CALLED = False
+
+
+def get_limiters(logger: logging.Logger, stats: bool=False) -> GET_LIMITERS_RET_TYPE:
+    """
+    Returns a dictionary of service name to a callable to acquire `num` API requests from a
+    set of limiters associated with said service.
+
+    NOTE: You should only call this method once as the set of limiters should last length of life of the application.
+          The limiters are bound to the current event loop.
+
+    :param logger: logger to use
+    :param stats: whether the limiters collect stats, see `limiter_context.get_limiters_stats`
+    :return: dict of: {service_name: limiter_context_callable}
+    """
+    global _GET_LIMITERS_CALLED
+    assert not _GET_LIMITERS_CALLED
+
+    ret_value = _create_limiters(logger, GLOBAL_LIMITERS, stats)
+
+    _GET_LIMITERS_CALLED = True
+    return ret_value
+
+
+def _create_limiters(logger: logging.Logger, global_limiters: dict, stats: bool=False) -> GET_LIMITERS_RET_TYPE:
+    # `global_limiters` has the format of `GLOBAL_LIMITERS`
+    return {
+        limiter_type: {
+            svc: partial(limiters_context, limiters=[_create_limiter(units, period, logger, RateLimiter, stats) for period, units in period_units_dict.items()], service=svc)
+            for svc, period_units_dict in limiters.items()
+        }
+        for limiter_type, limiters in global_limiters.items()
+    }
+
+
+class _LimitersContext:
+    __slots__ = ('_limiters', '_num', '_max_wait', '_priority')
+
+    def __init__(self, limiters: List[RateLimiter], num: int, max_wait: float=None, priority: int=0):
+        self._limiters = limiters
+        self._num = num
+        self._max_wait = max_wait
+        self._priority = priority
+
+    async def __aenter__(self):
+        await reserve_all(self._limiters, self._num, self._max_wait, self._priority)
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        # NOTE: Even if there's a pending exception we have to assume the __aenter__ call counted
+        release_all(self._limiters, self._num)
+
+
+# limiters + service params have defaults because we want `num` to be positional and have a default
+def limiters_context(num: int=1, limiters: List[RateLimiter]=None, service: LimiterServices=None, max_wait: float=None,
+                     priority: int=0) -> _LimitersContext:
+    """
+    Async context which will acquire `num` units from all `limiters`
+
+    :param num: number of API queries which will be called
+    :param limiters: list of limiters to acquire from
+    :param service: service of limiters
+    :param max_wait: raise `RateLimiter.Rejected` instead of waiting if the units can't be admitted within this many seconds
+    :param priority: callers waiting with a higher priority are served first, ex: interactive requests over background jobs
+    """
+    return _LimitersContext(limiters, num, max_wait, priority)
+
+
+# cache of get_per_user_limiter_context return values keyed by: (service_name, user_name), only touched from the event loop so it needs no lock
+_PER_USER_LIMITER_CACHE = LimiterCache(PER_USER_LIMITER_CACHE_SIZE)
+
+
+def get_per_user_limiter_context(logger: logging.Logger, limiters: GET_LIMITERS_RET_TYPE, service_name: LimiterServices, user_name: str) -> _PER_USER_LIMITER_CONTEXT_RETURN_TYPE:
+    """
+    Will return the per user request and quota limiters for `service_name` by appending any relevant per user limiters to the global limiters
+    for said service.
+
+    :param logger: logger to use
+    :param limiters: limiters for all services (value from `get_limiters`)
+    :param service_name: service name from which to get limiters
+    :param user_name: user name associated with this set of limiters
+    :return: dictionary of: {'request': per_user_request_limiter_context, 'quota': per_user_quota_limiter_context}.  If a given `service_name`
+            does not have limits the context will be None
+    """
+    cache_key = (service_name, user_name)
+
+    return_value = _PER_USER_LIMITER_CACHE.get(cache_key)
+    if return_value:
+        return return_value
+
+    return_value, user_limiters = _create_per_user_contexts(logger, limiters, service_name, RateLimiter, limiters_context, get_limiters_context_with_added_limiters)
+
+    return _PER_USER_LIMITER_CACHE.add(cache_key, return_value, user_limiters)
+
+
+def configure_per_user_limiter_cache(max_size: int=PER_USER_LIMITER_CACHE_SIZE, ttl_s: float=None):
+    """
+    Sets the bounds of the `get_per_user_limiter_context` cache, see `limiter_context.configure_per_user_limiter_cache`
+
+    :param max_size: max number of (service_name, user_name) entries, or None for unbounded
+    :param ttl_s: if set, users which haven't been looked up for this many seconds are evicted once idle
+    """
+    _PER_USER_LIMITER_CACHE.max_size = max_size
+    _PER_USER_LIMITER_CACHE.ttl_s = ttl_s
+
+
+def get_per_user_limiter_cache_stats() -> Dict[str, int]:
+    """
+    :return: dict of: {'size', 'hits', 'misses', 'evictions', 'busy_skips'} for the `get_per_user_limiter_context` cache
+    """
+    return _PER_USER_LIMITER_CACHE.stats
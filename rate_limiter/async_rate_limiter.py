@@ -1,23 +1,96 @@
 import asyncio
+import heapq
+import itertools
 import logging
-from collections import deque
-import time
+import weakref
+from typing import Callable, List
 
+from .stats import LimiterStats
+from .window import create_window
 
-class CancellingTaskCtx:
-    def __init__(self, fut):
+
+class _LimiterContext:
+    __slots__ = ('_limiter', '_num')
+
+    def __init__(self, limiter, num: int):
+        """
+        Async context manager which acquires and releases `num` units from `limiter`
+
+        :param limiter: RateLimiter to acquire from
+        :param num: number of units
+        """
+        self._limiter = limiter
+        self._num = num
+
+    async def __aenter__(self):
+        await self._limiter.acquire(self._num)
+        return self._limiter
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        # NOTE: Even if there's a pending exception we have to assume the call counted
+        self._limiter.release(self._num)
+
+
+class ReleaseDriver:
+    _drivers = weakref.WeakKeyDictionary()  # {loop: ReleaseDriver}
+
+    def __init__(self, loop: asyncio.AbstractEventLoop):
+        """
+        Returns the units of expired hits for every registered limiter on `loop` from a single `loop.call_at` timer,
+        instead of each limiter running its own release task.
+
+        :param loop: event loop of the limiters
+        """
+        # weak so `_drivers` doesn't keep the loop alive, the loop owns our timer so it outlives us while we're armed
+        self._loop = weakref.ref(loop)
+        self._heap = []  # heap of: (deadline, seq, limiter)
+        self._seq = itertools.count()  # tie-breaker so limiters are never compared
+        self._timer: asyncio.TimerHandle = None
+
+    @classmethod
+    def for_loop(cls, loop: asyncio.AbstractEventLoop=None) -> 'ReleaseDriver':
         """
-        Creates a task from a future/coroutine and cancels at during __exit__ if task not done
-        :param fut: Future or coroutine
+        Returns the driver shared by all limiters on `loop`
+
+        :param loop: event loop, defaults to the current one
         """
-        self._task = asyncio.Task(fut)
+        loop = loop or asyncio.get_event_loop()
+        driver = cls._drivers.get(loop)
+        if not driver:
+            driver = cls._drivers[loop] = cls(loop)
+
+        return driver
+
+    def schedule(self, limiter, delay_s: float):
+        """
+        Registers `limiter._release_expired` to be called in `delay_s`, it returns the next delay to re-register or None.
+
+        :param limiter: limiter to call
+        :param delay_s: seconds from now at which to call it
+        """
+        entry = (self._loop().time() + delay_s, next(self._seq), limiter)
+        heapq.heappush(self._heap, entry)
+
+        if self._heap[0] is entry:
+            self._arm_timer()
+
+    def _arm_timer(self):
+        if self._timer:
+            self._timer.cancel()
+
+        self._timer = self._loop().call_at(self._heap[0][0], self._on_timer) if self._heap else None
 
-    def __enter__(self):
-        return self._task
+    def _on_timer(self):
+        now = self._loop().time()
+        while self._heap and self._heap[0][0] <= now:
+            _, _, limiter = heapq.heappop(self._heap)
 
-    def __exit__(self, exc_type, exc_val, exc_tb):
-        if not self._task.done():
-            self._task.cancel()
+            delay_s = limiter._release_expired()
+            if delay_s is not None:
+                heapq.heappush(self._heap, (now + delay_s, next(self._seq), limiter))
+
+        self._timer = None
+        self._arm_timer()
 
 
 # This is a moving-window rate limiter.  The theory
@@ -29,112 +102,493 @@ class RateLimiter:
     class Error(Exception):
         pass
 
-    def __init__(self, max_rate: int, period_s: float or int, logger: logging.Logger):
+    class Rejected(Exception):
+        """ Raised instead of waiting when an acquire is shed, see `max_wait` and `max_waiters` """
+        pass
+
+    def __init__(self, max_rate: int, period_s: float or int, logger: logging.Logger, buckets: int=None,
+                 release_driver: ReleaseDriver=None, clock: Callable[[], float]=None, stats: bool=False,
+                 max_wait: float=None, max_waiters: int=None, aging_s: float=None):
         """
         Allows `max_rate` per `period_s`.
 
         :param max_rate: number of hits allowed per `period_s`
         :param period_s: period in seconds
         :param logger: logger to use
+        :param buckets: if set, hits are coalesced into this many buckets per period so memory is fixed regardless
+                        of `max_rate`, otherwise one record is kept per hit
+        :param release_driver: if set (see `ReleaseDriver.for_loop`), expired hits are released by this shared driver
+                               instead of a task per limiter
+        :param clock: monotonic clock used to timestamp hits, defaults to `loop.time`.  See `rate_limiter.clock`
+        :param stats: whether to collect the stats returned by `stats`
+        :param max_wait: default of `acquire`'s `max_wait`
+        :param max_waiters: if set, acquires which would have to wait while this many tasks are already waiting raise
+                            `Rejected` instead
+        :param aging_s: seconds a waiter has to wait to get ahead of new waiters one priority above it, defaults to
+                        `period_s`
         """
 
         assert isinstance(max_rate, int) and max_rate > 0
         assert period_s > 0
+        assert max_waiters is None or max_waiters >= 0
 
         self._max_rate = max_rate
         self._period_s = period_s
         self._loop = asyncio.get_event_loop()
+        self._clock = clock or self._loop.time
         self._logger = logger
+        self._max_wait = max_wait
+        self._max_waiters = max_waiters
+        self._aging_s = period_s if aging_s is None else aging_s
         self._release_task = None
-        self._release_worker_exception = None
-        self._broken_event = asyncio.Event()  # will get set if limiter is broken
-        self._broken_evt_wait_fut = asyncio.ensure_future(self._broken_event.wait())
+        self._release_driver = release_driver
+        self._scheduled = False  # True while there's a pending release task or driver callback
+        self._release_worker_exception = None  # will get set if limiter is broken
         self._waiters = 0
+        self._pending = 0  # `reserve_all` calls waiting on a group which includes us, see `is_idle`
+        self._join_waiters = []  # futures resolved when `_waiters` drops to 0 or `_scheduled` to False
+
+        # We'll initially allow `max_rate` to happen in parallel, and then return units as their hits expire.
+        # Tasks which can't be satisfied immediately queue up in a heap of [rank, seq, num, future], see `_rank`.
+        # We only ever wake the head of the queue so large acquires can't be starved by a stream of small ones.
+        self._available = max_rate
+        self._acquire_waiters = []
+        self._seq = itertools.count()  # tie-breaker so waiters of the same rank are served in FIFO order
+
+        # we'll push (end_time, num) records to this window during `release`
+        self._end_time_q = create_window(period_s, buckets)
+
+        self._stats = LimiterStats() if stats else None
+
+    @property
+    def max_rate(self):
+        return self._max_rate
 
-        # We'll initially allow `max_rate` to happen in parallel, and then release
-        # the semaphores as new tasks can be started
-        self._sema = asyncio.Semaphore(max_rate)
+    @property
+    def stats(self) -> dict or None:
+        """
+        :return: None if the limiter was created without `stats`, otherwise `LimiterStats.snapshot` plus:
+                 {'max_rate', 'available', 'in_window': units of hits in the window, 'in_use': units acquired and not
+                 released, 'waiters'}
+        """
+        if self._stats is None:
+            return None
 
-        # we'll push the task end-time to this queue during `__aexit__`
-        self._end_time_q = deque()
+        stats = self._stats.snapshot()
+        in_window = self._end_time_q.units()
+        stats.update(max_rate=self._max_rate, available=self._available, in_window=in_window,
+                     in_use=self._max_rate - self._available - in_window, waiters=self._waiters)
+        return stats
 
     @property
     def is_broken(self):
-        return self._broken_event.is_set()
+        return self._release_worker_exception is not None
 
-    async def join(self):
-        """ Will wait until all waiters have finished """
-        while self._waiters:
-            await asyncio.sleep(1)
+    @property
+    def is_idle(self):
+        """ True if no units are held or in the window and nobody is waiting, so dropping the limiter loses no history """
+        return self._available == self._max_rate and not self._waiters and not self._pending and not self._acquire_waiters
 
-        if not self._broken_evt_wait_fut.done():
-            # normal operation
-            if self._release_task and not self._release_task.done():
-                await self._release_task
+    async def join(self, drain: bool=True):
+        """
+        Will wait until all waiters have finished
 
-            self._broken_evt_wait_fut.cancel()
-        else:
+        :param drain: also wait until all hits have been released, this could cause an extra `self._period_s` seconds of waiting
+        """
+        while self._waiters or self._pending or (drain and self._scheduled):
+            fut = self._loop.create_future()
+            self._join_waiters.append(fut)
+            await fut
+
+        if self.is_broken and self._release_task and not self._release_task.done():
             # exceptional operation
-            if not self._release_task.done():
-                self._release_task.cancel()
+            self._release_task.cancel()
+
+    def _notify_join(self):
+        join_waiters, self._join_waiters = self._join_waiters, []
+        for fut in join_waiters:
+            if not fut.done():
+                fut.set_result(None)
+
+    def __call__(self, num: int=1) -> _LimiterContext:
+        """
+        Returns an async context manager which will acquire `num` units on enter and release them on exit
+
+        :param num: number of units
+        """
+        return _LimiterContext(self, num)
 
     async def __aenter__(self):
-        self._waiters += 1
+        await self.acquire()
+        return self
 
-        try:
-            # Wait on which happens first: we acquire the semaphore or the rate-limiter breaks
-            with CancellingTaskCtx(self._sema.acquire()) as acquire_fut:
-                await asyncio.wait((self._broken_evt_wait_fut, acquire_fut), return_when=asyncio.FIRST_COMPLETED)
+    async def acquire(self, num: int=1, max_wait: float=None, priority: int=0):
+        """
+        Acquires `num` units from the limiter atomically, waiters are served by priority and then in FIFO order
+
+        :param num: number of units to acquire
+        :param max_wait: if the units can't be admitted within this many seconds according to the hits in the window
+                         and the waiters queued ahead of us, raise `Rejected` immediately instead of waiting.  Defaults
+                         to the limiter's `max_wait`.
+        :param priority: waiters with a higher priority are served first, see `_rank`
+        """
+        assert isinstance(num, int) and 0 < num <= self._max_rate
+
+        if self._release_worker_exception:
+            raise self.Error("Error while acquiring rate limiter") from self._release_worker_exception
+
+        # fast path: nobody is queued ahead of us and there are enough units
+        if not self._acquire_waiters and self._available >= num:
+            self._available -= num
+            if self._stats is not None:
+                self._stats.record(0)
+            return
+
+        self._shed(num, max_wait, priority)
+        if self._stats is None:
+            await self._wait(num, priority)
+            return
+
+        start = self._loop.time()
+        await self._wait(num, priority)
+        self._stats.record(self._loop.time() - start)
+
+    def try_acquire(self, num: int=1) -> bool:
+        """
+        Acquires `num` units only if they're available right now and nobody is queued ahead of us
+
+        :param num: number of units to acquire
+        :return: whether they were acquired
+        """
+        assert isinstance(num, int) and 0 < num <= self._max_rate
+
+        if self._release_worker_exception:
+            raise self.Error("Error while acquiring rate limiter") from self._release_worker_exception
+
+        if self._admit_delay(num) != 0:
+            return False
+
+        self._available -= num
+        if self._stats is not None:
+            self._stats.record(0)
+        return True
+
+    def reserve(self, num: int=1) -> float or None:
+        """
+        Commits `num` units now and returns the seconds until they may be used, ie: until enough hits have expired.  The
+        caller must wait that long before its hit and then `release` as usual.  Until then the units are owed to the
+        limiter, so `_available` may go negative and later acquires queue up behind the reservation.
+
+        :param num: number of units to reserve
+        :return: seconds to wait, or None if that depends on units which haven't been released yet or on queued waiters
+                 (nothing is committed)
+        """
+        assert isinstance(num, int) and 0 < num <= self._max_rate
+
+        if self._release_worker_exception:
+            raise self.Error("Error while acquiring rate limiter") from self._release_worker_exception
+
+        delay_s = self._admit_delay(num)
+        if delay_s is None:
+            return None
 
-                if self._broken_evt_wait_fut.done():
-                    raise self.Error("Error while acquiring semaphore") from self._release_worker_exception
+        self._available -= num
+        if self._stats is not None:
+            self._stats.record(delay_s)
+        return delay_s
+
+    def _rank(self, priority: int) -> float:
+        """
+        Waiters are served in order of rank, which is their enqueue time minus `priority * aging_s`: higher priorities
+        go first, and a waiter gets ahead of new waiters one priority above it for every `aging_s` it waits, so low
+        priorities can't be starved.  All waiters of the same priority are served in FIFO order.
+        """
+        return self._clock() - priority * self._aging_s
+
+    async def _wait(self, num: int, priority: int=0):
+        """
+        Queues up until `num` units are handed to us, ie: they're taken from `_available` for us
+
+        :param num: number of units
+        :param priority: see `_rank`
+        """
+        # The future is either resolved by `_wake_waiters` once our units are available, or failed by `_set_broken`
+        waiter = [self._rank(priority), next(self._seq), num, self._loop.create_future()]
+        heapq.heappush(self._acquire_waiters, waiter)
+        self._waiters += 1
+        if self._stats is not None:
+            self._stats.record_waiters(self._waiters)
+        if self._acquire_waiters[0] is waiter:
+            # we got ahead of a head which is waiting for more units than are available
+            self._wake_waiters()
+        try:
+            await waiter[3]
+        except asyncio.CancelledError:
+            fut = waiter[3]
+            if not fut.cancelled() and not fut.exception():
+                # the units were handed to us before we got cancelled
+                self._return_units(num)
+            else:
+                try:
+                    self._acquire_waiters.remove(waiter)
+                    heapq.heapify(self._acquire_waiters)
+                except ValueError:
+                    pass  # already dropped by `_wake_waiters`
+                self._wake_waiters()  # we may have been blocking the head of the queue
+            raise
         finally:
             self._waiters -= 1
+            if not self._waiters and not self._pending and self._join_waiters:
+                self._notify_join()
+
+    def _shed(self, num: int, max_wait: float=None, priority: int=0):
+        """
+        Raises `Rejected` if a task about to queue up for `num` units should be turned away
+
+        :param num: number of units
+        :param max_wait: overrides the limiter's `max_wait`
+        :param priority: priority the task would queue up with
+        """
+        if self._max_waiters is not None and self._waiters >= self._max_waiters:
+            self._reject("Rate limiter has {} waiters".format(self._waiters))
+
+        max_wait = self._max_wait if max_wait is None else max_wait
+        if max_wait is None:
+            return
+
+        # Waiters are served in order, so we get in once the units of everyone queued ahead of us have expired too.
+        # If they aren't all in the window yet they can't expire before a full period from now.
+        rank = self._rank(priority)
+        queued = sum(waiter[2] for waiter in self._acquire_waiters if waiter[0] <= rank and not waiter[3].done())
+        short = queued + num - self._available
+        if short <= 0:
+            return
+
+        admit_ts = self._end_time_q.admit_time(short)
+        delay_s = self._period_s if admit_ts is None else admit_ts - self._clock()
+
+        if delay_s > max_wait:
+            self._reject("Rate limiter can't admit {} units for {:.3f}s".format(num, delay_s))
+
+    def _reject(self, msg: str):
+        if self._stats is not None:
+            self._stats.rejected += 1
+        raise self.Rejected(msg)
+
+    def _admit_delay(self, num: int) -> float or None:
+        """
+        Seconds until `num` units can be acquired according to the hits in the window
+
+        :return: 0 if they're available now, or None if it depends on queued waiters or units which haven't been released yet
+        """
+        if self._acquire_waiters:
+            return None
+
+        now = self._clock()
+        if self._available < num:
+            # return anything which expired but the release worker hasn't gotten to yet
+            self._available += self._end_time_q.expire(now)
+
+        if self._available >= num:
+            return 0
+
+        admit_ts = self._end_time_q.admit_time(num - self._available)
+        return None if admit_ts is None else admit_ts - now
+
+    def _return_units(self, num: int):
+        self._available += num
+        self._wake_waiters()
+
+    def _wake_waiters(self):
+        # hand units to waiters in order, stopping at the first one we can't satisfy
+        while self._acquire_waiters:
+            _, _, num, fut = self._acquire_waiters[0]
+            if fut.done():
+                # cancelled waiter which hasn't cleaned up yet
+                heapq.heappop(self._acquire_waiters)
+                continue
+
+            if self._available < num:
+                break
+
+            heapq.heappop(self._acquire_waiters)
+            self._available -= num
+            fut.set_result(None)
+
+    def _release_expired(self) -> float or None:
+        """
+        Returns the units of each record that expired its period from when it finished
+
+        :return: seconds until the next expiry, or None if there are no more records
+        """
+        try:
+            now = self._clock()  # cache as this call is not cheap
+
+            released = self._end_time_q.expire(now)
+            if released:
+                self._return_units(released)
+
+            next_expiry_ts = self._end_time_q.next_expiry()
+            if next_expiry_ts is None:
+                self._scheduled = False
+                self._notify_join()
+                return None
+
+            return next_expiry_ts - now
+        except BaseException as e:
+            self._set_broken(e)
+            return None
+
+    def _set_broken(self, e: BaseException):
+        # if releasing fails, the ratelimiter will be marked as broken and all current and future acquires will raise
+        self._logger.exception("Failed while attempting to release units")
+        self._release_worker_exception = e
+        self._scheduled = False
+        self._notify_join()
+
+        # fail all current waiters, future acquires will raise immediately
+        while self._acquire_waiters:
+            fut = heapq.heappop(self._acquire_waiters)[3]
+            if not fut.done():
+                error = self.Error("Error while acquiring rate limiter")
+                error.__cause__ = e
+                fut.set_exception(error)
+        # NOTE: theoretically we could try to "reset" the limiter after flushing the window
 
     async def _release_worker(self, sleep_s):
         try:
-            # swapping back/forth at this point is ok because __aexit__ will not swap as it does not yield will detect we're already running
-            await asyncio.sleep(sleep_s)
-
-            now = time.time()  # cache as this call is not cheap
-
-            # Here we'll release each semaphore that expired its period from when it finished
-            # We have a loop as an optimization against having multipler timers since the timer may be called later
-            # than when wanted, and thus we may have multiple semaphores that we can release.
-            while len(self._end_time_q):
-                oldest_finished_ts = self._end_time_q[0]
-                time_since_finished_ts = now - oldest_finished_ts
-                if time_since_finished_ts >= self._period_s:
-                    # if either of these fail, the ratelimiter will be marked as broken and all current and future acquires will raise
-                    self._end_time_q.popleft()
-                    self._sema.release()
-                else:
-                    # swapping here is ok for same reason as above
-                    await asyncio.sleep(self._period_s - time_since_finished_ts)
-                    now = time.time()  # we need to update time after we sleep
+            # swapping back/forth at this point is ok because `release` will not swap as it does not yield will detect we're already running
+            # We loop as an optimization against having multiple timers since the timer may be called later than when
+            # wanted, and thus we may have multiple records that we can release.
+            while sleep_s is not None:
+                await asyncio.sleep(sleep_s)
+                sleep_s = self._release_expired()
         except BaseException as e:
-            self._logger.exception("Failed while attempting to release semaphores")
-            self._release_worker_exception = e  # must set this before we set the event
-            self._broken_event.set()
-            # NOTE: theoretically we could try to "reset" the limiter after flushing the semas
+            self._set_broken(e)
             raise
         finally:
             self._release_task = None  # only clear this when we're actually exiting
 
     async def __aexit__(self, exc_type, exc_val, exc_tb):
         # NOTE: Even if there's a pending exception we have to assume the call counted
+        self.release()
+
+    def cancel(self, num: int=1):
+        """
+        Returns `num` acquired units which were never used, without registering a hit
+
+        :param num: number of units to return, must not exceed what was acquired
+        """
+        self._return_units(num)
+
+    def release(self, num: int=1):
+        """
+        Registers a hit of `num` units, they will be returned to the limiter `period_s` from now
+
+        :param num: number of units to release, must match what was acquired
+        """
+        assert isinstance(num, int) and 0 < num <= self._max_rate
 
         # It's important no yields occur because this and _release_worker modify self._end_time_q.  We're
         # relying on asyncio behavior of only allowing one task to run at a time as a lock.
         try:
-            # If this fails you'll permanently decrease your available max_rate by one, and if max_rate == 1 deadlock
-            self._end_time_q.append(time.time())
+            # If this fails you'll permanently decrease your available max_rate by `num`, and if max_rate == num deadlock
+            self._end_time_q.add(self._clock(), num)
 
-            if not self._release_task:
+            if not self._scheduled:
                 # If there's already a timer we don't need to register a new one because the existing
                 # timer will iterate through all the pending events and re-register if they're not yet releasable.
-                # If this fails you'll deadlock if your max_rate == 1
-                self._release_task = asyncio.ensure_future(self._release_worker(self._period_s))
+                # If this fails you'll deadlock if your max_rate == num
+                if self._release_driver:
+                    self._release_driver.schedule(self, self._period_s)
+                else:
+                    self._release_task = asyncio.ensure_future(self._release_worker(self._period_s))
+                self._scheduled = True
         except BaseException:
             self._logger.exception("Error registering rate limiter hit, potential for deadlock!!!")
             raise
+
+
+async def reserve_all(limiters: List[RateLimiter], num: int=1, max_wait: float=None, priority: int=0):
+    """
+    Acquires `num` units from every limiter in `limiters`, or from none of them.
+
+    If any limiter is short we queue up on the most constrained one, ie: the one whose units are furthest away, until
+    it hands us its units in order like any other waiter.  We then hold them while checking the others, and give them
+    back before queueing again if any of those is short, so we never hold units of one limiter while waiting on another.
+    While we wait none of the limiters is idle, so a cache can't drop the ones we aren't queued on.
+
+    :param limiters: limiters to acquire from
+    :param num: number of units to acquire from each limiter
+    :param max_wait: see `RateLimiter.acquire`, it's checked against every limiter before waiting as are their `max_waiters`
+    :param priority: see `RateLimiter.acquire`
+    """
+    limiters = list(set(limiters))
+    wait_start = None  # for stats, set once we have to wait
+    held = None  # limiter which handed us its units while we waited in its queue
+
+    try:
+        while True:
+            blocked = None
+            blocked_delay_s = 0
+            for limiter in limiters:
+                assert isinstance(num, int) and 0 < num <= limiter.max_rate
+
+                if limiter.is_broken:
+                    if held:
+                        held._return_units(num)
+                    raise limiter.Error("Error while acquiring rate limiter") from limiter._release_worker_exception
+
+                if limiter is held:
+                    continue
+
+                delay_s = limiter._admit_delay(num)
+                if delay_s is None:
+                    # depends on units in use or on queued waiters
+                    blocked = limiter
+                    break
+
+                if delay_s > blocked_delay_s:
+                    blocked, blocked_delay_s = limiter, delay_s
+
+            if not blocked:
+                # no yields since checking the limiters, so they can all admit us
+                wait_s = 0 if wait_start is None else limiters[0]._loop.time() - wait_start
+                for limiter in limiters:
+                    if limiter is not held:
+                        limiter._available -= num
+                    if limiter._stats is not None:
+                        limiter._stats.record(wait_s)
+                return
+
+            if held:
+                held._return_units(num)
+                held = None
+
+            if wait_start is None:
+                # only shed before we start waiting, later checks would just waste the wait
+                for limiter in limiters:
+                    limiter._shed(num, max_wait, priority)
+                wait_start = limiters[0]._loop.time()
+                for limiter in limiters:
+                    limiter._pending += 1
+
+            await blocked._wait(num, priority)
+            held = blocked
+    finally:
+        if wait_start is not None:
+            for limiter in limiters:
+                limiter._pending -= 1
+                if not limiter._waiters and not limiter._pending and limiter._join_waiters:
+                    limiter._notify_join()
+
+
+def release_all(limiters: List[RateLimiter], num: int=1):
+    """
+    Registers a hit of `num` units on every limiter in `limiters`
+
+    :param limiters: limiters which were acquired with `reserve_all`
+    :param num: number of units acquired from each limiter
+    """
+    for limiter in set(limiters):
+        limiter.release(num)
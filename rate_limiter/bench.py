@@ -0,0 +1,297 @@
+import argparse
+import asyncio
+from functools import partial
+import gc
+import json
+import logging
+import sys
+import threading
+import time
+import tracemalloc
+from typing import Callable, Dict, List
+
+from . import async_limiter_context, limiter_context
+from .async_rate_limiter import RateLimiter as ASyncRateLimiter
+from .sync_rate_limiter import RateLimiter as SyncRateLimiter
+
+
+# Benchmarks for the limiters, run with: python -m rate_limiter.bench [--quick]
+#
+# Every engine is measured for:
+#  - uncontended ops/s: acquire + release from a single thread / task, with a limit which is never reached
+#  - contended ops/s: the same split between 1-256 threads / tasks sharing the limiter
+#  - wake-up latency: how late a blocked acquire returns after the hit it waited for expired
+#  - tail wait (sync only): how long acquires wait when `_TAIL_THREADS` threads contend for a limit they exceed, the
+#    tail shows whether threads get overtaken, ex: `SyncRateLimiter` vs `SyncRateLimiter(fifo=True)`
+#  - memory per limiter and per in-window hit (limiters only, the contexts wrap the same limiters)
+# The results are printed as JSON so runs can be compared.
+
+_LOGGER = logging.getLogger("rate_limiter.bench")
+
+# a limit which is never reached, with a period short enough for the window to be released during the run and for
+# the async benchmarks to drain their limiters cheaply
+_UNLIMITED_RATE = 10 ** 9
+_UNLIMITED_PERIOD_S = 0.1
+
+_CONCURRENCY = (1, 4, 16, 64, 256)
+
+# many more threads than the limit admits per period, so they queue up
+_TAIL_THREADS = 32
+_TAIL_RATE = 4
+
+
+def _percentiles(samples: List[float]) -> Dict[str, float]:
+    samples = sorted(samples)
+
+    def _pct(pct):
+        return samples[min(int(len(samples) * pct), len(samples) - 1)]
+
+    return {
+        "p50_us": round(_pct(0.5) * 1e6, 1),
+        "p99_us": round(_pct(0.99) * 1e6, 1),
+        "p999_us": round(_pct(0.999) * 1e6, 1),
+        "max_us": round(samples[-1] * 1e6, 1),
+    }
+
+
+# Each engine is a function of (max_rate, period_s) which returns a callable of `num` returning a context manager,
+# ie: the interface shared by the limiters and the `limiters_context` partials
+
+def _sync_limiter(max_rate: int, period_s: float, buckets: int=None, fifo: bool=False):
+    return SyncRateLimiter(max_rate, period_s, _LOGGER, buckets=buckets, fifo=fifo)
+
+
+def _sync_limiters_context(max_rate: int, period_s: float):
+    limiters = [SyncRateLimiter(max_rate, period_s, _LOGGER) for _ in range(2)]
+    return partial(limiter_context.limiters_context, limiters=limiters, service=limiter_context.LimiterServices.Gmail)
+
+
+def _async_limiter(max_rate: int, period_s: float, buckets: int=None):
+    return ASyncRateLimiter(max_rate, period_s, _LOGGER, buckets=buckets)
+
+
+def _async_limiters_context(max_rate: int, period_s: float):
+    limiters = [ASyncRateLimiter(max_rate, period_s, _LOGGER) for _ in range(2)]
+    return partial(async_limiter_context.limiters_context, limiters=limiters, service=limiter_context.LimiterServices.Gmail)
+
+
+def _limiters(ctx) -> list:
+    # the limiters behind an engine's return value
+    return ctx.keywords["limiters"] if isinstance(ctx, partial) else [ctx]
+
+
+async def _async_drain(ctx):
+    # wait for the release tasks rather than leave them pending for the loop to destroy
+    for limiter in _limiters(ctx):
+        await limiter.join()
+
+
+SYNC_ENGINES = {
+    "SyncRateLimiter": _sync_limiter,
+    "SyncRateLimiter(buckets=1000)": partial(_sync_limiter, buckets=1000),
+    "SyncRateLimiter(fifo=True)": partial(_sync_limiter, fifo=True),
+    "limiters_context": _sync_limiters_context,
+}
+
+ASYNC_ENGINES = {
+    "ASyncRateLimiter": _async_limiter,
+    "ASyncRateLimiter(buckets=1000)": partial(_async_limiter, buckets=1000),
+    "async_limiters_context": _async_limiters_context,
+}
+
+
+def _sync_ops(factory: Callable, ops: int, concurrency: int) -> float:
+    ctx = factory(_UNLIMITED_RATE, _UNLIMITED_PERIOD_S)
+    per_thread = ops // concurrency
+    barrier = threading.Barrier(concurrency + 1)
+
+    def _worker():
+        barrier.wait()
+        for _ in range(per_thread):
+            with ctx():
+                pass
+
+    threads = [threading.Thread(target=_worker) for _ in range(concurrency)]
+    for thread in threads:
+        thread.start()
+
+    barrier.wait()
+    start = time.perf_counter()
+    for thread in threads:
+        thread.join()
+    return per_thread * concurrency / (time.perf_counter() - start)
+
+
+def _sync_wake_latency(factory: Callable, samples: int, period_s: float) -> List[float]:
+    ctx = factory(1, period_s)
+    latencies = []
+    with ctx():
+        pass
+    released = time.monotonic()
+
+    for _ in range(samples):
+        # blocks until the previous hit expires
+        with ctx():
+            latencies.append(time.monotonic() - (released + period_s))
+        released = time.monotonic()
+
+    return latencies
+
+
+def _sync_tail_wait(factory: Callable, samples: int, period_s: float) -> List[float]:
+    """
+    :return: seconds each of `samples` acquires waited, split between `_TAIL_THREADS` threads
+    """
+    ctx = factory(_TAIL_RATE, period_s)
+    per_thread = max(samples // _TAIL_THREADS, 1)
+    barrier = threading.Barrier(_TAIL_THREADS)
+    waits = []
+
+    def _worker():
+        barrier.wait()
+        for _ in range(per_thread):
+            start = time.monotonic()
+            with ctx():
+                waits.append(time.monotonic() - start)
+
+    threads = [threading.Thread(target=_worker) for _ in range(_TAIL_THREADS)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return waits
+
+
+async def _async_ops(factory: Callable, ops: int, concurrency: int) -> float:
+    ctx = factory(_UNLIMITED_RATE, _UNLIMITED_PERIOD_S)
+    per_task = ops // concurrency
+    start_event = asyncio.Event()
+
+    async def _worker():
+        await start_event.wait()
+        for _ in range(per_task):
+            async with ctx():
+                pass
+
+            if concurrency > 1:
+                await asyncio.sleep(0)  # the limiter never blocks, so let the other tasks interleave
+
+    tasks = [asyncio.ensure_future(_worker()) for _ in range(concurrency)]
+    await asyncio.sleep(0)
+
+    start = time.perf_counter()
+    start_event.set()
+    await asyncio.gather(*tasks)
+    elapsed_s = time.perf_counter() - start
+
+    await _async_drain(ctx)
+    return per_task * concurrency / elapsed_s
+
+
+async def _async_wake_latency(factory: Callable, samples: int, period_s: float) -> List[float]:
+    loop = asyncio.get_event_loop()
+    ctx = factory(1, period_s)
+    latencies = []
+    async with ctx():
+        pass
+    released = loop.time()
+
+    for _ in range(samples):
+        async with ctx():
+            latencies.append(loop.time() - (released + period_s))
+        released = loop.time()
+
+    await _async_drain(ctx)
+    return latencies
+
+
+def _memory(factory: Callable, count: int, hits: int) -> Dict[str, float]:
+    """
+    :return: dict of: {'per_limiter_bytes', 'per_hit_bytes'}
+    """
+    gc.collect()
+    tracemalloc.start()
+    try:
+        start = tracemalloc.get_traced_memory()[0]
+        limiters = [factory(_UNLIMITED_RATE, 3600) for _ in range(count)]
+        per_limiter = (tracemalloc.get_traced_memory()[0] - start) / count
+
+        # only register the hits in the window so nothing gets scheduled
+        window = limiters[0]._end_time_q
+        start = tracemalloc.get_traced_memory()[0]
+        now = time.monotonic()
+        for i in range(hits):
+            window.add(now + i * 1e-4, 1)
+        per_hit = (tracemalloc.get_traced_memory()[0] - start) / hits
+    finally:
+        tracemalloc.stop()
+
+    return {"per_limiter_bytes": round(per_limiter, 1), "per_hit_bytes": round(per_hit, 1)}
+
+
+def run(ops: int=100_000, samples: int=1000, period_s: float=0.002, memory: bool=True) -> Dict[str, dict]:
+    """
+    Runs all the benchmarks
+
+    :param ops: number of acquire + release for the throughput benchmarks
+    :param samples: number of wake-ups / acquires for the latency benchmarks
+    :param period_s: period of the limiter in the latency benchmarks
+    :param memory: whether to measure memory
+    :return: dict of: {engine: results}
+    """
+    results = dict()
+
+    for name, factory in SYNC_ENGINES.items():
+        results[name] = {
+            "uncontended_ops_s": round(_sync_ops(factory, ops, 1)),
+            "contended_ops_s": {str(concurrency): round(_sync_ops(factory, ops, concurrency)) for concurrency in _CONCURRENCY},
+            "wake_latency": _percentiles(_sync_wake_latency(factory, samples, period_s)),
+            "tail_wait": _percentiles(_sync_tail_wait(factory, samples, period_s)),
+        }
+
+    loop = asyncio.get_event_loop()
+    for name, factory in ASYNC_ENGINES.items():
+        results[name] = {
+            "uncontended_ops_s": round(loop.run_until_complete(_async_ops(factory, ops, 1))),
+            "contended_ops_s": {str(concurrency): round(loop.run_until_complete(_async_ops(factory, ops, concurrency))) for concurrency in _CONCURRENCY},
+            "wake_latency": _percentiles(loop.run_until_complete(_async_wake_latency(factory, samples, period_s))),
+        }
+
+    if memory:
+        for name, factory in (("SyncRateLimiter", _sync_limiter), ("SyncRateLimiter(buckets=1000)", SYNC_ENGINES["SyncRateLimiter(buckets=1000)"])):
+            results[name]["memory"] = _memory(factory, 1000, 100_000)
+
+        async def _async_memory(factory):
+            # nothing gets scheduled, see `_memory`, so there are no release tasks to drain
+            return _memory(factory, 1000, 100_000)
+
+        for name in ("ASyncRateLimiter", "ASyncRateLimiter(buckets=1000)"):
+            results[name]["memory"] = loop.run_until_complete(_async_memory(ASYNC_ENGINES[name]))
+
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks the rate limiters and prints the results as JSON")
+    parser.add_argument("--quick", action="store_true", help="run fewer iterations, for smoke testing")
+    parser.add_argument("--no-memory", action="store_true", help="skip the memory benchmarks")
+    parser.add_argument("--output", help="file to write the JSON to instead of stdout")
+    args = parser.parse_args()
+
+    ops, samples = (10_000, 100) if args.quick else (100_000, 1000)
+    results = {
+        "python": sys.version.split()[0],
+        "results": run(ops, samples, memory=not args.no_memory),
+    }
+
+    output = json.dumps(results, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(output + "\n")
+    else:
+        print(output)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,480 @@
+import asyncio
+from concurrent.futures import Future, TimeoutError as FutureTimeoutError
+from contextlib import contextmanager
+from functools import partial
+import itertools
+import logging
+import socket
+import threading
+from typing import ContextManager, Dict, List
+
+from .limiter_context import GLOBAL_LIMITERS, PER_USER_LIMITERS, LimiterServices
+from .server import _REQUEST, _RESPONSE, OP_ACQUIRE, OP_RELEASE, OP_CANCEL, OP_RETURN, STATUS_OK, STATUS_UNLIMITED, \
+    DEFAULT_PATH, limiter_key
+
+
+# Clients of `rate_limiter.server`.  `get_limiters` and `get_per_user_limiter_context` return the same structures as
+# `limiter_context` / `async_limiter_context`, ie: partials of a limiters context with `limiters` and `service`, and take
+# the same arguments, so code using those can switch to the shared daemon without changes.
+
+class Error(Exception):
+    pass
+
+
+def _per_user_keys(service_name: LimiterServices, user_name: str) -> Dict[str, str or None]:
+    # mirrors `limiter_context.get_per_user_limiter_context`: None if the service has no per user limits
+    return {
+        limiter_type: limiter_key(limiter_type, service_name, user_name) if service_name in PER_USER_LIMITERS[limiter_type] else None
+        for limiter_type in ("request", "quota")
+    }
+
+
+class _SyncLimiterContext:
+    __slots__ = ('_limiter', '_num')
+
+    def __init__(self, limiter, num: int):
+        self._limiter = limiter
+        self._num = num
+
+    def __enter__(self):
+        self._limiter.acquire(self._num)
+        return self._limiter
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        # NOTE: Even if there's a pending exception we have to assume the __enter__ call counted
+        self._limiter.release(self._num)
+
+
+class SyncRemoteLimiter:
+    def __init__(self, client: 'SyncClient', key: str):
+        """
+        Proxy with the `SyncRateLimiter` API for the limiters of `key` on the server
+
+        :param client: client to use
+        :param key: protocol key, see `server.limiter_key`
+        """
+        self._client = client
+        self._key = key
+        self._unlimited = False
+
+    def __call__(self, num: int=1) -> _SyncLimiterContext:
+        """
+        Returns a context manager which will acquire `num` units on enter and release them on exit
+
+        :param num: number of units
+        """
+        return _SyncLimiterContext(self, num)
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
+
+    def acquire(self, num: int=1, timeout=None):
+        """
+        Acquires `num` units from the limiters of our key in a single step
+
+        :param num: number of units to acquire
+        :param timeout: max seconds to wait, raises `TimeoutError` if exceeded
+        """
+        if self._unlimited:
+            return
+
+        req_id, fut = self._client._request(OP_ACQUIRE, self._key, num)
+        try:
+            status = fut.result(timeout)
+        except FutureTimeoutError:
+            self._client._request(OP_CANCEL, self._key, 0, req_id)
+            if fut.result() == STATUS_OK:
+                # it was granted before the server got our cancel
+                self.release(num)
+            raise TimeoutError("Timed out acquiring rate limiter")
+
+        if status == STATUS_UNLIMITED:
+            self._unlimited = True
+        elif status != STATUS_OK:
+            raise Error("Error acquiring {}: status {}".format(self._key, status))
+
+    def release(self, num: int=1):
+        """
+        Registers a hit of `num` units, this doesn't wait for the server
+
+        :param num: number of units to release, must match what was acquired
+        """
+        if not self._unlimited:
+            self._client._request(OP_RELEASE, self._key, num)
+
+    def cancel(self, num: int=1):
+        """
+        Returns `num` acquired units which were never used, without registering a hit.  This doesn't wait for the server.
+
+        :param num: number of units to return, must not exceed what was acquired
+        """
+        if not self._unlimited:
+            self._client._request(OP_RETURN, self._key, num)
+
+
+# limiters + service params have defaults because we want `num` to be positional and have a default
+@contextmanager
+def limiters_context(num: int=1, limiters: List[SyncRemoteLimiter]=None, service: LimiterServices=None) -> ContextManager:
+    """
+    `limiter_context.limiters_context` for the contexts of `SyncClient`.  The server acquires all the limiters of a key
+    in a single step, limiters added to a context (ex: with `get_limiters_context_with_added_limiters`) are acquired
+    after it in order.  `max_wait` and `priority` aren't supported by the protocol.
+
+    :param num: number of API queries which will be called
+    :param limiters: list of limiters to acquire from
+    :param service: service of limiters
+    """
+    acquired = []
+    try:
+        for limiter in limiters:
+            limiter.acquire(num)
+            acquired.append(limiter)
+    except BaseException:
+        for limiter in acquired:
+            limiter.cancel(num)
+        raise
+
+    try:
+        yield
+    finally:
+        for limiter in acquired:
+            limiter.release(num)
+
+
+class SyncClient:
+    def __init__(self, logger: logging.Logger, path: str=DEFAULT_PATH):
+        """
+        Thread-safe client, requests from all threads are pipelined over a single connection
+
+        :param logger: logger to use
+        :param path: path of the server's Unix socket
+        """
+        self._logger = logger
+        self._sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._sock.connect(path)
+        self._send_lock = threading.Lock()
+        self._req_ids = itertools.count(1)
+        self._pending_lock = threading.Lock()
+        self._pending = dict()  # dict of: {req_id: Future of the response status}, None once the connection is lost
+        self._reader = threading.Thread(target=self._read_responses, name="RateLimiterClient", daemon=True)
+        self._reader.start()
+
+    def limiter(self, key: str) -> SyncRemoteLimiter:
+        return SyncRemoteLimiter(self, key)
+
+    def get_limiters(self, logger: logging.Logger, stats: bool=False) -> Dict[str, Dict[LimiterServices, partial]]:
+        """
+        Equivalent of `limiter_context.get_limiters`, with the same signature so it can be swapped in
+
+        :param logger: ignored, the limiters live in the server
+        :param stats: ignored, the stats are collected by the server
+        :return: dict of: {limiter_type: {service_name: partial of `limiters_context`}}
+        """
+        return {
+            limiter_type: {svc: self._context(limiter_key(limiter_type, svc), svc) for svc in limiters}
+            for limiter_type, limiters in GLOBAL_LIMITERS.items()
+        }
+
+    def get_per_user_limiter_context(self, logger: logging.Logger, limiters: Dict, service_name: LimiterServices, user_name: str) -> Dict[str, partial]:
+        """
+        Equivalent of `limiter_context.get_per_user_limiter_context`, with the same signature so it can be swapped in
+
+        :param logger: ignored, the limiters live in the server
+        :param limiters: ignored, ex: the value from `get_limiters`
+        :param service_name: service name from which to get limiters
+        :param user_name: user name associated with this set of limiters
+        """
+        return {limiter_type: key and self._context(key, service_name) for limiter_type, key in _per_user_keys(service_name, user_name).items()}
+
+    def _context(self, key: str, service_name: LimiterServices) -> partial:
+        return partial(limiters_context, limiters=[self.limiter(key)], service=service_name)
+
+    def close(self):
+        self._sock.shutdown(socket.SHUT_RDWR)
+        self._reader.join()
+        self._sock.close()
+
+    def _request(self, op: int, key: str, num: int, req_id: int=None) -> (int, Future):
+        key_bytes = key.encode()
+        fut = None
+        if req_id is None:
+            req_id = next(self._req_ids) & 0xFFFFFFFF
+            fut = Future()
+            if op in (OP_RELEASE, OP_RETURN):
+                fut.add_done_callback(self._check_release)
+
+            with self._pending_lock:
+                if self._pending is None:
+                    # nobody would ever resolve it
+                    raise ConnectionError("Connection to rate limiter server lost")
+                self._pending[req_id] = fut
+
+        with self._send_lock:
+            self._sock.sendall(_REQUEST.pack(req_id, op, len(key_bytes), num) + key_bytes)
+
+        return req_id, fut
+
+    def _check_release(self, fut: Future):
+        if fut.exception() or fut.result() != STATUS_OK:
+            self._logger.error("Error releasing rate limiter units: {}".format(fut.exception() or fut.result()))
+
+    def _read_responses(self):
+        buf = bytearray()
+        try:
+            while True:
+                data = self._sock.recv(65536)
+                if not data:
+                    break
+
+                buf += data
+                end = len(buf) - len(buf) % _RESPONSE.size
+                with self._pending_lock:
+                    responses = [(self._pending.pop(req_id), status) for req_id, status in _RESPONSE.iter_unpack(buf[:end])]
+                del buf[:end]
+
+                # outside the lock so done callbacks can make requests
+                for fut, status in responses:
+                    fut.set_result(status)
+        except OSError:
+            pass
+        finally:
+            # callers may still be adding requests, swap them out so no new ones get in
+            with self._pending_lock:
+                pending, self._pending = self._pending, None
+
+            for fut in pending.values():
+                fut.set_exception(ConnectionError("Connection to rate limiter server lost"))
+
+
+class _ASyncLimiterContext:
+    __slots__ = ('_limiter', '_num')
+
+    def __init__(self, limiter, num: int):
+        self._limiter = limiter
+        self._num = num
+
+    async def __aenter__(self):
+        await self._limiter.acquire(self._num)
+        return self._limiter
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        # NOTE: Even if there's a pending exception we have to assume the __aenter__ call counted
+        self._limiter.release(self._num)
+
+
+class ASyncRemoteLimiter:
+    def __init__(self, client: 'ASyncClient', key: str):
+        """
+        Proxy with the `ASyncRateLimiter` API for the limiters of `key` on the server
+
+        :param client: client to use
+        :param key: protocol key, see `server.limiter_key`
+        """
+        self._client = client
+        self._key = key
+        self._unlimited = False
+
+    def __call__(self, num: int=1) -> _ASyncLimiterContext:
+        """
+        Returns an async context manager which will acquire `num` units on enter and release them on exit
+
+        :param num: number of units
+        """
+        return _ASyncLimiterContext(self, num)
+
+    async def __aenter__(self):
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        self.release()
+
+    async def acquire(self, num: int=1):
+        """
+        Acquires `num` units from the limiters of our key in a single step
+
+        :param num: number of units to acquire
+        """
+        if self._unlimited:
+            return
+
+        req_id, fut = self._client._request(OP_ACQUIRE, self._key, num)
+        try:
+            status = await asyncio.shield(fut)
+        except asyncio.CancelledError:
+            self._client._request(OP_CANCEL, self._key, 0, req_id)
+
+            def _on_cancelled(fut: asyncio.Future):
+                # it was granted before the server got our cancel
+                if not fut.exception() and fut.result() == STATUS_OK:
+                    self.release(num)
+
+            fut.add_done_callback(_on_cancelled)
+            raise
+
+        if status == STATUS_UNLIMITED:
+            self._unlimited = True
+        elif status != STATUS_OK:
+            raise Error("Error acquiring {}: status {}".format(self._key, status))
+
+    def release(self, num: int=1):
+        """
+        Registers a hit of `num` units, this doesn't wait for the server
+
+        :param num: number of units to release, must match what was acquired
+        """
+        if not self._unlimited:
+            self._client._request(OP_RELEASE, self._key, num)
+
+    def cancel(self, num: int=1):
+        """
+        Returns `num` acquired units which were never used, without registering a hit.  This doesn't wait for the server.
+
+        :param num: number of units to return, must not exceed what was acquired
+        """
+        if not self._unlimited:
+            self._client._request(OP_RETURN, self._key, num)
+
+
+class _LimitersContext:
+    __slots__ = ('_limiters', '_num', '_acquired')
+
+    def __init__(self, limiters: List[ASyncRemoteLimiter], num: int):
+        self._limiters = limiters
+        self._num = num
+        self._acquired = []
+
+    async def __aenter__(self):
+        try:
+            for limiter in self._limiters:
+                await limiter.acquire(self._num)
+                self._acquired.append(limiter)
+        except BaseException:
+            for limiter in self._acquired:
+                limiter.cancel(self._num)
+            self._acquired = []
+            raise
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        # NOTE: Even if there's a pending exception we have to assume the __aenter__ call counted
+        for limiter in self._acquired:
+            limiter.release(self._num)
+        self._acquired = []
+
+
+# limiters + service params have defaults because we want `num` to be positional and have a default
+def async_limiters_context(num: int=1, limiters: List[ASyncRemoteLimiter]=None, service: LimiterServices=None) -> _LimitersContext:
+    """
+    `async_limiter_context.limiters_context` for the contexts of `ASyncClient`, see `limiters_context`
+
+    :param num: number of API queries which will be called
+    :param limiters: list of limiters to acquire from
+    :param service: service of limiters
+    """
+    return _LimitersContext(limiters, num)
+
+
+class ASyncClient:
+    def __init__(self, logger: logging.Logger):
+        """
+        Client for asyncio, requests are pipelined over a single connection and the requests made in the same loop
+        iteration are sent with a single write.  Use `connect` to create one.
+
+        :param logger: logger to use
+        """
+        self._logger = logger
+        self._loop = asyncio.get_event_loop()
+        self._reader: asyncio.StreamReader = None
+        self._writer: asyncio.StreamWriter = None
+        self._read_task: asyncio.Task = None
+        self._req_ids = itertools.count(1)
+        self._pending = dict()  # dict of: {req_id: future of the response status}
+        self._out = bytearray()
+
+    @classmethod
+    async def connect(cls, logger: logging.Logger, path: str=DEFAULT_PATH) -> 'ASyncClient':
+        """
+        :param logger: logger to use
+        :param path: path of the server's Unix socket
+        """
+        client = cls(logger)
+        client._reader, client._writer = await asyncio.open_unix_connection(path)
+        client._read_task = asyncio.ensure_future(client._read_responses())
+        return client
+
+    def limiter(self, key: str) -> ASyncRemoteLimiter:
+        return ASyncRemoteLimiter(self, key)
+
+    def get_limiters(self, logger: logging.Logger, stats: bool=False) -> Dict[str, Dict[LimiterServices, partial]]:
+        """
+        Equivalent of `async_limiter_context.get_limiters`, with the same signature so it can be swapped in
+
+        :param logger: ignored, the limiters live in the server
+        :param stats: ignored, the stats are collected by the server
+        :return: dict of: {limiter_type: {service_name: partial of `async_limiters_context`}}
+        """
+        return {
+            limiter_type: {svc: self._context(limiter_key(limiter_type, svc), svc) for svc in limiters}
+            for limiter_type, limiters in GLOBAL_LIMITERS.items()
+        }
+
+    def get_per_user_limiter_context(self, logger: logging.Logger, limiters: Dict, service_name: LimiterServices, user_name: str) -> Dict[str, partial]:
+        """
+        Equivalent of `async_limiter_context.get_per_user_limiter_context`, with the same signature so it can be swapped in
+
+        :param logger: ignored, the limiters live in the server
+        :param limiters: ignored, ex: the value from `get_limiters`
+        :param service_name: service name from which to get limiters
+        :param user_name: user name associated with this set of limiters
+        """
+        return {limiter_type: key and self._context(key, service_name) for limiter_type, key in _per_user_keys(service_name, user_name).items()}
+
+    def _context(self, key: str, service_name: LimiterServices) -> partial:
+        return partial(async_limiters_context, limiters=[self.limiter(key)], service=service_name)
+
+    async def close(self):
+        self._flush()
+        self._writer.close()
+        await self._read_task
+
+    def _request(self, op: int, key: str, num: int, req_id: int=None) -> (int, asyncio.Future):
+        key_bytes = key.encode()
+        fut = None
+        if req_id is None:
+            req_id = next(self._req_ids) & 0xFFFFFFFF
+            fut = self._pending[req_id] = self._loop.create_future()
+            if op in (OP_RELEASE, OP_RETURN):
+                fut.add_done_callback(self._check_release)
+
+        if not self._out:
+            self._loop.call_soon(self._flush)
+        self._out += _REQUEST.pack(req_id, op, len(key_bytes), num) + key_bytes
+        return req_id, fut
+
+    def _flush(self):
+        if self._out and not self._writer.is_closing():
+            self._writer.write(bytes(self._out))
+        self._out.clear()
+
+    def _check_release(self, fut: asyncio.Future):
+        if fut.exception() or fut.result() != STATUS_OK:
+            self._logger.error("Error releasing rate limiter units: {}".format(fut.exception() or fut.result()))
+
+    async def _read_responses(self):
+        try:
+            while True:
+                req_id, status = _RESPONSE.unpack(await self._reader.readexactly(_RESPONSE.size))
+                fut = self._pending.pop(req_id)
+                if not fut.done():
+                    fut.set_result(status)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            for fut in self._pending.values():
+                if not fut.done():
+                    fut.set_exception(ConnectionError("Connection to rate limiter server lost"))
+            self._pending.clear()
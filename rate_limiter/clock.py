@@ -0,0 +1,31 @@
+from functools import partial
+import time
+
+
+# Clocks which can be passed as the `clock` parameter of the limiters.  They must be monotonic as any step backwards or
+# forwards (ex: NTP adjustments) would respectively stall callers or release a burst of hits.
+
+if hasattr(time, 'CLOCK_MONOTONIC_COARSE'):
+    # Linux only: returns the time of the last timer tick (typically 1-4ms resolution), which is cheaper to read
+    # than `time.monotonic`.  Hits may be released up to one tick early so only use it where that's acceptable.
+    coarse_monotonic = partial(time.clock_gettime, time.CLOCK_MONOTONIC_COARSE)
+else:
+    coarse_monotonic = time.monotonic
+
+
+class VirtualClock:
+    def __init__(self, start: float=0.0):
+        """
+        Clock which only moves when told to, for tests and simulations
+
+        :param start: initial time
+        """
+        self._now = start
+
+    def __call__(self) -> float:
+        return self._now
+
+    def advance(self, seconds: float):
+        """ Moves the clock forward by `seconds` """
+        assert seconds >= 0
+        self._now += seconds
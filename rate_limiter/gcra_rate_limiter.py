@@ -0,0 +1,283 @@
+import asyncio
+import logging
+import threading
+import time
+from typing import Callable
+
+
+# This is a GCRA (generic cell rate algorithm) rate limiter, which is equivalent to a lazily computed token bucket.
+# Instead of tracking every hit it stores a single "theoretical arrival time" (TAT), the time at which the limiter
+# would be empty again.  Each unit pushes the TAT forward by the emission interval, and a request is admitted
+# once the TAT minus the burst tolerance is not in the future.  Because availability is computed during acquire
+# there's no helper thread or task, and memory is constant regardless of `max_rate`.
+#
+# Like the moving-window limiters no window of `period_s` sees more than `max_rate` hits: a burst of `burst` units is
+# followed by one unit per emission interval of `period_s / (max_rate - burst + 1)`, so bursts are paid for with a
+# lower sustained rate.  The default `burst` of 1 spaces hits evenly at the full `max_rate`.
+#
+# NOTE: unlike the moving-window limiters hits are counted when acquired rather than when released, and a single
+#       acquire can't exceed `burst` units: weighted callers must pass a `burst` of at least their largest `num`, or
+#       they get a `ValueError`.
+class _GCRA:
+    def __init__(self, max_rate: int, period_s: float or int, burst: int=None):
+        """
+        :param max_rate: number of hits allowed per `period_s`
+        :param period_s: period in seconds
+        :param burst: max number of units which may be acquired back to back, defaults to 1
+        """
+        assert isinstance(max_rate, int) and max_rate > 0
+        assert period_s > 0
+
+        burst = burst or 1
+        assert isinstance(burst, int) and 0 < burst <= max_rate
+
+        self._max_rate = max_rate
+        self._period_s = period_s
+        self._burst = burst
+        self._emission_interval = period_s / (max_rate - burst + 1)
+        self._tolerance = burst * self._emission_interval
+        self._tat = 0.0
+
+    @property
+    def max_rate(self):
+        return self._max_rate
+
+    @property
+    def is_broken(self):
+        # there is no background worker which can fail
+        return False
+
+    @property
+    def is_idle(self):
+        """ True if the limiter is back to a full burst, so dropping it loses no history """
+        return self._tat <= self._clock()
+
+    def _reserve(self, num: int, now: float, max_delay: float=None) -> float or None:
+        """
+        Commits `num` units if they can be admitted within `max_delay` seconds
+
+        :return: seconds until the units are admitted, or None if that would exceed `max_delay` (nothing is committed)
+        """
+        assert isinstance(num, int) and num > 0
+        if num > self._burst:
+            raise ValueError("Can't acquire {} units with a burst of {}, construct the limiter with burst >= {}".format(num, self._burst, num))
+
+        tat = max(self._tat, now) + num * self._emission_interval
+        delay = tat - self._tolerance - now
+        if delay <= 0:
+            delay = 0
+        elif max_delay is not None and delay > max_delay:
+            return None
+
+        self._tat = tat
+        return delay
+
+    def _cancel(self, num: int, tat: float):
+        # give back units from a reservation which was never used, only possible if nobody reserved after us
+        if self._tat == tat:
+            self._tat -= num * self._emission_interval
+
+
+class _SyncLimiterContext:
+    __slots__ = ('_limiter', '_num')
+
+    def __init__(self, limiter, num: int):
+        """
+        Context manager which acquires and releases `num` units from `limiter`
+
+        :param limiter: RateLimiter to acquire from
+        :param num: number of units
+        """
+        self._limiter = limiter
+        self._num = num
+
+    def __enter__(self):
+        self._limiter.acquire(self._num)
+        return self._limiter
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self._limiter.release(self._num)
+
+
+class SyncRateLimiter(_GCRA):
+    class Error(Exception):
+        pass
+
+    def __init__(self, max_rate: int, period_s: float or int, logger: logging.Logger, burst: int=None,
+                 clock: Callable[[], float]=time.monotonic):
+        """
+        Allows `max_rate` per `period_s` with bursts of up to `burst` units.  A single acquire can't exceed `burst`
+        units, so weighted callers must raise it, ex: `burst=4` for `limiter(4)`, otherwise it raises `ValueError`.
+
+        :param max_rate: number of hits allowed per `period_s`
+        :param period_s: period in seconds
+        :param logger: logger to use
+        :param burst: max number of units which may be acquired back to back, which lowers the sustained rate, see
+                      above.  Defaults to 1.
+        :param clock: monotonic clock, see `rate_limiter.clock`
+        """
+        super().__init__(max_rate, period_s, burst)
+        self._logger = logger
+        self._clock = clock
+        self._lock = threading.Lock()
+
+    def __call__(self, num: int=1) -> _SyncLimiterContext:
+        """
+        Returns a context manager which will acquire `num` units on enter
+
+        :param num: number of units
+        """
+        return _SyncLimiterContext(self, num)
+
+    def join(self):
+        """ Nothing runs in the background so there is nothing to wait for, present for API compatibility """
+        pass
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def acquire(self, num: int=1, timeout=None):
+        """
+        Acquires `num` units, waiters are admitted in the order they called acquire
+
+        :param num: number of units to acquire
+        :param timeout: max seconds to wait, raises `TimeoutError` if exceeded.  The units are not consumed in that case.
+        """
+        with self._lock:
+            delay = self._reserve(num, self._clock(), timeout)
+
+        if delay is None:
+            raise TimeoutError("Timed out acquiring rate limiter")
+
+        if delay:
+            time.sleep(delay)
+
+    def try_acquire(self, num: int=1) -> bool:
+        """
+        Acquires `num` units only if they're available right now
+
+        :param num: number of units to acquire
+        :return: whether they were acquired
+        """
+        with self._lock:
+            return self._reserve(num, self._clock(), 0) is not None
+
+    def reserve(self, num: int=1) -> float:
+        """
+        Commits `num` units now and returns the seconds until they may be used
+
+        :param num: number of units to reserve
+        :return: seconds to wait
+        """
+        with self._lock:
+            return self._reserve(num, self._clock())
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.release()
+
+    def release(self, num: int=1):
+        """ Hits are counted when acquired, present for API compatibility """
+        pass
+
+
+class _ASyncLimiterContext:
+    __slots__ = ('_limiter', '_num')
+
+    def __init__(self, limiter, num: int):
+        """
+        Async context manager which acquires and releases `num` units from `limiter`
+
+        :param limiter: RateLimiter to acquire from
+        :param num: number of units
+        """
+        self._limiter = limiter
+        self._num = num
+
+    async def __aenter__(self):
+        await self._limiter.acquire(self._num)
+        return self._limiter
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        self._limiter.release(self._num)
+
+
+class ASyncRateLimiter(_GCRA):
+    class Error(Exception):
+        pass
+
+    def __init__(self, max_rate: int, period_s: float or int, logger: logging.Logger, burst: int=None,
+                 clock: Callable[[], float]=None):
+        """
+        Allows `max_rate` per `period_s` with bursts of up to `burst` units.  A single acquire can't exceed `burst`
+        units, so weighted callers must raise it, ex: `burst=4` for `limiter(4)`, otherwise it raises `ValueError`.
+
+        :param max_rate: number of hits allowed per `period_s`
+        :param period_s: period in seconds
+        :param logger: logger to use
+        :param burst: max number of units which may be acquired back to back, which lowers the sustained rate, see
+                      above.  Defaults to 1.
+        :param clock: monotonic clock, defaults to `loop.time`.  See `rate_limiter.clock`
+        """
+        super().__init__(max_rate, period_s, burst)
+        self._loop = asyncio.get_event_loop()
+        self._clock = clock or self._loop.time
+        self._logger = logger
+
+    def __call__(self, num: int=1) -> _ASyncLimiterContext:
+        """
+        Returns an async context manager which will acquire `num` units on enter
+
+        :param num: number of units
+        """
+        return _ASyncLimiterContext(self, num)
+
+    async def join(self):
+        """ Nothing runs in the background so there is nothing to wait for, present for API compatibility """
+        pass
+
+    async def __aenter__(self):
+        await self.acquire()
+        return self
+
+    async def acquire(self, num: int=1):
+        """
+        Acquires `num` units, waiters are admitted in the order they called acquire
+
+        :param num: number of units to acquire
+        """
+        delay = self._reserve(num, self._clock())
+        if not delay:
+            return
+
+        tat = self._tat
+        try:
+            await asyncio.sleep(delay)
+        except asyncio.CancelledError:
+            self._cancel(num, tat)
+            raise
+
+    def try_acquire(self, num: int=1) -> bool:
+        """
+        Acquires `num` units only if they're available right now
+
+        :param num: number of units to acquire
+        :return: whether they were acquired
+        """
+        return self._reserve(num, self._clock(), 0) is not None
+
+    def reserve(self, num: int=1) -> float:
+        """
+        Commits `num` units now and returns the seconds until they may be used
+
+        :param num: number of units to reserve
+        :return: seconds to wait
+        """
+        return self._reserve(num, self._clock())
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        self.release()
+
+    def release(self, num: int=1):
+        """ Hits are counted when acquired, present for API compatibility """
+        pass
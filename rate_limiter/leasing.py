@@ -0,0 +1,322 @@
+import asyncio
+import logging
+import math
+import threading
+import time
+from typing import Callable
+
+from .sync_rate_limiter import ReleaseScheduler, _DEFAULT_SCHEDULER, _LimiterContext as _SyncLimiterContext
+from .async_rate_limiter import _LimiterContext as _ASyncLimiterContext
+
+
+# Leasing layer in front of a limiter which is costly to call (ex: `shared_rate_limiter`, `client`).  Units are acquired
+# from the backend in leases of K units which are then handed out locally, so most acquires don't touch the backend.
+# Hits are released to the backend in batches, and every `lease_s` the unused units of the lease are returned to it
+# (with `cancel`, so they don't count as hits) and the pending hits are released.
+#
+# K follows an EWMA of the local consumption over each lease, so a busy process leases more and an idle one holds nothing.
+# The backend counts leased units as in use, so the limit always holds, and the cost is bounded by the lease size:
+# at most `max_lease` units per process are unavailable to other processes, and hits reach the backend at most `lease_s` late.
+class _Lease:
+    def __init__(self, limiter, logger: logging.Logger, max_lease: int, lease_s: float, min_lease: int, alpha: float,
+                 clock: Callable[[], float]):
+        """
+        :param limiter: backend limiter, it must support `acquire`, `release` and `cancel`
+        :param logger: logger to use
+        :param max_lease: max units leased at once
+        :param lease_s: seconds after which unused units are returned to `limiter`
+        :param min_lease: min units leased at once
+        :param alpha: weight of the latest lease in the consumption EWMA
+        :param clock: monotonic clock used to measure consumption
+        """
+        max_rate = getattr(limiter, 'max_rate', None)
+        if max_rate:
+            max_lease = min(max_lease, max_rate)
+
+        assert 0 < min_lease <= max_lease
+        assert lease_s > 0
+        assert 0 < alpha <= 1
+
+        self._limiter = limiter
+        self._logger = logger
+        self._max_lease = max_lease
+        self._min_lease = min_lease
+        self._lease_s = lease_s
+        self._alpha = alpha
+        self._clock = clock
+
+        self._leased = 0  # units leased from `limiter` which haven't been acquired locally
+        self._used = 0  # units released locally which haven't been released to `limiter`
+        self._consumed = 0  # units acquired locally since `_period_start`
+        self._period_start = clock()
+        self._rate = 0.0  # EWMA of units acquired per second
+        self._lease_size = min_lease
+        self._scheduled = False
+
+    @property
+    def lease_size(self):
+        return self._lease_size
+
+    def _take(self, num: int) -> bool:
+        """ Takes `num` leased units if we have them """
+        if self._leased < num:
+            return False
+
+        self._leased -= num
+        self._consumed += num
+        return True
+
+    def _next_lease(self, num: int) -> int:
+        """ Number of units to lease so `num` can be taken """
+        return max(self._lease_size, num - self._leased)
+
+    def _add_lease(self, lease: int, num: int):
+        """ Adds a lease of `lease` units from which `num` were taken """
+        self._leased += lease - num
+        self._consumed += num
+
+    def _add_used(self, num: int) -> int:
+        """
+        Registers the local release of `num` units
+
+        :return: number of units to release to the backend now, they're batched until there's a lease worth of them
+        """
+        self._used += num
+        if self._used < self._lease_size:
+            return 0
+
+        used, self._used = self._used, 0
+        return used
+
+    def _expire(self) -> (int, int):
+        """
+        Ends the current lease period and updates the lease size
+
+        :return: tuple of: (unused units to cancel, used units to release) on the backend
+        """
+        now = self._clock()
+        elapsed = now - self._period_start
+        if elapsed > 0:
+            self._rate = self._alpha * (self._consumed / elapsed) + (1 - self._alpha) * self._rate
+        self._consumed = 0
+        self._period_start = now
+        self._lease_size = min(max(math.ceil(self._rate * self._lease_s), self._min_lease), self._max_lease)
+        self._scheduled = False
+
+        unused, self._leased = self._leased, 0
+        used, self._used = self._used, 0
+        return unused, used
+
+    def _return_to_backend(self, unused: int, used: int):
+        if unused:
+            self._limiter.cancel(unused)
+        if used:
+            self._limiter.release(used)
+
+
+class SyncLeasedRateLimiter(_Lease):
+    def __init__(self, limiter, logger: logging.Logger, max_lease: int, lease_s: float=1.0, min_lease: int=1,
+                 alpha: float=0.3, scheduler: ReleaseScheduler=None, clock: Callable[[], float]=time.monotonic):
+        """
+        Serves units from leases on `limiter`, with the `SyncRateLimiter` API.
+
+        :param limiter: backend limiter, it must support `acquire`, `release` and `cancel`
+        :param logger: logger to use
+        :param max_lease: max units leased at once
+        :param lease_s: seconds after which unused units are returned to `limiter`
+        :param min_lease: min units leased at once
+        :param alpha: weight of the latest lease in the consumption EWMA
+        :param scheduler: scheduler which expires the leases, defaults to the one shared by all limiters in the process
+        :param clock: monotonic clock used to measure consumption
+        """
+        super().__init__(limiter, logger, max_lease, lease_s, min_lease, alpha, clock)
+        self._scheduler = scheduler or _DEFAULT_SCHEDULER
+        self._lock = threading.Lock()
+        self._lease_lock = threading.Lock()  # only one thread at a time leases from the backend
+
+    def __call__(self, num: int=1) -> _SyncLimiterContext:
+        """
+        Returns a context manager which will acquire `num` units on enter and release them on exit
+
+        :param num: number of units
+        """
+        return _SyncLimiterContext(self, num)
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        # NOTE: Even if there's a pending exception we have to assume the __enter__ call counted
+        self.release()
+
+    def acquire(self, num: int=1, timeout=None):
+        """
+        Acquires `num` units, from the current lease if possible
+
+        :param num: number of units to acquire
+        :param timeout: max seconds to wait, raises `TimeoutError` if exceeded
+        """
+        with self._lock:
+            if self._take(num):
+                return
+
+        end_time = None if timeout is None else time.monotonic() + timeout
+        if not self._lease_lock.acquire(timeout=-1 if timeout is None else timeout):
+            raise TimeoutError("Timed out acquiring rate limiter")
+
+        try:
+            with self._lock:
+                # another thread may have leased while we were waiting
+                if self._take(num):
+                    return
+                lease = self._next_lease(num)
+
+            self._limiter.acquire(lease, None if end_time is None else max(end_time - time.monotonic(), 0))
+
+            with self._lock:
+                self._add_lease(lease, num)
+                self._schedule()
+        finally:
+            self._lease_lock.release()
+
+    def release(self, num: int=1):
+        """
+        Registers a hit of `num` units, it's released to the backend with the next batch
+
+        :param num: number of units to release, must match what was acquired
+        """
+        with self._lock:
+            used = self._add_used(num)
+            self._schedule()
+
+        if used:
+            self._limiter.release(used)
+
+    def cancel(self, num: int=1):
+        """
+        Returns `num` acquired units which were never used to the current lease
+
+        :param num: number of units to return, must not exceed what was acquired
+        """
+        with self._lock:
+            self._leased += num
+            self._consumed -= num
+
+    def flush(self):
+        """ Returns the unused units and releases the pending hits to the backend now, ex: before exiting """
+        with self._lock:
+            unused, used = self._expire()
+
+        self._return_to_backend(unused, used)
+
+    def _schedule(self):
+        # must be called with `_lock` held
+        if not self._scheduled:
+            self._scheduler.schedule(self, self._lease_s)
+            self._scheduled = True
+
+    def _release_expired(self) -> None:
+        """ Called by the scheduler when the lease expires """
+        try:
+            self.flush()
+        except BaseException:
+            self._logger.exception("Failed while returning leased units")
+
+        return None
+
+
+class ASyncLeasedRateLimiter(_Lease):
+    def __init__(self, limiter, logger: logging.Logger, max_lease: int, lease_s: float=1.0, min_lease: int=1,
+                 alpha: float=0.3, clock: Callable[[], float]=None):
+        """
+        Serves units from leases on `limiter`, with the `ASyncRateLimiter` API.
+
+        :param limiter: async backend limiter, it must support `acquire`, `release` and `cancel`
+        :param logger: logger to use
+        :param max_lease: max units leased at once
+        :param lease_s: seconds after which unused units are returned to `limiter`
+        :param min_lease: min units leased at once
+        :param alpha: weight of the latest lease in the consumption EWMA
+        :param clock: monotonic clock used to measure consumption, defaults to `loop.time`
+        """
+        self._loop = asyncio.get_event_loop()
+        super().__init__(limiter, logger, max_lease, lease_s, min_lease, alpha, clock or self._loop.time)
+        self._lease_lock = asyncio.Lock()  # only one task at a time leases from the backend
+        self._timer: asyncio.TimerHandle = None
+
+    def __call__(self, num: int=1) -> _ASyncLimiterContext:
+        """
+        Returns an async context manager which will acquire `num` units on enter and release them on exit
+
+        :param num: number of units
+        """
+        return _ASyncLimiterContext(self, num)
+
+    async def __aenter__(self):
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        # NOTE: Even if there's a pending exception we have to assume the __aenter__ call counted
+        self.release()
+
+    async def acquire(self, num: int=1):
+        """
+        Acquires `num` units, from the current lease if possible
+
+        :param num: number of units to acquire
+        """
+        if self._take(num):
+            return
+
+        async with self._lease_lock:
+            # another task may have leased while we were waiting
+            if self._take(num):
+                return
+
+            lease = self._next_lease(num)
+            await self._limiter.acquire(lease)
+            self._add_lease(lease, num)
+            self._schedule()
+
+    def release(self, num: int=1):
+        """
+        Registers a hit of `num` units, it's released to the backend with the next batch
+
+        :param num: number of units to release, must match what was acquired
+        """
+        used = self._add_used(num)
+        self._schedule()
+
+        if used:
+            self._limiter.release(used)
+
+    def cancel(self, num: int=1):
+        """
+        Returns `num` acquired units which were never used to the current lease
+
+        :param num: number of units to return, must not exceed what was acquired
+        """
+        self._leased += num
+        self._consumed -= num
+
+    def flush(self):
+        """ Returns the unused units and releases the pending hits to the backend now, ex: before exiting """
+        if self._timer:
+            self._timer.cancel()
+            self._timer = None
+
+        self._return_to_backend(*self._expire())
+
+    def _schedule(self):
+        if not self._scheduled:
+            self._timer = self._loop.call_later(self._lease_s, self._on_timer)
+            self._scheduled = True
+
+    def _on_timer(self):
+        self._timer = None
+        try:
+            self.flush()
+        except BaseException:
+            self._logger.exception("Failed while returning leased units")
@@ -0,0 +1,134 @@
+from collections import OrderedDict
+import time
+from typing import Any, Callable, Dict, Hashable, List
+
+
+class _Entry:
+    __slots__ = ('value', 'limiters', 'last_used', 'used', 'evicted')
+
+    def __init__(self, value: Any, limiters: List, now: float):
+        self.value = value
+        self.limiters = limiters
+        self.last_used = now
+        self.used = False  # set on each hit, cleared when the entry gets a second chance
+        self.evicted = False  # set while `_evict` decides whether to drop the entry
+
+
+class LimiterCache:
+    # max number of least recently used entries inspected per eviction pass, so a run of busy entries can't make
+    # insertions O(size)
+    _EVICT_SCAN = 8
+
+    def __init__(self, max_size: int=None, ttl_s: float=None, clock: Callable[[], float]=time.monotonic):
+        """
+        LRU/TTL cache of values which own a set of limiters, ex: the per user limiter contexts.
+
+        An entry is only evicted once all of its limiters are idle (see `is_idle`), ie: their windows are empty and
+        nobody holds or waits on them, so no quota history is lost.  Busy entries are kept even if that means going
+        over `max_size`, they're retried on later evictions.
+
+        `get` takes no lock so hits don't contend, instead of re-ordering entries it marks them as used and eviction
+        gives used entries a second chance (ie: the CLOCK approximation of LRU).  `add` must be serialized by the owner.
+
+        :param max_size: max number of entries to keep, or None for unbounded
+        :param ttl_s: if set, idle entries which haven't been used for this many seconds are evicted by later insertions
+        :param clock: monotonic clock used for the TTL
+        """
+        assert max_size is None or max_size > 0
+        assert ttl_s is None or ttl_s > 0
+
+        self.max_size = max_size
+        self.ttl_s = ttl_s
+        self._clock = clock
+        self._entries = OrderedDict()  # dict of: {key: _Entry} in insertion / second chance order
+
+        # NOTE: `_hits` is updated without a lock so it may undercount with concurrent threads
+        self._hits = 0
+        self._misses = 0
+        self._evictions = 0
+        self._busy_skips = 0  # eviction candidates which were kept because a limiter was in use
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        return {
+            "size": len(self._entries),
+            "hits": self._hits,
+            "misses": self._misses,
+            "evictions": self._evictions,
+            "busy_skips": self._busy_skips,
+        }
+
+    def get(self, key: Hashable) -> Any:
+        """
+        Lock-free lookup
+
+        :return: the value for `key`, or None if it's not cached
+        """
+        while True:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+
+            # `_evict` flags the entry before checking `used`, and we set `used` before checking the flag, so either
+            # it sees our hit and keeps the entry or we see the flag and look again once it's dropped or kept
+            entry.last_used = self._clock()
+            entry.used = True
+            if not entry.evicted:
+                break
+
+        self._hits += 1
+        return entry.value
+
+    def add(self, key: Hashable, value: Any, limiters: List) -> Any:
+        """
+        Adds `value` unless `key` is already cached, and evicts idle entries which are over `max_size` or expired
+
+        NOTE: calls must be serialized by the owner
+
+        :param key: cache key
+        :param value: value to cache
+        :param limiters: limiters owned by `value`, it's only evicted once all of them are idle
+        :return: the cached value for `key`, which is the existing one if there was one
+        """
+        entry = self._entries.get(key)
+        if entry is not None:
+            return entry.value
+
+        self._misses += 1
+        now = self._clock()
+        self._entries[key] = _Entry(value, limiters, now)
+        self._evict(now)
+        return value
+
+    def _evict(self, now: float):
+        entries = self._entries
+        for _ in range(min(self._EVICT_SCAN, len(entries) - 1)):
+            key, entry = next(iter(entries.items()))
+            over_size = self.max_size is not None and len(entries) > self.max_size
+            expired = self.ttl_s is not None and now - entry.last_used >= self.ttl_s
+            if not over_size and not expired:
+                break
+
+            if entry.used:
+                entry.used = False
+                entries.move_to_end(key)
+                continue
+
+            if all(limiter.is_idle for limiter in entry.limiters):
+                entry.evicted = True
+                # a hit which raced with us has set `used` by now, see `get`
+                if not entry.used:
+                    del entries[key]
+                    self._evictions += 1
+                    continue
+
+                entry.evicted = False
+            else:
+                self._busy_skips += 1
+
+            # look at it again once the rest of the cache has been cycled through
+            entry.used = False
+            entries.move_to_end(key)
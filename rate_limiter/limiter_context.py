@@ -1,11 +1,12 @@
-from contextlib import contextmanager, ExitStack
+from contextlib import contextmanager
 from enum import Enum
 import logging
 from functools import partial
 import threading
 from typing import Union, Callable, ContextManager, Dict, List, Tuple
 
-from sync_rate_limiter import RateLimiter
+from .limiter_cache import LimiterCache
+from .sync_rate_limiter import RateLimiter, reserve_all, release_all
 
 
 class StrEnum(str, Enum):
@@ -14,6 +15,7 @@ class StrEnum(str, Enum):
 
 SECONDS_IN_MINUTE = 60
 SECONDS_IN_HOUR = SECONDS_IN_MINUTE * 60
+SECONDS_IN_DAY = SECONDS_IN_HOUR * 24
 
 # This represents a contextmanager that takes a rate limit unit parameter and waits against one or many RateLimiters
 # It's a partial that is the second type
@@ -31,17 +33,18 @@ class LimiterServices(StrEnum):
 # The following two structures document the known limits for Google APIs.  There are two types of limiters, a per request
 # limiter, and a quota per request.  Some requests have a quota cost.  Further there are global limiters, and per user limiters.
 # The format of the two structures is: {limiter_type: {LimiterServices: {period_in_seconds: rate_in_period}}}
-# NOTE: we're often reducing the periods of the actual limits to avoid blowing memory with the rate limiter's queue
+# NOTE: limiters with more than `_WINDOW_BUCKETS` units use a bucketed window so the real (daily) limits can be used without
+#       blowing memory with the rate limiter's queue
 # NOTE: batch requests will count as multiple requests in terms of limits if there are multiple items in the batch
 GLOBAL_LIMITERS = {
     "request": {
         # https://developers.google.com/calendar/pricing
         LimiterServices.Calendar: {
-            SECONDS_IN_HOUR: 41_666,  # 1,000,000 / day ~= 41,666 / hr
+            SECONDS_IN_DAY: 1_000_000,
         },
 
         LimiterServices.AdminSDK: {
-            SECONDS_IN_HOUR: 6250,  # 150,000 / day = 6260 / hr
+            SECONDS_IN_DAY: 150_000,
         },
 
         LimiterServices.Gmail: {
@@ -52,7 +55,7 @@ GLOBAL_LIMITERS = {
         # Neither Calendar (https://developers.google.com/calendar/pricing) nor Admin SDK (https://developers.google.com/admin-sdk/directory/v1/limits) seem to have "quota" units
         LimiterServices.Gmail: {
             # https://developers.google.com/gmail/api/v1/reference/quota
-            SECONDS_IN_MINUTE: 694_4444  # 1,000,000,000 / day ~= 694,4444 / min
+            SECONDS_IN_DAY: 1_000_000_000
         }
     }
 }
@@ -85,22 +88,21 @@ PER_USER_LIMITERS = {
     }
 }
 
-# These locks are to ensure that a group of limiters for a given service acquire a set of locks atomically
-# so that groups don't contend with each other and cause deadlocks.  They need to be RLocks to ensure that
-# you can acquire "request" and "quota" limiters on a given thread for a given service.  If we enforced rate limiters
-# go be acquired in particular orders this would not be needed.
-_LIMITERS_LOCKS = {
-    LimiterServices.Calendar: threading.RLock(),
-    LimiterServices.AdminSDK: threading.RLock(),
-    LimiterServices.Gmail: threading.RLock(),
-    LimiterServices.People: threading.RLock(),
-}
+GET_LIMITERS_RET_TYPE = Dict[str, Dict[str, API_LIMITER_CONTEXT_TYPE]]
 
+# Number of buckets per period for limiters allowing more than this many units per period
+_WINDOW_BUCKETS = 1000
 
-GET_LIMITERS_RET_TYPE = Dict[str, Dict[str, API_LIMITER_CONTEXT_TYPE]]
+_GET_LIMITERS_CALLED = False
 
 
-def get_limiters(logger: logging.Logger) -> GET_LIMITERS_RET_TYPE:
+def _create_limiter(units: int, period: int, logger: logging.Logger, limiter_cls: type=RateLimiter, stats: bool=False):
+    # Large limits use a fixed-memory bucketed window, small ones keep one exact record per hit
+    buckets = _WINDOW_BUCKETS if units > _WINDOW_BUCKETS else None
+    return limiter_cls(units, period, logger, buckets=buckets, stats=stats)
+
+
+def get_limiters(logger: logging.Logger, stats: bool=False) -> GET_LIMITERS_RET_TYPE:
     """
     Returns a dictionary of service name to a callable to acquire `num` API requests from a
     set of limiters associated with said service.
@@ -108,6 +110,7 @@ def get_limiters(logger: logging.Logger) -> GET_LIMITERS_RET_TYPE:
     NOTE: You should only call this method once as the set of limiters should last length of life of the application.
 
     :param logger: logger to use
+    :param stats: whether the limiters collect stats, see `get_limiters_stats`
     :return: dict of: {service_name: limiter_context_callable}
     """
     global _GET_LIMITERS_CALLED
@@ -115,7 +118,7 @@ def get_limiters(logger: logging.Logger) -> GET_LIMITERS_RET_TYPE:
 
     ret_value = {
         limiter_type: {
-            svc: partial(limiters_context, limiters=[RateLimiter(units, period, logger) for period, units in period_units_dict.items()], service=svc)
+            svc: partial(limiters_context, limiters=[_create_limiter(units, period, logger, stats=stats) for period, units in period_units_dict.items()], service=svc)
             for svc, period_units_dict in limiters.items()
         }
         for limiter_type, limiters in GLOBAL_LIMITERS.items()
@@ -125,41 +128,60 @@ def get_limiters(logger: logging.Logger) -> GET_LIMITERS_RET_TYPE:
     return ret_value
 
 
+def get_limiters_stats(limiters: GET_LIMITERS_RET_TYPE) -> Dict[str, Dict[str, Dict[float, dict]]]:
+    """
+    Returns the stats of the limiters of every service, this works with `async_limiter_context` limiters as well
+
+    :param limiters: limiters for all services (value from `get_limiters` called with `stats=True`)
+    :return: dict of: {limiter_type: {service_name: {period_s: limiter stats}}} where the limiter stats are those of
+             `RateLimiter.stats` plus 'utilization', the fraction of `max_rate` in use or in the window
+    """
+    ret_value = dict()
+    for limiter_type, services in limiters.items():
+        for svc, context in services.items():
+            for limiter in context.keywords["limiters"]:
+                stats = limiter.stats
+                if stats is None:
+                    continue
+
+                stats["utilization"] = (stats["in_window"] + stats["in_use"]) / stats["max_rate"]
+                ret_value.setdefault(limiter_type, dict()).setdefault(svc, dict())[limiter._period_s] = stats
+
+    return ret_value
+
+
 # limiters + service params have defaults because we want `num` to be positional and have a default
 @contextmanager
-def limiters_context(num: int=1, limiters: List[RateLimiter]=None, service: LimiterServices=None) -> ContextManager:
+def limiters_context(num: int=1, limiters: List[RateLimiter]=None, service: LimiterServices=None, max_wait: float=None,
+                     priority: int=0) -> ContextManager:
     """
-    Context class which will acquire `num` semaphores from all `limiters`
+    Context class which will acquire `num` units from all `limiters`
 
     :param num: number of API queries which will be called
     :param limiters: list of limiters to acquire from
     :param service: service of limiters
+    :param max_wait: raise `RateLimiter.Rejected` instead of waiting if the units can't be admitted within this many seconds
+    :param priority: callers waiting with a higher priority are served first, ex: interactive requests over background jobs
     """
-    with ExitStack() as exit_stack:
-        # We only want one thread to acquire a group of locks at a time to avoid deadlocks.
-        # We want to release the lock on the service before we yield to allow others to begin acquiring from the limiters
-        with _LIMITERS_LOCKS[service]:
-            # now we can acquire the semaphores
-            for limiter in limiters:
-                assert num <= limiter.max_rate
-                for _ in range(num):
-                    # NOTE: If we block on a semaphore here, we will be holding the lock as well, but it's ok because if someone comes
-                    #       and blocks on the lock they would have blocked on the semaphore if the lock were not present.
-                    exit_stack.enter_context(limiter)
-
+    # all-or-nothing so we never hold units of one limiter (ex: global) while blocked on another (ex: per user), and
+    # callers which don't share a blocked limiter proceed in parallel
+    reserve_all(limiters, num, max_wait=max_wait, priority=priority)
+    try:
         yield
+    finally:
+        release_all(limiters, num)
 
 
 def get_limiters_context_with_added_limiters(method: API_LIMITER_CONTEXT_TYPE, limiters: List[RateLimiter]) -> API_LIMITER_CONTEXT_TYPE:
     """
     Will create a new rate limiter context from the exist context `method` with a new list of limiters which contains the existing limiters
-    from `method` and the new list of `limiters`.
+    from `method` and the new list of `limiters`.  This works with the contexts of `async_limiter_context` and `client` as well.
 
     :param method: limiters partial context to obtain existing limiters from
     :param limiters: list of limiters to add
     :return: new partial
     """
-    assert method.func == limiters_context
+    assert isinstance(method, partial)
     assert not method.args
     assert method.keywords.keys() == {'limiters', 'service'}
 
@@ -170,12 +192,54 @@ def get_limiters_context_with_added_limiters(method: API_LIMITER_CONTEXT_TYPE, l
 
 _PER_USER_LIMITER_CONTEXT_RETURN_TYPE = Dict[str, API_LIMITER_CONTEXT_TYPE]
 
-# cache of get_per_user_limiter_context return values
-_PER_USER_LIMITER_CACHE: Dict[Tuple[str, str], _PER_USER_LIMITER_CONTEXT_RETURN_TYPE] = dict()  # dict of: {(service_name, user_name): return of get_per_user_limiter_context}
+# Default max number of users kept in the per user limiter caches, see `configure_per_user_limiter_cache`
+PER_USER_LIMITER_CACHE_SIZE = 10_000
 
-# This lock protects `_PER_USER_LIMITER_CACHE`
+# cache of get_per_user_limiter_context return values, keyed by: (service_name, user_name)
+_PER_USER_LIMITER_CACHE = LimiterCache(PER_USER_LIMITER_CACHE_SIZE)
+
+# This lock serializes `_PER_USER_LIMITER_CACHE.add` and its configuration, lookups don't take it
 _PER_USER_LIMITER_LOCK = threading.Lock()
 
+# Per user limiters are built while holding the lock of the key's stripe, so each key is only built once while users
+# of other stripes are built in parallel
+_PER_USER_LIMITER_BUILD_LOCKS = [threading.Lock() for _ in range(64)]
+
+
+def _create_per_user_contexts(logger: logging.Logger, limiters: GET_LIMITERS_RET_TYPE, service_name: LimiterServices, limiter_cls: type,
+                              context_func: Callable, add_limiters_func: Callable) -> Tuple[_PER_USER_LIMITER_CONTEXT_RETURN_TYPE, List]:
+    """
+    Creates the per user limiters for `service_name` and appends them to the global limiters for said service.  This is shared with
+    `async_limiter_context` which passes its own limiter class and context functions.
+
+    :param logger: logger to use
+    :param limiters: limiters for all services (value from `get_limiters`)
+    :param service_name: service name from which to get limiters
+    :param limiter_cls: class of limiter to create
+    :param context_func: limiters context function, ex: `limiters_context`
+    :param add_limiters_func: function to add limiters to a context, ex: `get_limiters_context_with_added_limiters`
+    :return: tuple of: ({'request': per_user_request_limiter_context, 'quota': per_user_quota_limiter_context}, per user limiters)
+    """
+    return_value = dict()
+    user_limiters = []
+    for limiter_type in ("request", "quota"):
+        context = limiters[limiter_type].get(service_name)
+        named_user_limiters = PER_USER_LIMITERS[limiter_type].get(service_name)
+        if named_user_limiters:
+            named_user_limiters = [_create_limiter(units, period, logger, limiter_cls) for period, units in named_user_limiters.items()]
+            user_limiters += named_user_limiters
+
+        if context and named_user_limiters:
+            context = add_limiters_func(context, named_user_limiters)
+        elif named_user_limiters:
+            context = partial(context_func, limiters=named_user_limiters, service=service_name)
+        else:
+            context = None
+
+        return_value[limiter_type] = context
+
+    return return_value, user_limiters
+
 
 def get_per_user_limiter_context(logger: logging.Logger, limiters: GET_LIMITERS_RET_TYPE, service_name: LimiterServices, user_name: str) -> _PER_USER_LIMITER_CONTEXT_RETURN_TYPE:
     """
@@ -191,42 +255,41 @@ def get_per_user_limiter_context(logger: logging.Logger, limiters: GET_LIMITERS_
     """
     cache_key = (service_name, user_name)
 
-    with _PER_USER_LIMITER_LOCK:
+    return_value = _PER_USER_LIMITER_CACHE.get(cache_key)
+    if return_value:
+        return return_value
+
+    with _PER_USER_LIMITER_BUILD_LOCKS[hash(cache_key) % len(_PER_USER_LIMITER_BUILD_LOCKS)]:
+        # another thread may have built it while we were waiting
         return_value = _PER_USER_LIMITER_CACHE.get(cache_key)
         if return_value:
             return return_value
 
-        # request limiters
-        request_context = limiters["request"].get(service_name)
-        named_user_req_limiters = PER_USER_LIMITERS["request"].get(service_name)
-        if named_user_req_limiters:
-            named_user_req_limiters = [RateLimiter(units, period, logger) for period, units in named_user_req_limiters.items()]
+        return_value, user_limiters = _create_per_user_contexts(logger, limiters, service_name, RateLimiter, limiters_context, get_limiters_context_with_added_limiters)
 
-        if request_context and named_user_req_limiters:
-            request_context = get_limiters_context_with_added_limiters(request_context, named_user_req_limiters)
-        elif named_user_req_limiters:
-            request_context = partial(limiters_context, limiters=named_user_req_limiters, service=service_name)
-        else:
-            request_context = None
-
-        # quota limiters
-        quota_context = limiters["quota"].get(service_name)
-        named_user_quota_limiters = PER_USER_LIMITERS["quota"].get(service_name)
-        if named_user_quota_limiters:
-            named_user_quota_limiters = [RateLimiter(units, period, logger) for period, units in named_user_quota_limiters.items()]
-
-        if quota_context and named_user_quota_limiters:
-            quota_context = get_limiters_context_with_added_limiters(quota_context, named_user_quota_limiters)
-        elif named_user_quota_limiters:
-            quota_context = partial(limiters_context, limiters=named_user_quota_limiters, service=service_name)
-        else:
-            quota_context = None
+        with _PER_USER_LIMITER_LOCK:
+            return _PER_USER_LIMITER_CACHE.add(cache_key, return_value, user_limiters)
 
-        return_value = {
-            'request': request_context,
-            'quota': quota_context
-        }
 
-        _PER_USER_LIMITER_CACHE[cache_key] = return_value
+def configure_per_user_limiter_cache(max_size: int=PER_USER_LIMITER_CACHE_SIZE, ttl_s: float=None):
+    """
+    Sets the bounds of the `get_per_user_limiter_context` cache.  Users are only evicted once their limiters are idle, so
+    a user which comes back after being evicted starts with its full quota without having exceeded any limit.
 
-        return return_value
+    NOTE: contexts returned before their user was evicted keep working but are no longer shared with new lookups, so
+          callers should call `get_per_user_limiter_context` for each use rather than hold on to the contexts.
+
+    :param max_size: max number of (service_name, user_name) entries, or None for unbounded
+    :param ttl_s: if set, users which haven't been looked up for this many seconds are evicted once idle
+    """
+    with _PER_USER_LIMITER_LOCK:
+        _PER_USER_LIMITER_CACHE.max_size = max_size
+        _PER_USER_LIMITER_CACHE.ttl_s = ttl_s
+
+
+def get_per_user_limiter_cache_stats() -> Dict[str, int]:
+    """
+    :return: dict of: {'size', 'hits', 'misses', 'evictions', 'busy_skips'} for the `get_per_user_limiter_context` cache
+    """
+    with _PER_USER_LIMITER_LOCK:
+        return _PER_USER_LIMITER_CACHE.stats
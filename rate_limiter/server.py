@@ -0,0 +1,237 @@
+import argparse
+import asyncio
+import errno
+import logging
+import os
+import struct
+from typing import List
+
+from . import async_limiter_context
+from .async_rate_limiter import RateLimiter, reserve_all, release_all
+from .limiter_context import GET_LIMITERS_RET_TYPE, LimiterServices
+
+
+# Daemon which owns the `limiter_context` tables so every process on the host shares them, see `rate_limiter.client`.
+#
+# Protocol: clients send requests of `_REQUEST` followed by `key_len` bytes of utf-8 key, and requests may be pipelined.
+# The server answers every ACQUIRE, RELEASE and RETURN with a `_RESPONSE` carrying the same `req_id`, in the order they complete,
+# with responses completed in the same loop iteration coalesced into a single write.  CANCEL has no response of its own,
+# the pending ACQUIRE with `req_id` is answered with STATUS_CANCELLED instead.
+#
+# Keys are "<limiter_type>/<service>" for the global limiters or "<limiter_type>/<service>/<user_name>" for the per user
+# ones, ex: "quota/gmail/user@domain.com".  Units still held when a client disconnects are released (ie: counted as hits).
+_REQUEST = struct.Struct('!IBHI')  # req_id, op, key_len, num
+_RESPONSE = struct.Struct('!IB')  # req_id, status
+
+OP_ACQUIRE = 1
+OP_RELEASE = 2
+OP_CANCEL = 3
+OP_RETURN = 4  # give back units which were never used, without registering a hit
+
+STATUS_OK = 0
+STATUS_UNLIMITED = 1  # the key has no limits, the client doesn't need to ask again
+STATUS_CANCELLED = 2
+STATUS_ERROR = 3
+
+DEFAULT_PATH = "/tmp/rate_limiter.sock"
+
+
+def limiter_key(limiter_type: str, service_name: LimiterServices, user_name: str=None) -> str:
+    """
+    :return: protocol key of the limiters of `service_name`, including the per user limiters of `user_name` if set
+    """
+    parts = [limiter_type, LimiterServices(service_name).value]
+    if user_name is not None:
+        parts.append(user_name)
+    return "/".join(parts)
+
+
+class _Connection:
+    def __init__(self, server: 'Server', reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        self._server = server
+        self._reader = reader
+        self._writer = writer
+        self._loop = asyncio.get_event_loop()
+        self._acquiring = dict()  # dict of: {req_id: task} for acquires which haven't been granted yet
+        self._held = dict()  # dict of: {key: [limiters, units]} of units granted and not yet released
+        self._out = bytearray()
+
+    async def run(self):
+        try:
+            while True:
+                req_id, op, key_len, num = _REQUEST.unpack(await self._reader.readexactly(_REQUEST.size))
+                key = (await self._reader.readexactly(key_len)).decode()
+                self._handle(req_id, op, key, num)
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass  # client went away
+        finally:
+            self._close()
+
+    def _handle(self, req_id: int, op: int, key: str, num: int):
+        if op == OP_CANCEL:
+            task = self._acquiring.get(req_id)
+            if task:
+                task.cancel()
+            return
+
+        if op in (OP_RELEASE, OP_RETURN):
+            self._release(req_id, op, key, num)
+            return
+
+        try:
+            limiters = self._server.resolve(key)
+        except (ValueError, KeyError, IndexError):
+            self._server.logger.warning("Invalid rate limiter key: {}".format(key))
+            self._respond(req_id, STATUS_ERROR)
+            return
+
+        if limiters is None:
+            self._respond(req_id, STATUS_UNLIMITED)
+        elif op == OP_ACQUIRE:
+            if not 0 < num <= min(limiter.max_rate for limiter in limiters):
+                self._respond(req_id, STATUS_ERROR)
+                return
+
+            task = asyncio.ensure_future(reserve_all(limiters, num))
+            self._acquiring[req_id] = task
+            task.add_done_callback(lambda task: self._on_acquired(req_id, key, limiters, num, task))
+        else:
+            self._respond(req_id, STATUS_ERROR)
+
+    def _release(self, req_id: int, op: int, key: str, num: int):
+        # Units go back to the limiters they were granted from rather than to what `key` resolves to now, so they can't
+        # be credited to other instances, ex: if the user was dropped from the per user cache and created again.
+        held = self._held.get(key)
+        if not held or held[1] < num:
+            self._respond(req_id, STATUS_ERROR)
+            return
+
+        limiters = held[0]
+        held[1] -= num
+        if not held[1]:
+            del self._held[key]
+
+        if op == OP_RELEASE:
+            release_all(limiters, num)
+        else:
+            for limiter in set(limiters):
+                limiter.cancel(num)
+        self._respond(req_id, STATUS_OK)
+
+    def _on_acquired(self, req_id: int, key: str, limiters: List[RateLimiter], num: int, task: asyncio.Future):
+        self._acquiring.pop(req_id, None)
+        if self._writer is None:
+            # the grant completed after we were closed, there's nobody left to release it
+            if not task.cancelled() and not task.exception():
+                release_all(limiters, num)
+        elif task.cancelled():
+            self._respond(req_id, STATUS_CANCELLED)
+        elif task.exception():
+            self._server.logger.error("Error acquiring {}".format(key), exc_info=task.exception())
+            self._respond(req_id, STATUS_ERROR)
+        else:
+            self._held.setdefault(key, [limiters, 0])[1] += num
+            self._respond(req_id, STATUS_OK)
+
+    def _respond(self, req_id: int, status: int):
+        if self._writer is None:
+            return
+
+        if not self._out:
+            self._loop.call_soon(self._flush)
+        self._out += _RESPONSE.pack(req_id, status)
+
+    def _flush(self):
+        if self._writer is not None and self._out:
+            self._writer.write(bytes(self._out))
+        self._out.clear()
+
+    def _close(self):
+        for task in self._acquiring.values():
+            task.cancel()
+        self._acquiring.clear()
+
+        # we don't know whether the client used them, so they're counted as hits
+        for limiters, units in self._held.values():
+            release_all(limiters, units)
+        self._held.clear()
+
+        self._writer.close()
+        self._writer = None
+
+
+class Server:
+    def __init__(self, logger: logging.Logger, limiters: GET_LIMITERS_RET_TYPE=None):
+        """
+        Serves the limiters of `async_limiter_context` to clients over a Unix socket
+
+        :param logger: logger to use
+        :param limiters: limiters for all services, defaults to `async_limiter_context.get_limiters`
+        """
+        self.logger = logger
+        self._limiters = limiters or async_limiter_context.get_limiters(logger)
+        self._server: asyncio.AbstractServer = None
+
+    def resolve(self, key: str) -> List[RateLimiter] or None:
+        """
+        :return: limiters of `key`, or None if it has no limits
+        """
+        parts = key.split("/", 2)
+        limiter_type, service_name = parts[0], LimiterServices(parts[1])
+        if len(parts) == 3:
+            context = async_limiter_context.get_per_user_limiter_context(self.logger, self._limiters, service_name, parts[2])[limiter_type]
+        else:
+            context = self._limiters[limiter_type].get(service_name)
+
+        return context.keywords["limiters"] if context else None
+
+    async def start(self, path: str=DEFAULT_PATH):
+        """
+        Starts listening on `path`, replacing the socket file of a server which is gone
+
+        :param path: path of the Unix socket
+        :raises OSError: with `errno.EADDRINUSE` if another server is listening on `path`
+        """
+        if os.path.exists(path):
+            try:
+                _, writer = await asyncio.open_unix_connection(path)
+            except FileNotFoundError:
+                pass  # removed since we checked
+            except ConnectionRefusedError:
+                os.unlink(path)  # stale, nobody is listening
+            else:
+                writer.close()
+                raise OSError(errno.EADDRINUSE, "Another rate limiter server is listening on {}".format(path))
+
+        self._server = await asyncio.start_unix_server(self._on_client, path)
+
+    async def _on_client(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        await _Connection(self, reader, writer).run()
+
+    async def close(self):
+        self._server.close()
+        await self._server.wait_closed()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serves the rate limiters of rate_limiter.limiter_context over a Unix socket")
+    parser.add_argument("--path", default=DEFAULT_PATH, help="path of the Unix socket (default: %(default)s)")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    logger = logging.getLogger("rate_limiter.server")
+
+    loop = asyncio.get_event_loop()
+    server = Server(logger)
+    loop.run_until_complete(server.start(args.path))
+    logger.info("Listening on {}".format(args.path))
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        loop.run_until_complete(server.close())
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,391 @@
+from collections import deque
+import fcntl
+import logging
+import math
+import mmap
+import os
+import struct
+import tempfile
+import threading
+import time
+from typing import Callable
+import uuid
+
+
+class _LimiterContext:
+    __slots__ = ('_limiter', '_num')
+
+    def __init__(self, limiter, num: int):
+        self._limiter = limiter
+        self._num = num
+
+    def __enter__(self):
+        self._limiter.acquire(self._num)
+        return self._limiter
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        # NOTE: Even if there's a pending exception we have to assume the __enter__ call counted
+        self._limiter.release(self._num)
+
+
+# Header: magic, version, boot id, max_rate, period_s, buckets, units in the window, index of the oldest bucket which may
+# hold units
+_HEADER = struct.Struct('<4sI16sqdqqq')
+_MAGIC = b'RLSM'
+_VERSION = 2
+
+# Ring slot: bucket index, units
+_SLOT = struct.Struct('<qq')
+
+# Directory for the shared files, /dev/shm is memory backed so the window never touches disk.  Otherwise prefer the runtime
+# dir which, like /dev/shm, doesn't outlive a reboot.
+_DEFAULT_DIR = '/dev/shm' if os.path.isdir('/dev/shm') else os.environ.get('XDG_RUNTIME_DIR') or tempfile.gettempdir()
+
+
+def _boot_id() -> bytes:
+    """ Identifies the current boot as the monotonic clock restarts with it, all zeros if the OS doesn't provide one """
+    try:
+        with open('/proc/sys/kernel/random/boot_id') as f:
+            return uuid.UUID(f.read().strip()).bytes
+    except (OSError, ValueError):
+        return bytes(16)
+
+
+_BOOT_ID = _boot_id()
+
+
+# This is a moving-window rate limiter whose window lives in a memory mapped file, so every process on the host which
+# opens the same `name` shares a single limit (ex: pre-fork worker pools).  Hits are coalesced into `buckets` buckets per
+# period like `BucketedWindow`, kept in a fixed size ring so the file never grows.
+#
+# Since a process can die at any time nothing is "held" in shared memory: a hit is registered in the window when it's
+# acquired and moved to the current bucket when it's released, so the units of a process which crashed are returned
+# `period_s` after it acquired them.
+# NOTE: for the same reason units held for longer than `period_s` are no longer counted until they're released.
+# NOTE: `clock` must be the same system-wide monotonic clock in every process, `time.monotonic` is on Linux.
+# NOTE: the window is reset when the file is opened after a reboot, as its timestamps are from the previous boot's clock.
+# Without a boot id (non Linux) `directory` must not outlive a reboot.
+class RateLimiter:
+    class Error(Exception):
+        pass
+
+    def __init__(self, max_rate: int, period_s: float or int, logger: logging.Logger, name: str, buckets: int=1000,
+                 directory: str=_DEFAULT_DIR, clock: Callable[[], float]=time.monotonic):
+        """
+        Allows `max_rate` per `period_s` across all processes using limiter `name`.
+
+        :param max_rate: number of hits allowed per `period_s`
+        :param period_s: period in seconds
+        :param logger: logger to use
+        :param name: name of the shared limiter, all processes must use the same `max_rate`, `period_s` and `buckets`
+        :param buckets: number of buckets per period, hits are released up to `period_s / buckets` late
+        :param directory: directory of the shared file
+        :param clock: monotonic clock used to timestamp hits, see `rate_limiter.clock`
+        """
+        assert isinstance(max_rate, int) and max_rate > 0
+        assert period_s > 0
+        assert isinstance(buckets, int) and buckets > 0
+        assert name and os.sep not in name
+
+        self._max_rate = max_rate
+        self._period_s = period_s
+        self._logger = logger
+        self._buckets = buckets
+        self._bucket_s = period_s / buckets
+        self._clock = clock
+
+        # one more slot than buckets as a hit is accounted at the end of its bucket, which may be the next one
+        self._ring_size = buckets + 1
+
+        # flock only excludes other processes as threads share our file descriptor
+        self._lock = threading.Lock()
+        self._acquired_buckets = deque()  # [bucket index, units] of each of our acquires which hasn't been released yet
+
+        self._path = os.path.join(directory, "rate_limiter.{}".format(name))
+        self._pid = os.getpid()
+        self._mm = None
+        self._fd = os.open(self._path, os.O_RDWR | os.O_CREAT, 0o600)
+        try:
+            size = _HEADER.size + self._ring_size * _SLOT.size
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+            try:
+                if os.fstat(self._fd).st_size == 0:
+                    os.ftruncate(self._fd, size)
+                    self._mm = mmap.mmap(self._fd, size)
+                    self._write_header(0, 0)
+                else:
+                    self._mm = mmap.mmap(self._fd, size)
+                    magic, version, boot_id, max_rate, period_s, buckets, _, _ = _HEADER.unpack_from(self._mm, 0)
+                    if (magic, version, max_rate, period_s, buckets) != (_MAGIC, _VERSION, self._max_rate, self._period_s, self._buckets):
+                        raise self.Error("Shared limiter {} exists with different parameters".format(name))
+
+                    if boot_id != _BOOT_ID:
+                        # left over from a previous boot, its timestamps could block us for up to the old uptime
+                        self._mm[_HEADER.size:] = bytes(size - _HEADER.size)
+                        self._write_header(0, 0)
+            finally:
+                fcntl.flock(self._fd, fcntl.LOCK_UN)
+        except BaseException:
+            if self._mm is not None:
+                self._mm.close()
+                self._mm = None
+            os.close(self._fd)
+            raise
+
+    @property
+    def max_rate(self):
+        return self._max_rate
+
+    @property
+    def is_broken(self):
+        # there is no background worker which can fail
+        return False
+
+    @property
+    def is_idle(self):
+        """ True if no process has units in the window """
+        with self._locked():
+            return self._expire(self._bucket_index(self._clock())) == 0
+
+    def __call__(self, num: int=1) -> _LimiterContext:
+        """
+        Returns a context manager which will acquire `num` units on enter and release them on exit
+
+        :param num: number of units
+        """
+        return _LimiterContext(self, num)
+
+    def join(self):
+        """ Nothing runs in the background so there is nothing to wait for, present for API compatibility """
+        pass
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def acquire(self, num: int=1, timeout=None):
+        """
+        Acquires `num` units from the limiter in a single step
+
+        :param num: number of units to acquire
+        :param timeout: max seconds to wait, raises `TimeoutError` if exceeded.  The units are not consumed in that case.
+        """
+        assert isinstance(num, int) and 0 < num <= self._max_rate
+
+        end_time = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self._locked():
+                now = self._clock()
+                now_idx = self._bucket_index(now)
+                units = self._expire(now_idx)
+                excess = units + num - self._max_rate
+                if excess <= 0:
+                    self._acquired_buckets.append([self._add(now, num, units), num])
+                    return
+
+                delay_s = self._admit_time(excess) - now
+
+            # other processes can't notify us, so we sleep until enough units expire and re-check
+            if end_time is not None and time.monotonic() + delay_s > end_time:
+                raise TimeoutError("Timed out acquiring rate limiter")
+
+            time.sleep(max(delay_s, 0))
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        # NOTE: Even if there's a pending exception we have to assume the __enter__ call counted
+        self.release()
+
+    def release(self, num: int=1):
+        """
+        Registers a hit of `num` units, they will be returned to the limiter `period_s` from now
+
+        :param num: number of units to release, must match what was acquired
+        """
+        assert isinstance(num, int) and 0 < num <= self._max_rate
+
+        with self._locked():
+            now = self._clock()
+            units = self._expire(self._bucket_index(now))
+
+            # Move the units out of the bucket they were acquired in
+            units = self._remove_acquired(num, units)
+            self._add(now, num, units)
+
+    def cancel(self, num: int=1):
+        """
+        Returns `num` acquired units which were never used, without registering a hit
+
+        :param num: number of units to return, must not exceed what was acquired
+        """
+        assert isinstance(num, int) and 0 < num <= self._max_rate
+
+        with self._locked():
+            units = self._expire(self._bucket_index(self._clock()))
+            units = self._remove_acquired(num, units)
+            *_, oldest_idx = _HEADER.unpack_from(self._mm, 0)
+            self._write_header(units, oldest_idx)
+
+    def _remove_acquired(self, num: int, units: int) -> int:
+        """
+        Removes `num` units from the buckets of our oldest acquires, must be called with the lock held after `_expire`
+
+        Releases may not match acquires in order, but taking them from our oldest acquire only ever leaves units in a
+        later bucket, so they're returned late rather than early.
+
+        :param units: number of units in the window
+        :return: number of units left in the window
+        """
+        acquired = self._acquired_buckets
+        while num and acquired:
+            acquired_idx, acquired_num = acquired[0]
+            taken = min(num, acquired_num)
+            num -= taken
+            if taken == acquired_num:
+                acquired.popleft()
+            else:
+                acquired[0][1] -= taken
+
+            offset = self._slot_offset(acquired_idx)
+            slot_idx, slot_units = _SLOT.unpack_from(self._mm, offset)
+            if slot_idx == acquired_idx:  # otherwise it already expired
+                removed = min(taken, slot_units)
+                _SLOT.pack_into(self._mm, offset, slot_idx, slot_units - removed)
+                units -= removed
+
+        return units
+
+    def close(self):
+        """ Unmaps the shared window, it persists for other processes """
+        if self._mm is not None:
+            self._mm.close()
+            self._mm = None
+            os.close(self._fd)
+
+    def unlink(self):
+        """ Removes the shared file, processes which have it open keep using the old window """
+        try:
+            os.unlink(self._path)
+        except FileNotFoundError:
+            pass
+
+    def __del__(self):
+        if getattr(self, '_mm', None) is not None:
+            self.close()
+
+    def _locked(self):
+        if self._pid != os.getpid():
+            self._after_fork()
+
+        return _FileLock(self._lock, self._fd)
+
+    def _after_fork(self):
+        # A forked child shares our open file description and with it the flock, so it needs its own to be excluded from
+        # the parent.  Closing the inherited fd doesn't drop the parent's flock as the parent still has the description
+        # open.  The mapping is MAP_SHARED so it survives the fork.
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._acquired_buckets = deque()
+        os.close(self._fd)
+        self._fd = os.open(self._path, os.O_RDWR)
+
+    def _bucket_index(self, ts: float) -> int:
+        return math.floor(ts / self._bucket_s)
+
+    def _slot_offset(self, bucket_idx: int) -> int:
+        return _HEADER.size + (bucket_idx % self._ring_size) * _SLOT.size
+
+    def _write_header(self, units: int, oldest_idx: int):
+        _HEADER.pack_into(self._mm, 0, _MAGIC, _VERSION, _BOOT_ID, self._max_rate, self._period_s, self._buckets, units, oldest_idx)
+
+    def _expire(self, now_idx: int) -> int:
+        """
+        Drops the buckets which have expired, must be called with the lock held
+
+        :return: number of units in the window
+        """
+        *_, units, oldest_idx = _HEADER.unpack_from(self._mm, 0)
+
+        # a hit in bucket `idx` is accounted as finishing at the end of it, so it expires once `now_idx >= idx + buckets`
+        expire_through = now_idx - self._buckets
+        if oldest_idx > expire_through:
+            return units
+
+        if expire_through - oldest_idx >= self._ring_size:
+            # everything expired, ex: the limiter was idle for a while
+            for slot in range(self._ring_size):
+                _SLOT.pack_into(self._mm, _HEADER.size + slot * _SLOT.size, 0, 0)
+            units = 0
+        else:
+            for idx in range(oldest_idx, expire_through + 1):
+                offset = self._slot_offset(idx)
+                slot_idx, slot_units = _SLOT.unpack_from(self._mm, offset)
+                if slot_idx == idx:
+                    units -= slot_units
+                    _SLOT.pack_into(self._mm, offset, 0, 0)
+
+        self._write_header(units, expire_through + 1)
+        return units
+
+    def _add(self, now: float, num: int, units: int) -> int:
+        """
+        Adds `num` units to the bucket of `now`, must be called with the lock held after `_expire`
+
+        :param units: number of units in the window before adding
+        :return: index of the bucket
+        """
+        bucket_idx = math.ceil(now / self._bucket_s)
+        offset = self._slot_offset(bucket_idx)
+        slot_idx, slot_units = _SLOT.unpack_from(self._mm, offset)
+        if slot_idx != bucket_idx:
+            slot_units = 0
+
+        _SLOT.pack_into(self._mm, offset, bucket_idx, slot_units + num)
+
+        *_, oldest_idx = _HEADER.unpack_from(self._mm, 0)
+        self._write_header(units + num, oldest_idx)
+        return bucket_idx
+
+    def _admit_time(self, num: int) -> float:
+        """
+        Time at which at least `num` units will have expired, must be called with the lock held after `_expire`
+        """
+        *_, oldest_idx = _HEADER.unpack_from(self._mm, 0)
+
+        expiring = 0
+        for idx in range(oldest_idx, oldest_idx + self._ring_size):
+            slot_idx, slot_units = _SLOT.unpack_from(self._mm, self._slot_offset(idx))
+            if slot_idx == idx:
+                expiring += slot_units
+                if expiring >= num:
+                    return (idx + self._buckets) * self._bucket_s
+
+        # can't happen as every unit in the window is in the ring, but retry after one bucket rather than spin
+        return self._clock() + self._bucket_s
+
+
+class _FileLock:
+    __slots__ = ('_lock', '_fd')
+
+    def __init__(self, lock: threading.Lock, fd: int):
+        """
+        Holds `lock` to exclude our threads and an flock on `fd` to exclude other processes
+
+        :param lock: lock for the threads of this process
+        :param fd: file descriptor of the shared file
+        """
+        self._lock = lock
+        self._fd = fd
+
+    def __enter__(self):
+        self._lock.acquire()
+        try:
+            fcntl.flock(self._fd, fcntl.LOCK_EX)
+        except BaseException:
+            self._lock.release()
+            raise
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        try:
+            fcntl.flock(self._fd, fcntl.LOCK_UN)
+        finally:
+            self._lock.release()
@@ -0,0 +1,146 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import selectors
+from typing import Iterable, List, Tuple
+
+from . import async_limiter_context
+from .clock import VirtualClock
+from .limiter_context import GLOBAL_LIMITERS, LimiterServices, _create_per_user_contexts
+
+
+# Virtual time for tests and simulations: the limiters are driven by a `VirtualClock` which jumps straight to the next
+# deadline instead of sleeping, so hours of traffic replay in milliseconds with exact timings.
+
+
+class _VirtualSelector(selectors.DefaultSelector):
+    def __init__(self, clock: VirtualClock):
+        super().__init__()
+        self._clock = clock
+
+    def select(self, timeout: float=None):
+        # the loop only asks us to block until its next timer, so we move the clock there instead
+        events = super().select(0)
+        if events or timeout == 0:
+            return events
+
+        if timeout is None:
+            # no timers, only real I/O (ex: `call_soon_threadsafe`) can wake the loop
+            return super().select(None)
+
+        self._clock.advance(timeout)
+        return []
+
+
+class VirtualEventLoop(asyncio.SelectorEventLoop):
+    def __init__(self, clock: VirtualClock=None):
+        """
+        Event loop whose `time` is `clock`, whenever it would block waiting for a timer it advances `clock` instead.
+        `ASyncRateLimiter`s created on it use its time by default.
+
+        NOTE: real I/O and threads still run in real time
+
+        :param clock: virtual clock, defaults to one starting at 0
+        """
+        self.clock = clock or VirtualClock()
+        super().__init__(_VirtualSelector(self.clock))
+
+    def time(self) -> float:
+        return self.clock()
+
+
+class ManualScheduler:
+    def __init__(self, clock: VirtualClock):
+        """
+        Replacement for `ReleaseScheduler` which doesn't run a thread, expired hits are released by `advance`.  Pass it
+        with `clock` to `SyncRateLimiter`, and acquire with `timeout=0` as nothing will release units while blocked.
+
+        :param clock: virtual clock of the limiters
+        """
+        self._clock = clock
+        self._heap = []  # heap of: (deadline, seq, limiter)
+        self._seq = itertools.count()
+
+    def schedule(self, limiter, delay_s: float):
+        heapq.heappush(self._heap, (self._clock() + delay_s, next(self._seq), limiter))
+
+    def advance(self, seconds: float):
+        """
+        Moves the clock forward by `seconds`, calling every deadline on the way at its exact time
+        """
+        end_time = self._clock() + seconds
+        while self._heap and self._heap[0][0] <= end_time:
+            deadline, _, limiter = heapq.heappop(self._heap)
+            self._clock.advance(max(deadline - self._clock(), 0))
+
+            delay_s = limiter._release_expired()
+            if delay_s is not None:
+                self.schedule(limiter, delay_s)
+
+        self._clock.advance(end_time - self._clock())
+
+
+# (arrival time in seconds, limiter_type, service_name, user_name or None for the global limiters only, num, duration in seconds)
+TRAFFIC_TYPE = Tuple[float, str, LimiterServices, str, int, float]
+
+
+def replay(traffic: Iterable[TRAFFIC_TYPE], logger: logging.Logger, global_limiters: dict=GLOBAL_LIMITERS) -> List[float]:
+    """
+    Replays recorded traffic against a fresh set of limiters in virtual time, ex: to capacity plan `GLOBAL_LIMITERS`
+
+    :param traffic: requests sorted by arrival time
+    :param logger: logger to use
+    :param global_limiters: limits in the format of `GLOBAL_LIMITERS`, the per user limits are those of `PER_USER_LIMITERS`
+    :return: seconds each request waited on the limiters, in the order of `traffic`
+    """
+    loop = VirtualEventLoop()
+
+    async def _run():
+        limiters = async_limiter_context._create_limiters(logger, global_limiters)
+        per_user = dict()  # dict of: {(service_name, user_name): per user contexts}, no eviction as the run is bounded
+        waits = []
+        tasks = []
+
+        async def _request(idx: int, context, num: int, duration_s: float):
+            start = loop.time()
+            async with context(num):
+                waits[idx] = loop.time() - start
+                await asyncio.sleep(duration_s)
+
+        for idx, (ts, limiter_type, service_name, user_name, num, duration_s) in enumerate(traffic):
+            if user_name is None:
+                context = limiters[limiter_type].get(service_name)
+            else:
+                key = (service_name, user_name)
+                if key not in per_user:
+                    per_user[key], _ = _create_per_user_contexts(logger, limiters, service_name, async_limiter_context.RateLimiter,
+                                                                 async_limiter_context.limiters_context,
+                                                                 async_limiter_context.get_limiters_context_with_added_limiters)
+                context = per_user[key][limiter_type]
+
+            waits.append(0.0)
+            if context is None:
+                continue  # no limits
+
+            await asyncio.sleep(max(ts - loop.time(), 0))
+            tasks.append(asyncio.ensure_future(_request(idx, context, num, duration_s)))
+
+        await asyncio.gather(*tasks)
+
+        # drain the windows so no release task is left pending, this is instant in virtual time
+        all_limiters = {
+            limiter
+            for contexts in itertools.chain(limiters.values(), per_user.values())
+            for context in contexts.values() if context
+            for limiter in context.keywords["limiters"]
+        }
+        for limiter in all_limiters:
+            await limiter.join()
+
+        return waits
+
+    try:
+        return loop.run_until_complete(_run())
+    finally:
+        loop.close()
@@ -0,0 +1,53 @@
+import math
+from typing import Dict
+
+
+class LimiterStats:
+    __slots__ = ('acquires', 'immediate', 'waited', 'rejected', 'peak_waiters', '_histogram')
+
+    # waits are counted in power of 2 buckets, from under 2**_MIN_EXP seconds (~1us) to over 2**_MAX_EXP seconds (~1h)
+    _MIN_EXP = -20
+    _MAX_EXP = 12
+
+    def __init__(self):
+        """
+        Counters of a limiter.  They're only allocated when stats are enabled, so a limiter without stats pays a single
+        `is None` check per acquire.
+
+        NOTE: this is not thread-safe, the owning limiter is responsible for locking.
+        """
+        self.acquires = 0
+        self.immediate = 0  # acquires which didn't wait
+        self.waited = 0
+        self.rejected = 0  # acquires shed by `max_wait` / `max_waiters`
+        self.peak_waiters = 0
+        self._histogram = [0] * (self._MAX_EXP - self._MIN_EXP + 1)
+
+    def record(self, wait_s: float):
+        """ Registers an acquire which waited `wait_s` seconds """
+        self.acquires += 1
+        if wait_s <= 0:
+            self.immediate += 1
+            return
+
+        self.waited += 1
+        exp = math.frexp(wait_s)[1]  # wait_s < 2 ** exp
+        self._histogram[min(max(exp, self._MIN_EXP), self._MAX_EXP) - self._MIN_EXP] += 1
+
+    def record_waiters(self, waiters: int):
+        if waiters > self.peak_waiters:
+            self.peak_waiters = waiters
+
+    def snapshot(self) -> Dict:
+        """
+        :return: dict of: {'acquires', 'immediate', 'waited', 'rejected', 'peak_waiters', 'wait_histogram'} where `wait_histogram`
+                 is a list of [upper bound in seconds, count] of the non-empty buckets
+        """
+        return {
+            "acquires": self.acquires,
+            "immediate": self.immediate,
+            "waited": self.waited,
+            "rejected": self.rejected,
+            "peak_waiters": self.peak_waiters,
+            "wait_histogram": [[2.0 ** (idx + self._MIN_EXP), count] for idx, count in enumerate(self._histogram) if count],
+        }
@@ -1,7 +1,97 @@
+import heapq
+import itertools
 import logging
 import time
 import threading
-import queue
+from typing import Callable, List
+
+from .stats import LimiterStats
+from .window import create_window
+
+
+class _LimiterContext:
+    __slots__ = ('_limiter', '_num')
+
+    def __init__(self, limiter, num: int):
+        """
+        Context manager which acquires and releases `num` units from `limiter`
+
+        :param limiter: RateLimiter to acquire from
+        :param num: number of units
+        """
+        self._limiter = limiter
+        self._num = num
+
+    def __enter__(self):
+        self._limiter.acquire(self._num)
+        return self._limiter
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        # NOTE: Even if there's a pending exception we have to assume the __enter__ call counted
+        self._limiter.release(self._num)
+
+
+class ReleaseScheduler:
+    def __init__(self, clock: Callable[[], float]=time.monotonic):
+        """
+        Returns the units of expired hits for every registered limiter from a single thread.  Limiters register the
+        time of their next expiry in a heap, so the thread count stays constant regardless of the number of limiters.
+
+        :param clock: monotonic clock used to schedule the deadlines
+        """
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._cond = threading.Condition(self._lock)
+        self._heap = []  # heap of: (deadline, seq, limiter)
+        self._seq = itertools.count()  # tie-breaker so limiters are never compared
+        self._thread: threading.Thread = None
+
+    def schedule(self, limiter, delay_s: float):
+        """
+        Registers `limiter._release_expired` to be called in `delay_s`, it returns the next delay to re-register or None.
+
+        :param limiter: limiter to call
+        :param delay_s: seconds from now at which to call it
+        """
+        with self._lock:
+            entry = (self._clock() + delay_s, next(self._seq), limiter)
+            heapq.heappush(self._heap, entry)
+
+            # the thread is started lazily, and won't have survived a fork
+            if not self._thread or not self._thread.is_alive():
+                self._thread = threading.Thread(target=self._thread_func, name="RateLimiterReleaseScheduler", daemon=True)
+                self._thread.start()
+            elif self._heap[0] is entry:
+                # the thread may be sleeping until a later deadline
+                self._cond.notify()
+
+    def _thread_func(self):
+        with self._lock:
+            while True:
+                if not self._heap:
+                    self._cond.wait()
+                    continue
+
+                deadline, _, limiter = self._heap[0]
+                now = self._clock()
+                if deadline > now:
+                    self._cond.wait(deadline - now)
+                    continue
+
+                heapq.heappop(self._heap)
+
+                # we can't hold our lock while calling into a limiter as limiters call `schedule` while holding theirs
+                self._lock.release()
+                try:
+                    delay_s = limiter._release_expired()
+                finally:
+                    self._lock.acquire()
+
+                if delay_s is not None:
+                    heapq.heappush(self._heap, (self._clock() + delay_s, next(self._seq), limiter))
+
+
+_DEFAULT_SCHEDULER = ReleaseScheduler()
 
 
 # This is a moving-window rate limiter.  The theory behind this limiter is that it will guarantee that at most
@@ -12,148 +102,566 @@ class RateLimiter:
     class Error(Exception):
         pass
 
-    class Terminator:
+    class Rejected(Exception):
+        """ Raised instead of waiting when an acquire is shed, see `max_wait` and `max_waiters` """
         pass
 
-    def __init__(self, max_rate: int, period_s: float or int, logger: logging.Logger):
+    def __init__(self, max_rate: int, period_s: float or int, logger: logging.Logger, buckets: int=None,
+                 scheduler: ReleaseScheduler=None, clock: Callable[[], float]=time.monotonic, stats: bool=False,
+                 max_wait: float=None, max_waiters: int=None, aging_s: float=None, fifo: bool=False):
         """
         Allows `max_rate` per `period_s`.
 
         :param max_rate: number of hits allowed per `period_s`
         :param period_s: period in seconds
         :param logger: logger to use
+        :param buckets: if set, hits are coalesced into this many buckets per period so memory is fixed regardless
+                        of `max_rate`, otherwise one record is kept per hit
+        :param scheduler: scheduler which releases expired hits, defaults to one shared by all limiters in the process
+        :param clock: monotonic clock used to timestamp hits, see `rate_limiter.clock`
+        :param stats: whether to collect the stats returned by `stats`
+        :param max_wait: default of `acquire`'s `max_wait`
+        :param max_waiters: if set, acquires which would have to wait while this many threads are already waiting
+                            raise `Rejected` instead
+        :param aging_s: seconds a waiter has to wait to get ahead of new waiters one priority above it, defaults to
+                        `period_s`
+        :param fifo: if set, returned units are handed directly to the waiters in order instead of waking them all to
+                     check.  This bounds the tail latency under contention, at the cost of a thread switch per hand-off.
         """
 
         assert isinstance(max_rate, int) and max_rate > 0
         assert period_s > 0
+        assert max_waiters is None or max_waiters >= 0
 
         self._max_rate = max_rate
         self._period_s = period_s
         self._logger = logger
+        self._clock = clock
+        self._max_wait = max_wait
+        self._max_waiters = max_waiters
+        self._aging_s = period_s if aging_s is None else aging_s
+        self._fifo = fifo
 
         self._lock = threading.Lock()
         self._waiters = 0
-
-        # We'll initially allow `max_rate` to happen in parallel, and then release
-        # the semaphores as new tasks can be started
-        self._sema = threading.Semaphore(max_rate)
-
-        # we'll push the task end-time to this queue during `__aexit__`
-        self._end_time_q = queue.Queue()
+        self._pending = 0  # `reserve_all` calls waiting on a group which includes us, see `is_idle`
+        # heap of the waiting threads, see `_rank`: [rank, seq, num] or in `fifo` mode [rank, seq, num, condition, handed]
+        self._acquire_waiters = []
+        self._seq = itertools.count()  # tie-breaker so waiters of the same rank are served in FIFO order
+        self._idle_cond = threading.Condition(self._lock)  # notified when `_waiters` or `_pending` drop to 0 or `_scheduled` to False
+
+        # We'll initially allow `max_rate` to happen in parallel, and then return units as their hits expire.
+        # `_available_cond` is notified whenever units are returned.
+        self._available = max_rate
+        self._available_cond = threading.Condition(self._lock)
+
+        # we'll push (end_time, num) records to this window during `release`.  `_scheduled` is True while the
+        # scheduler has a pending call to `_release_expired`.
+        self._end_time_q = create_window(period_s, buckets)
+        self._scheduler = scheduler or _DEFAULT_SCHEDULER
+        self._scheduled = False
 
         self._release_worker_exception = None
-        self._release_thread: threading.Thread = None
+        self._stats = LimiterStats() if stats else None
 
     @property
     def max_rate(self):
         return self._max_rate
 
+    @property
+    def stats(self) -> dict or None:
+        """
+        :return: None if the limiter was created without `stats`, otherwise `LimiterStats.snapshot` plus:
+                 {'max_rate', 'available', 'in_window': units of hits in the window, 'in_use': units acquired and not
+                 released, 'waiters'}
+        """
+        if self._stats is None:
+            return None
+
+        with self._lock:
+            stats = self._stats.snapshot()
+            in_window = self._end_time_q.units()
+            stats.update(max_rate=self._max_rate, available=self._available, in_window=in_window,
+                         in_use=self._max_rate - self._available - in_window, waiters=self._waiters)
+            return stats
+
     @property
     def is_broken(self):
         return self._release_worker_exception is not None
 
-    def join(self):
-        """ Will wait until all waiters have finished.
+    @property
+    def is_idle(self):
+        """ True if no units are held or in the window and nobody is waiting, so dropping the limiter loses no history """
+        with self._lock:
+            return self._available == self._max_rate and not self._waiters and not self._pending
 
-         This method is public for access by unittests. """
-        while self._waiters:
-            time.sleep(1)
+    def __call__(self, num: int=1) -> _LimiterContext:
+        """
+        Returns a context manager which will acquire `num` units on enter and release them on exit
 
-        if self._release_thread:
-            self._end_time_q.put(self.Terminator())
+        :param num: number of units
+        """
+        return _LimiterContext(self, num)
+
+    def join(self, drain: bool=True):
+        """ Will wait until all waiters have finished.
+
+         This method is public for access by unittests.
 
-            # wait until the helper thread exits, this could cause an extra `self._period_s` seconds of waiting
-            # we could add some more code to exit sooner if we wanted
-            while self._release_thread:
-                time.sleep(1)
+        :param drain: also wait until all hits have been released, this could cause an extra `self._period_s` seconds of waiting
+        """
+        with self._lock:
+            while self._waiters or self._pending or (drain and self._scheduled):
+                self._idle_cond.wait()
 
     def __enter__(self):
         self.acquire()
         return self
 
-    def acquire(self, timeout=None):
+    def acquire(self, num: int=1, timeout=None, max_wait: float=None, priority: int=0):
+        """
+        Acquires `num` units from the limiter in a single step
+
+        :param num: number of units to acquire
+        :param timeout: max seconds to wait, raises `TimeoutError` if exceeded
+        :param max_wait: if the units can't be admitted within this many seconds according to the hits in the window,
+                         raise `Rejected` immediately instead of waiting.  Defaults to the limiter's `max_wait`.
+        :param priority: waiting threads with a higher priority are served first, see `_rank`
+        """
+        assert not self.is_broken
+        assert isinstance(num, int) and 0 < num <= self._max_rate
+
+        with self._lock:
+            # fast path: nobody is queued ahead of us and there are enough units
+            if not self._acquire_waiters and self._available >= num:
+                self._available -= num
+                if self._stats is not None:
+                    self._stats.record(0)
+                return
+
+            self._shed(num, max_wait, priority)
+            start = time.monotonic()
+            end_time = None if timeout is None else start + timeout
+            if self._fifo:
+                # the units are taken for us by the hand-off
+                self._wait_handoff(num, end_time, priority)
+            else:
+                self._wait_available(num, end_time, priority)
+                self._available -= num
+
+            if self._stats is not None:
+                self._stats.record(time.monotonic() - start)
+
+    def try_acquire(self, num: int=1) -> bool:
+        """
+        Acquires `num` units only if they're available right now and nobody is queued ahead of us
+
+        :param num: number of units to acquire
+        :return: whether they were acquired
+        """
+        assert not self.is_broken
+        assert isinstance(num, int) and 0 < num <= self._max_rate
+
+        with self._lock:
+            if self._admit_delay(num) != 0:
+                return False
+
+            self._available -= num
+            if self._stats is not None:
+                self._stats.record(0)
+            return True
+
+    def reserve(self, num: int=1) -> float or None:
+        """
+        Commits `num` units now and returns the seconds until they may be used, ie: until enough hits have expired.  The
+        caller must wait that long before its hit and then `release` as usual.  Until then the units are owed to the
+        limiter, so `_available` may go negative and later acquires queue up behind the reservation.
+
+        :param num: number of units to reserve
+        :return: seconds to wait, or None if that depends on units which haven't been released yet or on queued waiters
+                 (nothing is committed)
+        """
         assert not self.is_broken
+        assert isinstance(num, int) and 0 < num <= self._max_rate
 
         with self._lock:
-            if not self._release_thread:
-                self._release_thread = threading.Thread(target=self._semaphore_releaser_thread_func, daemon=True)
-                self._release_thread.start()
-            self._waiters += 1
+            delay_s = self._admit_delay(num)
+            if delay_s is None:
+                return None
+
+            self._available -= num
+            if self._stats is not None:
+                self._stats.record(delay_s)
+            return delay_s
+
+    def _shed(self, num: int, max_wait: float=None, priority: int=0):
+        """
+        Raises `Rejected` if a caller about to wait for `num` units should be turned away, must be called with `_lock` held
+
+        :param num: number of units
+        :param max_wait: overrides the limiter's `max_wait`
+        :param priority: priority the caller would wait with
+        """
+        if self._max_waiters is not None and self._waiters >= self._max_waiters:
+            self._reject("Rate limiter has {} waiters".format(self._waiters))
+
+        max_wait = self._max_wait if max_wait is None else max_wait
+        if max_wait is None:
+            return
+
+        # Waiters are served in order, so we get in once the units of everyone queued ahead of us have expired too.
+        # If they aren't all in the window yet they can't expire before a full period from now.
+        rank = self._rank(priority)
+        queued = sum(waiter[2] for waiter in self._acquire_waiters if waiter[0] <= rank)
+
+        short = queued + num - self._available
+        if short <= 0:
+            return
+
+        admit_ts = self._end_time_q.admit_time(short)
+        delay_s = self._period_s if admit_ts is None else admit_ts - self._clock()
+
+        if delay_s > max_wait:
+            self._reject("Rate limiter can't admit {} units for {:.3f}s".format(num, delay_s))
+
+    def _reject(self, msg: str):
+        if self._stats is not None:
+            self._stats.rejected += 1
+        raise self.Rejected(msg)
+
+    def _rank(self, priority: int) -> float:
+        """
+        Waiters are served in order of rank, which is their enqueue time minus `priority * aging_s`: higher priorities
+        go first, and a waiter gets ahead of new waiters one priority above it for every `aging_s` it waits, so low
+        priorities can't be starved.  All waiters of the same priority are served in FIFO order.
+        """
+        return self._clock() - priority * self._aging_s
+
+    def _wait_available(self, num: int, end_time: float=None, priority: int=0):
+        """
+        Waits until `num` units are available without taking them, must be called with `_lock` held and not in `fifo`
+        mode
 
+        :param num: number of units
+        :param end_time: `time.monotonic()` after which to raise `TimeoutError`
+        :param priority: see `_rank`
+        """
+        waiter = [self._rank(priority), next(self._seq), num]
+        heapq.heappush(self._acquire_waiters, waiter)
+        self._waiters += 1
+        if self._stats is not None:
+            self._stats.record_waiters(self._waiters)
         try:
-            # Wait on which happens first: we acquire the semaphore or the rate-limiter breaks
-            # Since there's no equivalent to asyncio.wait for threading primitives we need to always have a timeout to ensure
-            # we see `self._release_worker_exception`
-            acquired = False
-            while not acquired and not self._release_worker_exception:
-                sleep_s = timeout or 10
-                acquired = self._sema.acquire(timeout=sleep_s)  # worst case scenario, if the _release_worker fails, we wait for sleep_s
-
-                if not acquired and timeout:
+            # Wait on which happens first: we're the head of the queue and enough units are returned, or the
+            # rate-limiter breaks.  Both notify `_available_cond`.
+            while (self._acquire_waiters[0] is not waiter or self._available < num) and not self._release_worker_exception:
+                if end_time is None:
+                    self._available_cond.wait()
+                    continue
+
+                sleep_s = end_time - time.monotonic()
+                if sleep_s <= 0:
                     raise TimeoutError("Timed out acquiring rate limiter")
+
+                self._available_cond.wait(sleep_s)
+
+            if self._release_worker_exception:
+                raise self.Error("Error while acquiring rate limiter") from self._release_worker_exception
         finally:
-            with self._lock:
-                self._waiters -= 1
+            if self._acquire_waiters[0] is waiter:
+                heapq.heappop(self._acquire_waiters)
+            else:
+                self._acquire_waiters.remove(waiter)
+                heapq.heapify(self._acquire_waiters)
+
+            if self._acquire_waiters:
+                # the next waiter may be able to go now
+                self._available_cond.notify_all()
 
-    def _semaphore_releaser_thread_func(self):
+            self._waiters -= 1
+            if not self._waiters:
+                self._idle_cond.notify_all()
+
+    def _wait_handoff(self, num: int, end_time: float=None, priority: int=0):
+        """
+        `fifo` version of `_wait_available`: queues up until `_hand_off` takes `num` units for us, must be called with
+        `_lock` held.  Each waiter has its own condition so a hand-off wakes exactly one thread.
+
+        :param num: number of units
+        :param end_time: `time.monotonic()` after which to raise `TimeoutError`
+        :param priority: see `_rank`
+        """
+        waiter = [self._rank(priority), next(self._seq), num, threading.Condition(self._lock), False]
+        heapq.heappush(self._acquire_waiters, waiter)
+        self._waiters += 1
+        if self._stats is not None:
+            self._stats.record_waiters(self._waiters)
         try:
-            while True:
-                # wait until we have items to release
-                # NOTE this code uses a few undocumented but non-private attributes (not_empty, etc)
-                #      We could either add another condition variable or continue using this. Given that we have unittests
-                #      which will ensure these attributes behave correctly we should be ok
-                # not_empty is a condition variable that is notified when the queue is not empty
-                # This is the beginning of a "peek" method that follows the implementation of Queue.get, see: https://github.com/python/cpython/blob/master/Lib/queue.py#L153
-                with self._end_time_q.not_empty:  # only "get" acquires this lock which is only used below
-                    while not len(self._end_time_q.queue):
-                        self._end_time_q.not_empty.wait()
-
-                # Here we'll release each semaphore that expired its period from when it finished
-                while len(self._end_time_q.queue):  # ok not to have lock as the enclosed code is the only thing that can remove items
-                    now = time.time()  # cache as this call is not cheap
-                    sleep_s = 0
-
-                    while len(self._end_time_q.queue):  # ok not to have lock as the enclosed code is the only thing that can remove items
-                        oldest_finished_ts = self._end_time_q.queue[0]
-                        if isinstance(oldest_finished_ts, self.Terminator):
-                            return
-
-                        time_since_finished_ts = now - oldest_finished_ts
-                        if time_since_finished_ts >= self._period_s:
-                            # if either of these fail, the ratelimiter will be marked as broken and all current and future acquires will raise
-                            self._end_time_q.get(block=False)
-                            self._end_time_q.task_done()
-
-                            self._sema.release()
-                        else:
-                            sleep_s = self._period_s - time_since_finished_ts
-                            break
-
-                    time.sleep(sleep_s)  # sleep outside lock
-        except BaseException as e:
-            self._logger.exception("Failed while attempting to release semaphores")
-            self._release_worker_exception = e
-            # NOTE: theoretically we could try to "reset" the limiter after flushing the semas
+            if self._acquire_waiters[0] is waiter:
+                # we may have got ahead of a head which is waiting for more units than are available
+                self._hand_off()
+
+            while not waiter[4] and not self._release_worker_exception:
+                if end_time is None:
+                    waiter[3].wait()
+                    continue
+
+                sleep_s = end_time - time.monotonic()
+                if sleep_s <= 0:
+                    raise TimeoutError("Timed out acquiring rate limiter")
+
+                waiter[3].wait(sleep_s)
+
+            if not waiter[4]:
+                raise self.Error("Error while acquiring rate limiter") from self._release_worker_exception
+        except BaseException:
+            if waiter[4]:
+                # the units were handed to us before we failed
+                self._available += num
+            else:
+                self._acquire_waiters.remove(waiter)
+                heapq.heapify(self._acquire_waiters)
+            self._hand_off()  # we may have been blocking the head of the queue
             raise
         finally:
-            self._release_thread = None  # only clear this when we're actually exiting
+            self._waiters -= 1
+            if not self._waiters:
+                self._idle_cond.notify_all()
+
+    def _hand_off(self):
+        """
+        Hands units to the `fifo` waiters in order, stopping at the first one we can't satisfy, must be called with
+        `_lock` held
+        """
+        while self._acquire_waiters:
+            waiter = self._acquire_waiters[0]
+            if self._available < waiter[2]:
+                break
+
+            heapq.heappop(self._acquire_waiters)
+            self._available -= waiter[2]
+            waiter[4] = True
+            waiter[3].notify()
+
+    def _notify_available(self):
+        # must be called with `_lock` held whenever units are returned
+        if self._fifo:
+            self._hand_off()
+        else:
+            self._available_cond.notify_all()
+
+    def _admit_delay(self, num: int) -> float or None:
+        """
+        Seconds until `num` units can be acquired according to the hits in the window, must be called with `_lock` held
+
+        :return: 0 if they're available now, or None if it depends on queued waiters or units which haven't been released yet
+        """
+        now = self._clock()
+        if self._available < num:
+            # return anything which expired but the scheduler hasn't gotten to yet
+            released = self._end_time_q.expire(now)
+            if released:
+                self._available += released
+                self._notify_available()
+
+        if self._acquire_waiters:
+            return None
+
+        if self._available >= num:
+            return 0
+
+        admit_ts = self._end_time_q.admit_time(num - self._available)
+        return None if admit_ts is None else admit_ts - now
+
+    def cancel(self, num: int=1):
+        """
+        Returns `num` acquired units which were never used, without registering a hit
+
+        :param num: number of units to return, must not exceed what was acquired
+        """
+        with self._lock:
+            self._available += num
+            self._notify_available()
+
+    def _release_expired(self) -> float or None:
+        """
+        Called by the scheduler to return the units of each record that expired its period from when it finished
+
+        :return: seconds until the next expiry, or None if there are no more records
+        """
+        try:
+            with self._lock:
+                now = self._clock()
+                released = self._end_time_q.expire(now)
+                if released:
+                    self._available += released
+                    self._notify_available()
+
+                next_expiry_ts = self._end_time_q.next_expiry()
+                if next_expiry_ts is None:
+                    self._scheduled = False
+                    self._idle_cond.notify_all()
+                    return None
+
+                return next_expiry_ts - now
+        except BaseException as e:
+            # the ratelimiter will be marked as broken and all current and future acquires will raise
+            self._logger.exception("Failed while attempting to release units")
+            self._release_worker_exception = e
+            self._scheduled = False
+
+            # wake up all waiters so they raise immediately
+            with self._lock:
+                self._available_cond.notify_all()
+                if self._fifo:
+                    for waiter in self._acquire_waiters:
+                        waiter[3].notify()
+                self._idle_cond.notify_all()
+
+            # NOTE: theoretically we could try to "reset" the limiter after flushing the window
+            return None
 
     def __exit__(self, exc_type, exc_val, exc_tb):
         # NOTE: Even if there's a pending exception we have to assume the __enter__ call counted
         self.release()
 
-    def release(self):
+    def release(self, num: int=1):
+        """
+        Registers a hit of `num` units, they will be returned to the limiter `period_s` from now
+
+        :param num: number of units to release, must match what was acquired
+        """
         assert not self.is_broken
+        assert isinstance(num, int) and 0 < num <= self._max_rate
 
         try:
-            # If this fails you'll permanently decrease your available max_rate by one, and if max_rate == 1 deadlock
-            self._end_time_q.put(time.time())
+            with self._lock:
+                # If this fails you'll permanently decrease your available max_rate by `num`, and if max_rate == num deadlock
+                now = self._clock()
+                self._end_time_q.add(now, num)
+
+                if not self._scheduled:
+                    # If there's already a pending call we don't need to register a new one because it will iterate
+                    # through all the pending records and re-register if they're not yet releasable.
+                    self._scheduler.schedule(self, self._end_time_q.next_expiry() - now)
+                    self._scheduled = True
         except BaseException:
-            if self._max_rate == 1:
+            if self._max_rate == num:
                 self._logger.exception("Error registering rate limiter hit, deadlocked!")
             else:
-                self._logger.exception("Error registering rate limiter hit, max_rate decreased by 1, potential for eventual deadlock")
+                self._logger.exception("Error registering rate limiter hit, max_rate decreased by {}, potential for eventual deadlock".format(num))
             raise
 
     def __del__(self):
-        self.join()
+        # don't wait for the hits in the window, nothing may be left to release them, ex: a `ManualScheduler`
+        self.join(drain=False)
+
+
+def reserve_all(limiters: List[RateLimiter], num: int=1, timeout=None, max_wait: float=None, priority: int=0):
+    """
+    Acquires `num` units from every limiter in `limiters`, or from none of them.
+
+    The limiters' locks are taken in a consistent order and only for a non-blocking check, so this can't deadlock with
+    other callers.  If any limiter is short we queue up on the most constrained one, ie: the one whose units are
+    furthest away, like any other waiter: by priority, and woken once its units are returned at the time computed from
+    its window.  We then take its units and hold them while checking the others, and give them back before queueing
+    again if any of those is short, so we never hold units of one limiter while waiting on another.  While we wait none
+    of the limiters is idle, so a cache can't drop the ones we aren't queued on.
+
+    :param limiters: limiters to acquire from
+    :param num: number of units to acquire from each limiter
+    :param timeout: max seconds to wait, raises `TimeoutError` if exceeded
+    :param max_wait: see `RateLimiter.acquire`, it's checked against every limiter before waiting as are their `max_waiters`
+    :param priority: see `RateLimiter.acquire`
+    """
+    limiters = sorted(set(limiters), key=id)
+    end_time = None if timeout is None else time.monotonic() + timeout
+    wait_start = None  # for stats, set once we have to wait
+    held = None  # limiter whose units we took after waiting in its queue
+
+    try:
+        while True:
+            for limiter in limiters:
+                assert not limiter.is_broken
+                assert isinstance(num, int) and 0 < num <= limiter.max_rate
+
+            blocked = None
+            blocked_delay_s = 0
+            locked = []
+            try:
+                for limiter in limiters:
+                    limiter._lock.acquire()
+                    locked.append(limiter)
+
+                for limiter in limiters:
+                    if limiter is held:
+                        continue
+
+                    delay_s = limiter._admit_delay(num)
+                    if delay_s is None:
+                        # depends on units in use or on queued waiters
+                        blocked = limiter
+                        break
+
+                    if delay_s > blocked_delay_s:
+                        blocked, blocked_delay_s = limiter, delay_s
+
+                if not blocked:
+                    wait_s = 0 if wait_start is None else time.monotonic() - wait_start
+                    for limiter in limiters:
+                        if limiter is not held:
+                            limiter._available -= num
+                        if limiter._stats is not None:
+                            limiter._stats.record(wait_s)
+                    held = None
+                    return
+
+                if held:
+                    # don't hold its units while waiting on the others
+                    held._available += num
+                    held._notify_available()
+                    held = None
+
+                if wait_start is None:
+                    # only shed before we start waiting, later checks would just waste the wait
+                    for limiter in limiters:
+                        limiter._shed(num, max_wait, priority)
+                    for limiter in limiters:
+                        limiter._pending += 1
+                    wait_start = time.monotonic()
+            finally:
+                for limiter in locked:
+                    limiter._lock.release()
+
+            if end_time is not None and time.monotonic() + blocked_delay_s > end_time:
+                raise TimeoutError("Timed out acquiring rate limiters")
+
+            with blocked._lock:
+                if blocked._fifo:
+                    # the units are taken for us by the hand-off
+                    blocked._wait_handoff(num, end_time, priority)
+                else:
+                    blocked._wait_available(num, end_time, priority)
+                    blocked._available -= num
+                held = blocked
+    finally:
+        if held:
+            held.cancel(num)
+
+        if wait_start is not None:
+            for limiter in limiters:
+                with limiter._lock:
+                    limiter._pending -= 1
+                    if not limiter._pending:
+                        limiter._idle_cond.notify_all()
+
+
+def release_all(limiters: List[RateLimiter], num: int=1):
+    """
+    Registers a hit of `num` units on every limiter in `limiters`
+
+    :param limiters: limiters which were acquired with `reserve_all`
+    :param num: number of units acquired from each limiter
+    """
+    for limiter in set(limiters):
+        limiter.release(num)
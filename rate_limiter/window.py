@@ -0,0 +1,114 @@
+import math
+from collections import deque
+
+
+class ExactWindow:
+    """
+    Keeps one (end_time, num) record per hit, so memory grows with the number of hits in the window.
+
+    NOTE: this is not thread-safe, the owning limiter is responsible for locking.
+    """
+    __slots__ = ('_period_s', '_records')
+
+    def __init__(self, period_s: float or int):
+        """
+        :param period_s: period in seconds after which a hit expires
+        """
+        self._period_s = period_s
+        self._records = deque()
+
+    def __len__(self):
+        return len(self._records)
+
+    def add(self, ts: float, num: int):
+        """
+        Registers a hit of `num` units which finished at `ts`
+        """
+        self._records.append((ts, num))
+
+    def units(self) -> int:
+        """
+        :return: number of units in the window, this is O(records) so it's meant for stats
+        """
+        return sum(record[1] for record in self._records)
+
+    def expire(self, now: float) -> int:
+        """
+        Removes all records which have been in the window for at least `period_s`
+
+        :return: number of units expired
+        """
+        expired = 0
+        records = self._records
+        while records:
+            ts, num = records[0]
+            if ts + self._period_s > now:
+                break
+
+            records.popleft()
+            expired += num
+
+        return expired
+
+    def admit_time(self, num: int) -> float or None:
+        """
+        :return: time at which at least `num` units will have expired, or None if the window doesn't hold that many
+        """
+        expiring = 0
+        for ts, record_num in self._records:
+            expiring += record_num
+            if expiring >= num:
+                return ts + self._period_s
+
+        return None
+
+    def next_expiry(self) -> float or None:
+        """
+        :return: time at which the oldest record will expire, or None if the window is empty
+        """
+        if not self._records:
+            return None
+
+        return self._records[0][0] + self._period_s
+
+
+class BucketedWindow(ExactWindow):
+    """
+    Coalesces hits into `buckets` buckets per period, so memory is O(buckets) regardless of `max_rate`.
+
+    Each hit is accounted as finishing at the end of its bucket, so it's released up to `period_s / buckets`
+    later than with an `ExactWindow`.  This errs on the side of fewer hits so the limit still holds.
+    """
+    __slots__ = ('_bucket_s',)
+
+    def __init__(self, period_s: float or int, buckets: int):
+        """
+        :param period_s: period in seconds after which a hit expires
+        :param buckets: number of buckets per period
+        """
+        assert isinstance(buckets, int) and buckets > 0
+
+        super().__init__(period_s)
+        self._bucket_s = period_s / buckets
+
+    def add(self, ts: float, num: int):
+        ts = math.ceil(ts / self._bucket_s) * self._bucket_s
+
+        records = self._records
+        if records and records[-1][0] == ts:
+            records[-1][1] += num
+        else:
+            records.append([ts, num])
+
+
+def create_window(period_s: float or int, buckets: int=None) -> ExactWindow:
+    """
+    Returns the window engine for a limiter
+
+    :param period_s: period in seconds after which a hit expires
+    :param buckets: if set, use a `BucketedWindow` with this many buckets per period, otherwise an `ExactWindow`
+    """
+    if buckets:
+        return BucketedWindow(period_s, buckets)
+
+    return ExactWindow(period_s)
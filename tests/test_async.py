@@ -1,11 +1,36 @@
 import asyncio
+import functools
+import gc
 import logging
-import time
+from unittest import mock
+import weakref
 
 import asynctest
 
 import common
 from rate_limiter import ASyncRateLimiter as RateLimiter
+from rate_limiter.async_rate_limiter import ReleaseDriver, reserve_all
+from rate_limiter.clock import VirtualClock
+from rate_limiter.simulation import VirtualEventLoop
+from rate_limiter.window import ExactWindow
+
+
+def virtual_time(test_method):
+    """ Runs a test on a `VirtualEventLoop`, so its sleeps, timeouts and the limiter's release task take no real time """
+    @functools.wraps(test_method)
+    def wrapper(self):
+        async def _run():
+            await test_method(self)
+            # drain while the loop is still around, so `tearDown` has nothing left to wait for
+            await self._rl.join()
+
+        loop = VirtualEventLoop()
+        try:
+            loop.run_until_complete(_run())
+        finally:
+            loop.close()
+
+    return wrapper
 
 
 class TestRateLimiter(asynctest.TestCase):
@@ -16,14 +41,16 @@ class TestRateLimiter(asynctest.TestCase):
         self._rl = None
 
     async def validate_elapsed(self, coro, num_seconds: float or int):
-        start_s = time.time()
+        loop = asyncio.get_event_loop()
+        start_s = loop.time()
         try:
-            await asyncio.wait_for(coro, num_seconds)
+            # in virtual time the coroutine finishes exactly on time, so give it the slack we assert with
+            await asyncio.wait_for(coro, num_seconds + 0.1)
         except:
-            print("Error elapsed: {}".format(time.time() - start_s))
+            print("Error elapsed: {}".format(loop.time() - start_s))
             raise
 
-        elapsed_s = time.time() - start_s
+        elapsed_s = loop.time() - start_s
         self.assertAlmostEqual(num_seconds, elapsed_s, delta=0.1)
 
     async def tearDown(self):
@@ -31,13 +58,15 @@ class TestRateLimiter(asynctest.TestCase):
 
     @staticmethod
     async def acquire(rl2, sleep_s=0):
-        start = time.time()
+        loop = asyncio.get_event_loop()
+        start = loop.time()
         async with rl2:
-            wait_s = time.time() - start
+            wait_s = loop.time() - start
             await asyncio.sleep(sleep_s)
 
         return wait_s
 
+    @virtual_time
     async def test_rate_limiter1(self):
         # test sequential
         self._rl = rl = RateLimiter(3, 2, self._logger)
@@ -62,6 +91,7 @@ class TestRateLimiter(asynctest.TestCase):
 
         await self.validate_elapsed(fut, 2)  # 7 (complete)
 
+    @virtual_time
     async def test_rate_limiter2(self):
         # test parallel
         self._rl = rl = RateLimiter(3, 2, self._logger)
@@ -77,6 +107,7 @@ class TestRateLimiter(asynctest.TestCase):
         # these should take 2 seconds and pass
         await asyncio.gather(self.validate_elapsed(fut, 1.95), *[self.validate_elapsed(self.acquire(rl), 1.95) for _ in range(2)])
 
+    @virtual_time
     async def test_rate_limiter3(self):
         self._rl = rl = RateLimiter(1, 1, self._logger)
         await asyncio.wait_for(self.acquire(rl), 0.01)
@@ -85,16 +116,18 @@ class TestRateLimiter(asynctest.TestCase):
 
         await asyncio.wait_for(self.acquire(rl), 0.01)
 
+    @virtual_time
     async def test_rate_limiter4(self):
         self._rl = rl = RateLimiter(3, 2, self._logger)
 
         # these won't register the call as having happened 1, 2, 3 seconds after
-        await asyncio.gather(*[self.validate_elapsed(self.acquire(rl, i), i + 0.1) for i in range(1, 4)])
+        await asyncio.gather(*[self.validate_elapsed(self.acquire(rl, i), i) for i in range(1, 4)])
 
         # we've waited 3s, so 1s one is released, 2nd has 1s wait, 3rd has 2s wait
         times = sorted(await asyncio.gather(*[asyncio.wait_for(self.acquire(rl), 3) for _ in range(3)]))
         self.assertRecursiveAlmostEqual(times, [0, 1, 2], delta=0.1)
 
+    @virtual_time
     async def test_rate_limiter5(self):
         self._rl = rl = RateLimiter(3, 2, self._logger)
 
@@ -105,4 +138,243 @@ class TestRateLimiter(asynctest.TestCase):
         times = sorted(await asyncio.gather(*[asyncio.wait_for(self.acquire(rl), 5.1) for _ in range(3)]))
         self.assertRecursiveAlmostEqual(times, [3, 4, 5], delta=0.1)
 
-    # TODO: add test where we break _release_worker
+    @virtual_time
+    async def test_weighted(self):
+        self._rl = rl = RateLimiter(5, 1, self._logger)
+        loop = asyncio.get_event_loop()
+
+        start = loop.time()
+        async with rl(3):
+            pass
+        self.assertEqual(len(rl._end_time_q), 1)  # one record per weighted hit
+
+        # only 2 units are left so this has to wait for the first hit to expire
+        async with rl(2):
+            pass
+        self.assertAlmostEqual(loop.time() - start, 0, delta=0.1)
+
+        await asyncio.wait_for(rl.acquire(3), 1.5)
+        rl.release(3)
+        self.assertAlmostEqual(loop.time() - start, 1, delta=0.1)
+
+    @virtual_time
+    async def test_weighted_fairness(self):
+        self._rl = rl = RateLimiter(4, 1, self._logger)
+        order = []
+
+        async def acquire(name, num):
+            async with rl(num):
+                order.append(name)
+
+        await acquire('first', 3)
+
+        # the big acquire queues first so the small ones can't barge in front of it even though they fit
+        big = asyncio.ensure_future(acquire('big', 4))
+        await asyncio.sleep(0)
+        small = [asyncio.ensure_future(acquire('small', 1)) for _ in range(3)]
+
+        await asyncio.wait_for(asyncio.gather(big, *small), 3.5)
+        self.assertEqual(order, ['first', 'big', 'small', 'small', 'small'])
+
+    @virtual_time
+    async def test_bucketed(self):
+        self._rl = rl = RateLimiter(3, 1, self._logger, buckets=4)
+
+        await asyncio.gather(*[asyncio.wait_for(self.acquire(rl), 0.1) for _ in range(3)])
+        self.assertLessEqual(len(rl._end_time_q), 2)  # hits are coalesced per bucket
+
+        # hits are released at the end of their bucket, so up to period_s / buckets later
+        wait_s = await asyncio.wait_for(self.acquire(rl), 1.5)
+        self.assertGreaterEqual(wait_s, 0.95)
+        self.assertLessEqual(wait_s, 1.35)
+
+    @virtual_time
+    async def test_release_driver(self):
+        driver = ReleaseDriver.for_loop()
+        self.assertIs(driver, ReleaseDriver.for_loop())
+
+        limiters = [RateLimiter(1, 0.5, self._logger, release_driver=driver) for _ in range(100)]
+        self._rl = limiters[-1]
+
+        num_tasks = len(asyncio.all_tasks())
+        for rl in limiters:
+            async with rl:
+                pass
+
+        # no release task was created per limiter
+        self.assertEqual(num_tasks, len(asyncio.all_tasks()))
+
+        times = await asyncio.gather(*[asyncio.wait_for(self.acquire(rl), 1) for rl in limiters])
+        self.assertAlmostEqual(max(times), 0.5, delta=0.1)
+
+    async def test_release_driver_loop_lifetime(self):
+        self._rl = RateLimiter(1, 1, self._logger)
+
+        # the shared drivers don't keep closed loops alive
+        loop = asyncio.new_event_loop()
+        ReleaseDriver.for_loop(loop)
+        loop.close()
+        loop_ref = weakref.ref(loop)
+        del loop
+        gc.collect()
+        self.assertIsNone(loop_ref())
+
+    @virtual_time
+    async def test_clock(self):
+        clock = VirtualClock(1000)
+        self._rl = rl = RateLimiter(1, 1, self._logger, clock=clock)
+
+        async with rl:
+            pass
+        self.assertEqual(rl._end_time_q.next_expiry(), 1001)
+
+        # the hit only expires once the injected clock moves
+        self.assertEqual(rl._release_expired(), 1)
+        clock.advance(1)
+        self.assertIsNone(rl._release_expired())
+
+        await asyncio.wait_for(self.acquire(rl), 0.01)
+        clock.advance(1)
+
+    @virtual_time
+    async def test_try_acquire_reserve(self):
+        self._rl = rl = RateLimiter(2, 0.2, self._logger)
+
+        self.assertTrue(rl.try_acquire())
+        self.assertEqual(rl.reserve(), 0)
+        self.assertFalse(rl.try_acquire())
+        # the delay depends on units which haven't been released yet
+        self.assertIsNone(rl.reserve())
+
+        rl.release(2)
+        delay_s = rl.reserve(2)
+        self.assertAlmostEqual(delay_s, 0.2, delta=0.05)
+        self.assertEqual(rl._available, -2)
+
+        # later acquires queue up behind the reservation
+        asyncio.get_event_loop().call_later(delay_s, rl.release, 2)
+        wait_s = await asyncio.wait_for(self.acquire(rl), 1)
+        self.assertAlmostEqual(wait_s, 0.4, delta=0.1)
+
+    @virtual_time
+    async def test_max_wait(self):
+        self._rl = rl = RateLimiter(3, 0.4, self._logger, stats=True)
+        async with rl:
+            pass
+        await asyncio.sleep(0.2)
+        async with rl(2):
+            pass
+
+        waiter = asyncio.ensure_future(self.acquire(rl))
+        await asyncio.sleep(0)
+
+        # the queued waiter gets the unit which expires next, we'd have to wait for the ones after it
+        with self.assertRaises(RateLimiter.Rejected):
+            await rl.acquire(max_wait=0.3)
+        self.assertAlmostEqual(await asyncio.wait_for(waiter, 1), 0.2, delta=0.1)
+
+        await asyncio.wait_for(rl.acquire(max_wait=0.3), 1)
+        rl.release()
+        self.assertEqual(rl.stats["rejected"], 1)
+
+    @virtual_time
+    async def test_max_waiters(self):
+        self._rl = rl = RateLimiter(1, 0.2, self._logger, max_waiters=1)
+        async with rl:
+            pass
+
+        waiter = asyncio.ensure_future(self.acquire(rl))
+        await asyncio.sleep(0)
+
+        with self.assertRaises(RateLimiter.Rejected):
+            await rl.acquire()
+        with self.assertRaises(RateLimiter.Rejected):
+            await reserve_all([rl])
+
+        await asyncio.wait_for(waiter, 1)
+
+    async def test_priority(self):
+        clock = VirtualClock(1000)
+        self._rl = rl = RateLimiter(1, 1, self._logger, clock=clock, aging_s=1)
+        order = []
+
+        async def _acquire(name, priority):
+            await rl.acquire(priority=priority)
+            order.append(name)
+            rl.cancel()
+
+        await rl.acquire()
+        tasks = [asyncio.ensure_future(_acquire("background", 0))]
+        await asyncio.sleep(0)
+        # after waiting 2 * aging_s the background waiter is ahead of new waiters up to 2 priorities above it
+        clock.advance(2)
+        tasks.append(asyncio.ensure_future(_acquire("interactive", 1)))
+        tasks.append(asyncio.ensure_future(_acquire("urgent", 3)))
+        await asyncio.sleep(0)
+
+        rl.cancel()
+        await asyncio.wait_for(asyncio.gather(*tasks), 1)
+        self.assertEqual(order, ["urgent", "background", "interactive"])
+
+    async def test_num_type(self):
+        self._rl = rl = RateLimiter(3, 1, self._logger)
+
+        # a fractional `num` would silently corrupt `_available`
+        with self.assertRaises(AssertionError):
+            await rl.acquire(2.5)
+        with self.assertRaises(AssertionError):
+            rl.release(2.5)
+        self.assertEqual(rl._available, 3)
+
+    @virtual_time
+    async def test_stats(self):
+        self.assertIsNone(RateLimiter(1, 1, self._logger).stats)
+
+        self._rl = rl = RateLimiter(2, 0.2, self._logger, stats=True)
+        async with rl(2):
+            pass
+        await asyncio.gather(rl.acquire(), rl.acquire())
+        self.assertEqual(rl.stats, {
+            "acquires": 3, "immediate": 1, "waited": 2, "rejected": 0, "peak_waiters": 2, "wait_histogram": [[0.25, 2]],
+            "max_rate": 2, "available": 0, "in_window": 0, "in_use": 2, "waiters": 0,
+        })
+        rl.release(2)
+        self.assertEqual((rl.stats["in_window"], rl.stats["in_use"]), (2, 0))
+
+    @virtual_time
+    async def test_join(self):
+        self._rl = rl = RateLimiter(1, 0.5, self._logger)
+        loop = asyncio.get_event_loop()
+        await asyncio.wait_for(self.acquire(rl), 0.1)
+
+        waiter = asyncio.ensure_future(self.acquire(rl))
+        await asyncio.sleep(0.1)
+
+        # returns as soon as the waiter is done, without waiting for its hit to be released
+        start = loop.time()
+        await asyncio.wait_for(rl.join(drain=False), 1)
+        self.assertAlmostEqual(loop.time() - start, 0.4, delta=0.1)
+        await waiter
+
+        # waits until the window is empty
+        start = loop.time()
+        await asyncio.wait_for(rl.join(), 1)
+        self.assertAlmostEqual(loop.time() - start, 0.5, delta=0.1)
+
+    @virtual_time
+    async def test_broken(self):
+        self._rl = rl = RateLimiter(1, 0.5, self._logger)
+        loop = asyncio.get_event_loop()
+        await asyncio.wait_for(self.acquire(rl), 0.1)
+
+        # the queued waiter is failed as soon as the limiter breaks
+        with mock.patch.object(ExactWindow, 'expire', side_effect=ValueError("boom")):
+            start = loop.time()
+            with self.assertRaises(RateLimiter.Error):
+                await asyncio.wait_for(self.acquire(rl), 1)
+
+        self.assertAlmostEqual(loop.time() - start, 0.5, delta=0.1)
+        self.assertTrue(rl.is_broken)
+
+        with self.assertRaises(RateLimiter.Error):
+            await self.acquire(rl)
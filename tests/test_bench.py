@@ -0,0 +1,20 @@
+import asynctest
+
+from rate_limiter import bench
+
+
+class TestBench(asynctest.TestCase):
+    def test_run(self):
+        # smoke test so the benchmarks don't rot, the numbers aren't checked
+        results = bench.run(ops=256, samples=5, period_s=0.01, memory=False)
+        self.assertEqual(set(results), set(bench.SYNC_ENGINES) | set(bench.ASYNC_ENGINES))
+        for engine_results in results.values():
+            self.assertEqual(set(engine_results["contended_ops_s"]), {"1", "4", "16", "64", "256"})
+            self.assertGreaterEqual(engine_results["wake_latency"]["p50_us"], 0)
+
+        for name in bench.SYNC_ENGINES:
+            self.assertGreaterEqual(results[name]["tail_wait"]["max_us"], results[name]["tail_wait"]["p50_us"])
+
+
+if __name__ == '__main__':
+    asynctest.main()
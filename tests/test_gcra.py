@@ -0,0 +1,113 @@
+import asyncio
+import bisect
+import logging
+import threading
+import time
+
+import asynctest
+
+import common
+from rate_limiter import SyncGCRARateLimiter, ASyncGCRARateLimiter
+from rate_limiter.clock import VirtualClock
+
+
+class TestGCRARateLimiter(asynctest.TestCase):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        logging.basicConfig(level=logging.INFO)
+        self._logger = logging.getLogger(self.__class__.__name__)
+
+    @staticmethod
+    async def acquire(rl, num=1):
+        start = time.time()
+        async with rl(num):
+            return time.time() - start
+
+    async def test_async_rate(self):
+        rl = ASyncGCRARateLimiter(4, 2, self._logger)
+        threads = threading.active_count()
+
+        # by default hits are spaced every period_s / max_rate
+        times = await asyncio.gather(*[self.acquire(rl) for _ in range(4)])
+        self.assertRecursiveAlmostEqual(times, [0, 0.5, 1, 1.5], delta=0.1)
+        self.assertEqual(threads, threading.active_count())
+
+    async def test_async_burst_then_rate(self):
+        rl = ASyncGCRARateLimiter(4, 1, self._logger, burst=3)
+
+        # a burst is allowed immediately, then one unit every period_s / (max_rate - burst + 1)
+        times = await asyncio.gather(*[self.acquire(rl) for _ in range(5)])
+        self.assertRecursiveAlmostEqual(times, [0, 0, 0, 0.5, 1], delta=0.1)
+
+    async def test_async_weighted(self):
+        rl = ASyncGCRARateLimiter(4, 2, self._logger, burst=2)
+
+        times = [await self.acquire(rl, 2), await self.acquire(rl, 2)]
+        self.assertRecursiveAlmostEqual(times, [0, 4 / 3], delta=0.1)
+
+        # weighted acquires need a burst which covers them
+        with self.assertRaisesRegex(ValueError, "burst"):
+            await self.acquire(ASyncGCRARateLimiter(4, 2, self._logger), 2)
+        with self.assertRaisesRegex(ValueError, "burst"):
+            SyncGCRARateLimiter(4, 2, self._logger).acquire(2)
+
+    async def test_async_cancel(self):
+        rl = ASyncGCRARateLimiter(1, 1, self._logger)
+        start = time.time()
+        await self.acquire(rl)
+
+        # a cancelled waiter gives back its reservation, so the next unit is admitted one emission interval after the first
+        with self.assertRaises(asyncio.TimeoutError):
+            await asyncio.wait_for(self.acquire(rl), 0.1)
+
+        await asyncio.wait_for(self.acquire(rl), 1.5)
+        self.assertAlmostEqual(time.time() - start, 1, delta=0.1)
+
+    async def test_sync(self):
+        rl = SyncGCRARateLimiter(2, 1, self._logger, burst=2)
+        loop = asyncio.get_event_loop()
+
+        def acquire(num=1, timeout=None):
+            start = time.time()
+            rl.acquire(num, timeout)
+            return time.time() - start
+
+        times = [await loop.run_in_executor(None, acquire) for _ in range(3)]
+        self.assertRecursiveAlmostEqual(times, [0, 0, 1], delta=0.1)
+
+        with self.assertRaises(TimeoutError):
+            acquire(2, 0.1)
+
+        # the timed out acquire didn't consume anything, so the next unit only waits one emission interval
+        self.assertAlmostEqual(await loop.run_in_executor(None, acquire), 1, delta=0.1)
+
+    async def test_try_acquire_reserve(self):
+        rl = ASyncGCRARateLimiter(2, 1, self._logger, burst=2)
+
+        self.assertTrue(rl.try_acquire())
+        self.assertTrue(rl.try_acquire())
+        self.assertFalse(rl.try_acquire())
+
+        # a reservation is committed even though it has to wait
+        self.assertAlmostEqual(rl.reserve(), 1, delta=0.05)
+        self.assertAlmostEqual(rl.reserve(), 2, delta=0.05)
+
+    async def test_window(self):
+        for burst in (1, 4, 10):
+            clock = VirtualClock()
+            rl = SyncGCRARateLimiter(10, 1, self._logger, burst=burst, clock=clock)
+
+            hits = []
+            for _ in range(500):
+                while rl.try_acquire():
+                    hits.append(clock())
+                clock.advance(0.01)
+
+            # no window of period_s sees more than max_rate hits
+            for idx, ts in enumerate(hits):
+                self.assertLessEqual(bisect.bisect_left(hits, ts + 1 - 1e-9) - idx, 10)
+            self.assertGreater(len(hits), 10)
+
+
+if __name__ == '__main__':
+    asynctest.main()
@@ -0,0 +1,62 @@
+import asyncio
+import logging
+import time
+
+import asynctest
+
+from rate_limiter import SyncRateLimiter, ASyncRateLimiter
+from rate_limiter.leasing import SyncLeasedRateLimiter, ASyncLeasedRateLimiter
+
+
+class TestLeasing(asynctest.TestCase):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        logging.basicConfig(level=logging.INFO)
+        self._logger = logging.getLogger(self.__class__.__name__)
+
+    def test_sync(self):
+        rl = SyncRateLimiter(100, 1, self._logger)
+        leased = SyncLeasedRateLimiter(rl, self._logger, max_lease=10, lease_s=0.2)
+
+        for _ in range(20):
+            with leased:
+                pass
+        self.assertEqual(rl._available, 80)
+
+        # once the lease expires the lease size follows our consumption
+        time.sleep(0.3)
+        self.assertGreater(leased.lease_size, 1)
+        self.assertLessEqual(leased.lease_size, 10)
+
+        # only the first acquire goes to the backend, and unused units are returned without counting as hits
+        leased.acquire()
+        self.assertEqual(rl._available, 80 - leased.lease_size)
+        leased.acquire()
+        leased.cancel()
+        leased.release()
+        leased.flush()
+        self.assertEqual(rl._available, 79)
+        self.assertEqual(len(rl._end_time_q), 21)
+
+        rl.join()
+
+    async def test_async(self):
+        rl = ASyncRateLimiter(100, 1, self._logger)
+        leased = ASyncLeasedRateLimiter(rl, self._logger, max_lease=5, min_lease=5, lease_s=0.2)
+
+        # the backend only sees whole leases
+        async with leased(3):
+            self.assertEqual(rl._available, 95)
+        async with leased(3):
+            self.assertEqual(rl._available, 90)
+        self.assertEqual(rl._available, 90)
+
+        await asyncio.sleep(0.3)
+        self.assertEqual(rl._available, 94)
+        self.assertEqual(len(rl._end_time_q), 1)  # the hits were released in a single batch
+
+        await rl.join()
+
+
+if __name__ == '__main__':
+    asynctest.main()
@@ -0,0 +1,121 @@
+import asyncio
+import logging
+import time
+
+import asynctest
+
+from rate_limiter import SyncRateLimiter as RateLimiter, ASyncRateLimiter
+from rate_limiter import async_rate_limiter, sync_rate_limiter
+from rate_limiter.clock import VirtualClock
+from rate_limiter.limiter_cache import LimiterCache
+
+
+class TestLimiterCache(asynctest.TestCase):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        logging.basicConfig(level=logging.INFO)
+        self._logger = logging.getLogger(self.__class__.__name__)
+
+    def test_max_size(self):
+        cache = LimiterCache(max_size=2)
+        limiters = {key: RateLimiter(1, 0.2, self._logger) for key in "abcd"}
+
+        cache.add("a", "a_value", [limiters["a"]])
+        cache.add("b", "b_value", [limiters["b"]])
+
+        # "a" has a hit in its window so it's kept, and "b" is evicted instead
+        with limiters["a"]:
+            pass
+        self.assertFalse(limiters["a"].is_idle)
+        cache.add("c", "c_value", [limiters["c"]])
+        self.assertEqual(len(cache), 2)
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("a"), "a_value")
+
+        time.sleep(0.3)
+        self.assertTrue(limiters["a"].is_idle)
+        cache.add("b", "b_value", [limiters["b"]])
+        self.assertIsNone(cache.get("c"))
+
+        # "a" was used since it was last looked at so it gets a second chance
+        cache.add("d", "d_value", [limiters["d"]])
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("a"), "a_value")
+        self.assertEqual(cache.add("a", "other_value", []), "a_value")
+
+        self.assertEqual(cache.stats, {"size": 2, "hits": 2, "misses": 5, "evictions": 3, "busy_skips": 1})
+
+    def test_ttl(self):
+        clock = VirtualClock()
+        cache = LimiterCache(ttl_s=10, clock=clock)
+        limiter = RateLimiter(1, 1, self._logger)
+
+        cache.add("a", "a_value", [limiter])
+        clock.advance(5)
+        cache.add("b", "b_value", [])
+        self.assertEqual(len(cache), 2)
+
+        clock.advance(5)
+        cache.add("c", "c_value", [])
+        self.assertIsNone(cache.get("a"))
+        self.assertEqual(cache.get("b"), "b_value")
+        self.assertEqual(cache.stats["evictions"], 1)
+
+    def test_racing_get(self):
+        # a hit while `_evict` inspects the entry keeps it, even if the clock hasn't moved since the entry's last hit
+        clock = VirtualClock()
+        cache = LimiterCache(max_size=1, clock=clock)
+
+        class Limiter:
+            @property
+            def is_idle(self):
+                self.value = cache.get("a")
+                return True
+
+        limiter = Limiter()
+        cache.add("a", "a_value", [limiter])
+        cache.add("b", "b_value", [])
+        self.assertEqual(limiter.value, "a_value")
+        self.assertEqual(cache.get("a"), "a_value")
+
+    async def test_reserve_all_pending(self):
+        # a per user limiter waiting in `reserve_all` on a busy global limiter isn't idle, so its entry is kept
+        cache = LimiterCache(max_size=1)
+        global_limiter, user_limiter = RateLimiter(1, 0.3, self._logger), RateLimiter(1, 0.3, self._logger)
+        with global_limiter:
+            pass
+
+        cache.add("a", "a_value", [user_limiter])
+        fut = asyncio.get_event_loop().run_in_executor(None, sync_rate_limiter.reserve_all, [global_limiter, user_limiter])
+        await asyncio.sleep(0.1)
+        self.assertFalse(user_limiter.is_idle)
+        cache.add("b", "b_value", [])
+        self.assertEqual(cache.get("a"), "a_value")
+
+        await asyncio.wait_for(fut, 1)
+        sync_rate_limiter.release_all([global_limiter, user_limiter])
+        await asyncio.get_event_loop().run_in_executor(None, user_limiter.join)
+        self.assertTrue(user_limiter.is_idle)
+
+    async def test_async_reserve_all_pending(self):
+        cache = LimiterCache(max_size=1)
+        global_limiter, user_limiter = ASyncRateLimiter(1, 0.3, self._logger), ASyncRateLimiter(1, 0.3, self._logger)
+        async with global_limiter:
+            pass
+
+        cache.add("a", "a_value", [user_limiter])
+        fut = asyncio.ensure_future(async_rate_limiter.reserve_all([global_limiter, user_limiter]))
+        await asyncio.sleep(0.1)
+        self.assertFalse(user_limiter.is_idle)
+        cache.add("b", "b_value", [])
+        self.assertEqual(cache.get("a"), "a_value")
+
+        await asyncio.wait_for(fut, 1)
+        async_rate_limiter.release_all([global_limiter, user_limiter])
+        await user_limiter.join()
+        self.assertTrue(user_limiter.is_idle)
+        await global_limiter.join()
+
+
+if __name__ == '__main__':
+    asynctest.main()
@@ -0,0 +1,169 @@
+import asyncio
+from functools import partial
+import logging
+import time
+
+import asynctest
+
+import common
+from rate_limiter import SyncRateLimiter as RateLimiter, ASyncRateLimiter
+from rate_limiter import async_limiter_context
+from rate_limiter.sync_rate_limiter import reserve_all, release_all
+from rate_limiter.limiter_context import LimiterServices, limiters_context, get_per_user_limiter_context, get_limiters_stats
+
+
+class TestLimiterContext(asynctest.TestCase):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        logging.basicConfig(level=logging.INFO)
+        self._logger = logging.getLogger(self.__class__.__name__)
+
+    def _get_limiters(self, max_rate: int=1000):
+        # equivalent of `get_limiters` which can be called more than once
+        global_limiter = RateLimiter(max_rate, 1, self._logger)
+        return {
+            limiter_type: {svc: partial(limiters_context, limiters=[global_limiter], service=svc) for svc in LimiterServices}
+            for limiter_type in ("request", "quota")
+        }
+
+    @staticmethod
+    async def acquire(context, num=1):
+        def _acquire():
+            start = time.time()
+            with context(num):
+                return time.time() - start
+
+        return await asyncio.get_event_loop().run_in_executor(None, _acquire)
+
+    async def test_independent_users(self):
+        limiters = self._get_limiters()
+        user1 = get_per_user_limiter_context(self._logger, limiters, LimiterServices.Gmail, "user1@test_independent_users")["quota"]
+        user2 = get_per_user_limiter_context(self._logger, limiters, LimiterServices.Gmail, "user2@test_independent_users")["quota"]
+        user1_limiter = user1.keywords["limiters"][-1]
+
+        # exhaust user1's per user limit
+        await asyncio.wait_for(self.acquire(user1, user1_limiter.max_rate), 0.1)
+
+        blocked = asyncio.ensure_future(self.acquire(user1))
+        await asyncio.sleep(0.1)
+        self.assertFalse(blocked.done())
+
+        # a throttled user doesn't block other users of the same service, nor pin global units while waiting
+        await asyncio.wait_for(self.acquire(user2), 0.1)
+        global_limiter = user1.keywords["limiters"][0]
+        self.assertEqual(global_limiter._available, global_limiter.max_rate - user1_limiter.max_rate - 1)
+
+        # user1's per user limit has a period of 1s
+        self.assertAlmostEqual(await asyncio.wait_for(blocked, 1.5), 1, delta=0.1)
+
+    async def test_concurrent_lookups(self):
+        limiters = self._get_limiters()
+        lookup = partial(get_per_user_limiter_context, self._logger, limiters, LimiterServices.Calendar, "user@test_concurrent_lookups")
+
+        # the per user limiters are only built once
+        loop = asyncio.get_event_loop()
+        results = await asyncio.gather(*[loop.run_in_executor(None, lookup) for _ in range(20)])
+        self.assertTrue(all(result is results[0] for result in results))
+
+    async def test_stats(self):
+        rl1 = RateLimiter(10, 1, self._logger, stats=True)
+        rl2 = RateLimiter(20, 60, self._logger)
+        limiters = {"request": {LimiterServices.Gmail: partial(limiters_context, limiters=[rl1, rl2], service=LimiterServices.Gmail)}}
+
+        with limiters["request"][LimiterServices.Gmail](5):
+            pass
+
+        stats = get_limiters_stats(limiters)
+        self.assertEqual(list(stats["request"][LimiterServices.Gmail]), [1])  # rl2 doesn't collect stats
+        stats = stats["request"][LimiterServices.Gmail][1]
+        self.assertEqual((stats["acquires"], stats["immediate"], stats["in_window"], stats["utilization"]), (1, 1, 5, 0.5))
+
+    async def test_reserve_all(self):
+        loop = asyncio.get_event_loop()
+        rl1 = RateLimiter(1, 1, self._logger)
+        rl2 = RateLimiter(1, 0.5, self._logger)
+
+        start = time.time()
+        with rl1:
+            pass
+        await asyncio.sleep(0.2)
+        with rl2:
+            pass
+
+        # rl1 admits at 1s and rl2 at 0.7s, so we sleep once until 1s
+        fut = loop.run_in_executor(None, reserve_all, [rl1, rl2], 1)
+        await asyncio.sleep(0.6)
+        self.assertEqual(rl2._available, 1)  # rl2 isn't pinned while we wait on rl1
+
+        await asyncio.wait_for(fut, 1)
+        self.assertAlmostEqual(time.time() - start, 1, delta=0.1)
+        self.assertEqual((rl1._available, rl2._available), (0, 0))
+
+        release_all([rl1, rl2], 1)
+
+        with self.assertRaises(TimeoutError):
+            reserve_all([rl1, rl2], 1, timeout=0.1)
+
+    async def test_async_independent_users(self):
+        global_limiter = ASyncRateLimiter(1000, 1, self._logger)
+        limiters = {
+            limiter_type: {svc: partial(async_limiter_context.limiters_context, limiters=[global_limiter], service=svc) for svc in LimiterServices}
+            for limiter_type in ("request", "quota")
+        }
+        user1 = async_limiter_context.get_per_user_limiter_context(self._logger, limiters, LimiterServices.Gmail, "user1@test_async_independent_users")["quota"]
+        user2 = async_limiter_context.get_per_user_limiter_context(self._logger, limiters, LimiterServices.Gmail, "user2@test_async_independent_users")["quota"]
+        self.assertIs(user1, async_limiter_context.get_per_user_limiter_context(self._logger, limiters, LimiterServices.Gmail, "user1@test_async_independent_users")["quota"])
+        user1_limiter = user1.keywords["limiters"][-1]
+
+        async def acquire(context, num=1):
+            start = time.time()
+            async with context(num):
+                return time.time() - start
+
+        # exhaust user1's per user limit in a single weighted acquire
+        await asyncio.wait_for(acquire(user1, user1_limiter.max_rate), 0.1)
+
+        blocked = asyncio.ensure_future(acquire(user1))
+        await asyncio.sleep(0.1)
+        self.assertFalse(blocked.done())
+
+        # a throttled user doesn't block other users of the same service, nor pin global units while waiting
+        await asyncio.wait_for(acquire(user2), 0.1)
+        self.assertEqual(global_limiter._available, global_limiter.max_rate - user1_limiter.max_rate - 1)
+
+        # user1's per user limit has a period of 1s
+        self.assertAlmostEqual(await asyncio.wait_for(blocked, 1.5), 1, delta=0.1)
+
+        for limiter in set(user1.keywords["limiters"] + user2.keywords["limiters"]):
+            await limiter.join()
+
+    async def test_async_weighted_fairness(self):
+        # a global and a per user limiter, the per user one being the short one
+        limiters = [ASyncRateLimiter(8, 0.5, self._logger), ASyncRateLimiter(4, 0.5, self._logger)]
+        context = partial(async_limiter_context.limiters_context, limiters=limiters, service=LimiterServices.Gmail)
+        order = []
+
+        async def acquire(name, num):
+            async with context(num):
+                order.append(name)
+
+        await acquire('first', 3)
+        big = asyncio.ensure_future(acquire('big', 4))
+        await asyncio.sleep(0)
+        small = [asyncio.ensure_future(acquire('small', 1)) for _ in range(3)]
+        await asyncio.sleep(0.1)
+
+        # the small ones queue up behind the big one instead of grabbing the unit which is still available
+        self.assertEqual(order, ['first'])
+        self.assertEqual(len(limiters[1]._acquire_waiters), 4)
+        self.assertEqual(limiters[1]._available, 1)
+
+        await asyncio.wait_for(asyncio.gather(big, *small), 2)
+        self.assertEqual(order, ['first', 'big', 'small', 'small', 'small'])
+
+        for limiter in limiters:
+            await limiter.join()
+
+
+if __name__ == '__main__':
+    asynctest.main()
@@ -0,0 +1,177 @@
+import asyncio
+import errno
+from functools import partial
+import logging
+import os
+import socket
+import tempfile
+import time
+from unittest import mock
+
+import asynctest
+
+from rate_limiter import ASyncRateLimiter, SyncRateLimiter
+from rate_limiter import async_limiter_context
+from rate_limiter.client import SyncClient, ASyncClient
+from rate_limiter.limiter_context import LimiterServices, get_limiters_context_with_added_limiters
+from rate_limiter.server import OP_ACQUIRE, Server, _Connection, limiter_key
+
+
+class TestServer(asynctest.TestCase):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        logging.basicConfig(level=logging.INFO)
+        self._logger = logging.getLogger(self.__class__.__name__)
+
+    async def setUp(self):
+        # equivalent of `get_limiters` which can be called more than once
+        self._global_limiter = ASyncRateLimiter(10, 0.5, self._logger)
+        limiters = {
+            limiter_type: {svc: partial(async_limiter_context.limiters_context, limiters=[self._global_limiter], service=svc) for svc in LimiterServices}
+            for limiter_type in ("request", "quota")
+        }
+
+        self._path = os.path.join(tempfile.mkdtemp(), "rate_limiter.sock")
+        self._server = Server(self._logger, limiters)
+        await self._server.start(self._path)
+
+    async def tearDown(self):
+        await self._server.close()
+        await self._global_limiter.join()
+
+    async def test_async_client(self):
+        client = await ASyncClient.connect(self._logger, self._path)
+        limiter = client.limiter(limiter_key("request", LimiterServices.Calendar))
+
+        # pipelined weighted acquires: 10 units are available immediately, the 11th waits for the window
+        start = time.time()
+        await asyncio.wait_for(asyncio.gather(*[limiter.acquire(2) for _ in range(5)]), 0.1)
+        self.assertEqual(self._global_limiter._available, 0)
+
+        blocked = asyncio.ensure_future(limiter.acquire())
+        await asyncio.sleep(0.1)
+        self.assertFalse(blocked.done())
+
+        limiter.release(10)
+        await asyncio.wait_for(blocked, 1)
+        self.assertAlmostEqual(time.time() - start, 0.6, delta=0.1)
+
+        # cancelling a waiting acquire doesn't consume units
+        async with client.get_limiters(self._logger)["request"][LimiterServices.Calendar](9):
+            pass
+        cancelled = asyncio.ensure_future(limiter.acquire(5))
+        await asyncio.sleep(0.1)
+        cancelled.cancel()
+        await asyncio.sleep(0.6)
+        self.assertEqual(self._global_limiter._available, 9)  # only the 1 unit we still hold
+
+        # units still held by a client are released when it disconnects
+        await client.close()
+        await asyncio.sleep(0.1)
+        self.assertEqual(list(self._global_limiter._end_time_q._records)[-1][1], 1)
+
+    async def test_sync_client(self):
+        loop = asyncio.get_event_loop()
+        client = await loop.run_in_executor(None, SyncClient, self._logger, self._path)
+        limiters = client.get_limiters(self._logger)
+        user = client.get_per_user_limiter_context(self._logger, limiters, LimiterServices.People, "user@test_sync_client")
+        local_limiter = SyncRateLimiter(1, 0.5, self._logger)
+
+        def _acquire():
+            with user["request"](2):
+                pass
+            with self.assertRaises(TimeoutError):
+                user["request"].keywords["limiters"][0].acquire(10, timeout=0.1)
+
+            # the contexts are partials like those of `limiter_context`, so local limiters can be added to them
+            with get_limiters_context_with_added_limiters(limiters["request"][LimiterServices.Gmail], [local_limiter])():
+                self.assertEqual(local_limiter._available, 0)
+
+        await loop.run_in_executor(None, _acquire)
+        self.assertEqual(self._global_limiter._available, 7)
+        local_limiter.join()
+
+        # the server tells the client it has no limits so it stops asking
+        unlimited = client.get_per_user_limiter_context(self._logger, limiters, LimiterServices.Calendar, "user@test_sync_client")["quota"]
+        self.assertIsNone(unlimited)
+        unlimited = client.limiter(limiter_key("quota", LimiterServices.Calendar, "user@test_sync_client"))
+        await loop.run_in_executor(None, unlimited.acquire)
+        self.assertTrue(unlimited._unlimited)
+
+        await loop.run_in_executor(None, client.close)
+
+    async def test_disconnect_while_acquiring(self):
+        client = await ASyncClient.connect(self._logger, self._path)
+        limiter = client.limiter(limiter_key("request", LimiterServices.Calendar))
+        await limiter.acquire(10)
+
+        pending = asyncio.ensure_future(limiter.acquire())
+        await asyncio.sleep(0.1)
+        await client.close()
+        await asyncio.sleep(0.6)
+        self.assertFalse(self._global_limiter._acquire_waiters)
+        self.assertEqual(self._global_limiter._available, 10)
+        pending.cancel()
+
+        # a grant which completes right before we close is released rather than stored
+        connection = _Connection(self._server, mock.Mock(), mock.Mock())
+        connection._handle(1, OP_ACQUIRE, limiter_key("request", LimiterServices.Calendar), 1)
+        await asyncio.sleep(0)  # the acquire is done but its callback hasn't run yet
+        connection._close()
+        await asyncio.sleep(0)
+        self.assertFalse(connection._held)
+        self.assertEqual(self._global_limiter._available, 9)
+        await asyncio.sleep(0.6)
+        self.assertEqual(self._global_limiter._available, 10)
+
+    async def test_start_in_use(self):
+        # a second server doesn't steal the socket of a running one
+        with self.assertRaises(OSError) as cm:
+            await Server(self._logger, self._server._limiters).start(self._path)
+        self.assertEqual(cm.exception.errno, errno.EADDRINUSE)
+
+        client = await ASyncClient.connect(self._logger, self._path)
+        await client.close()
+
+        # but replaces the socket file of one which is gone
+        await self._server.close()
+        self._server = Server(self._logger, self._server._limiters)
+        await self._server.start(self._path)
+        client = await ASyncClient.connect(self._logger, self._path)
+        await client.close()
+
+    async def test_release_to_granted_limiters(self):
+        client = await ASyncClient.connect(self._logger, self._path)
+        key = limiter_key("request", LimiterServices.People, "user@test_release_to_granted_limiters")
+        limiter = client.limiter(key)
+        await limiter.acquire()
+        user_limiter = self._server.resolve(key)[-1]
+
+        # the user is dropped from the cache while its units are held, so the key resolves to new limiters
+        async_limiter_context._PER_USER_LIMITER_CACHE._entries.clear()
+        self.assertIsNot(self._server.resolve(key)[-1], user_limiter)
+
+        limiter.release()
+        await client.close()
+        self.assertEqual(list(user_limiter._end_time_q._records)[-1][1], 1)
+
+    async def test_sync_client_connection_lost(self):
+        loop = asyncio.get_event_loop()
+        client = await loop.run_in_executor(None, SyncClient, self._logger, self._path)
+        limiter = client.limiter(limiter_key("request", LimiterServices.Calendar))
+        await loop.run_in_executor(None, limiter.acquire, 10)
+        blocked = loop.run_in_executor(None, limiter.acquire)
+        await asyncio.sleep(0.1)
+
+        # waiting callers fail instead of hanging, and so do later requests even though they could still be sent
+        client._sock.shutdown(socket.SHUT_RD)
+        with self.assertRaises(ConnectionError):
+            await asyncio.wait_for(blocked, 1)
+        await loop.run_in_executor(None, client._reader.join)
+        with self.assertRaises(ConnectionError):
+            await asyncio.wait_for(loop.run_in_executor(None, limiter.acquire, 1, 1), 2)
+        client._sock.close()
+
+
+if __name__ == '__main__':
+    asynctest.main()
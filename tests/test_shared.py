@@ -0,0 +1,119 @@
+import logging
+import multiprocessing
+import os
+import time
+from unittest import mock
+
+import asynctest
+
+from rate_limiter import shared_rate_limiter
+from rate_limiter.shared_rate_limiter import RateLimiter
+from rate_limiter.clock import VirtualClock
+
+
+class TestSharedRateLimiter(asynctest.TestCase):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        logging.basicConfig(level=logging.INFO)
+        self._logger = logging.getLogger(self.__class__.__name__)
+
+    def _create(self, max_rate, period_s, **kwargs):
+        rl = RateLimiter(max_rate, period_s, self._logger, "{}.{}".format(self.id(), os.getpid()), **kwargs)
+        self.addCleanup(rl.unlink)
+        return rl
+
+    def test_weighted(self):
+        clock = VirtualClock(100)
+        rl = self._create(10, 1, buckets=10, clock=clock)
+
+        with rl(4):
+            with rl(6):
+                pass
+
+        with self.assertRaises(TimeoutError):
+            rl.acquire(1, timeout=0.1)
+
+        # everything was released in the same bucket, so it all expires together
+        clock.advance(1.1)
+        self.assertTrue(rl.is_idle)
+        rl.acquire(10, timeout=0)
+        rl.release(4)
+
+        # unused units are returned without a hit
+        rl.cancel(6)
+        clock.advance(0.5)
+        rl.acquire(6, timeout=0)
+
+        # units are whole
+        for method in (rl.acquire, rl.release, rl.cancel):
+            with self.assertRaises(AssertionError):
+                method(2.5)
+
+    def test_shared(self):
+        rl = self._create(2, 0.5)
+        other = RateLimiter(2, 0.5, self._logger, "{}.{}".format(self.id(), os.getpid()))
+        with self.assertRaises(RateLimiter.Error):
+            RateLimiter(3, 0.5, self._logger, "{}.{}".format(self.id(), os.getpid()))
+
+        def _hit():
+            with rl:
+                pass
+
+        # hits from a forked process count against the same limit
+        ctx = multiprocessing.get_context('fork')
+        proc = ctx.Process(target=_hit)
+        proc.start()
+        proc.join()
+        self.assertEqual(proc.exitcode, 0)
+
+        start = time.monotonic()
+        with other(2):
+            pass
+        self.assertAlmostEqual(time.monotonic() - start, 0.5, delta=0.1)
+        other.close()
+
+    def test_fork_fd(self):
+        rl = self._create(1, 0.5)
+
+        def _hit():
+            inherited_fd = rl._fd
+            with rl:
+                pass
+            # the child's own fd gets the lowest free number, which is the inherited one once that's closed
+            os._exit(0 if rl._fd == inherited_fd else 1)
+
+        ctx = multiprocessing.get_context('fork')
+        proc = ctx.Process(target=_hit)
+        proc.start()
+        proc.join()
+        self.assertEqual(proc.exitcode, 0)
+
+    def test_crash(self):
+        rl = self._create(1, 0.5)
+
+        # a process which dies while holding units doesn't leak them
+        ctx = multiprocessing.get_context('fork')
+        proc = ctx.Process(target=lambda: rl.acquire() or os._exit(1))
+        proc.start()
+        proc.join()
+        self.assertFalse(rl.is_idle)
+
+        start = time.monotonic()
+        with rl:
+            pass
+        self.assertAlmostEqual(time.monotonic() - start, 0.5, delta=0.1)
+
+    def test_reboot(self):
+        rl = self._create(1, 100, buckets=10, clock=VirtualClock(1000))
+        rl.acquire()
+        rl.close()
+
+        # after a reboot the clock restarts, so the old hit would block for the previous uptime
+        with mock.patch.object(shared_rate_limiter, '_BOOT_ID', b'\xff' * 16):
+            rl = self._create(1, 100, buckets=10, clock=VirtualClock(0))
+            self.assertTrue(rl.is_idle)
+            rl.acquire(timeout=0)
+
+
+if __name__ == '__main__':
+    asynctest.main()
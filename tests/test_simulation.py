@@ -0,0 +1,86 @@
+import asyncio
+import logging
+
+import asynctest
+
+from rate_limiter import SyncRateLimiter, ASyncRateLimiter
+from rate_limiter.clock import VirtualClock
+from rate_limiter.limiter_context import LimiterServices, SECONDS_IN_HOUR
+from rate_limiter.simulation import VirtualEventLoop, ManualScheduler, replay
+
+
+class TestSimulation(asynctest.TestCase):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        logging.basicConfig(level=logging.INFO)
+        self._logger = logging.getLogger(self.__class__.__name__)
+
+    def _run(self, coro_func):
+        loop = VirtualEventLoop()
+        try:
+            return loop.run_until_complete(coro_func(loop))
+        finally:
+            loop.close()
+
+    def test_async_exact(self):
+        async def _test(loop):
+            rl = ASyncRateLimiter(3, 2, self._logger)
+            admitted = []
+
+            async def _acquire():
+                async with rl:
+                    admitted.append(loop.time())
+
+            await asyncio.gather(*[_acquire() for _ in range(7)])
+            await rl.join()
+            return admitted
+
+        # same as test_async's timing tests, without waiting 4 real seconds
+        self.assertEqual(self._run(_test), [0, 0, 0, 2, 2, 2, 4])
+
+    def test_async_hours(self):
+        async def _test(loop):
+            rl = ASyncRateLimiter(100, 60, self._logger)
+            for _ in range(10 * SECONDS_IN_HOUR):
+                await rl.acquire()
+                rl.release()
+                await asyncio.sleep(0.1)
+
+            await rl.join()
+            return loop.time()
+
+        # 100 hits per minute allowed vs 600 wanted, so the 36000 hits take 6 simulated hours
+        self.assertAlmostEqual(self._run(_test), 6 * SECONDS_IN_HOUR, delta=60)
+
+    def test_sync_manual_scheduler(self):
+        clock = VirtualClock()
+        scheduler = ManualScheduler(clock)
+        rl = SyncRateLimiter(2, 1, self._logger, scheduler=scheduler, clock=clock)
+
+        with rl(2):
+            pass
+        with self.assertRaises(TimeoutError):
+            rl.acquire(timeout=0)
+
+        scheduler.advance(0.5)
+        with self.assertRaises(TimeoutError):
+            rl.acquire(timeout=0)
+
+        scheduler.advance(0.5)
+        self.assertEqual(clock(), 1)
+        rl.acquire(2, timeout=0)
+        rl.release(2)
+        scheduler.advance(1)
+        self.assertTrue(rl.is_idle)
+
+    def test_replay(self):
+        # one user making 5 Gmail requests of 100 quota units per second, the per user quota allows 150 per second
+        traffic = [(i * 0.2, "quota", LimiterServices.Gmail, "user@test_replay", 100, 0) for i in range(10)]
+        waits = replay(traffic, self._logger)
+        self.assertEqual(len(waits), 10)
+        self.assertEqual(waits[0], 0)
+        self.assertGreater(max(waits), 1)
+
+
+if __name__ == '__main__':
+    asynctest.main()
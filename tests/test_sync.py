@@ -1,10 +1,18 @@
+import gc
 import logging
 import time
+import threading
 import asynctest
 import asyncio
+from unittest import mock
+import weakref
 
 import common
 from rate_limiter import SyncRateLimiter as RateLimiter
+from rate_limiter.clock import VirtualClock
+from rate_limiter.sync_rate_limiter import reserve_all
+from rate_limiter.simulation import ManualScheduler
+from rate_limiter.window import ExactWindow
 
 
 class TestRateLimiter(asynctest.TestCase):
@@ -14,27 +22,16 @@ class TestRateLimiter(asynctest.TestCase):
         self._logger = logging.getLogger(self.__class__.__name__)
         self._rl = None
 
-    async def validate_elapsed(self, coro, num_seconds: float or int):
-        start_s = time.time()
-        try:
-            await asyncio.wait_for(coro, num_seconds)
-        except:
-            print("Error elapsed: {}".format(time.time() - start_s))
-            raise
-
-        elapsed_s = time.time() - start_s
-        self.assertAlmostEqual(num_seconds, elapsed_s, delta=0.1)
-
     async def tearDown(self):
         self._rl.join()
 
     @staticmethod
-    async def acquire(rl2: RateLimiter, sleep_s=0, timeout=None):
+    async def acquire(rl2: RateLimiter, sleep_s=0, timeout=None, num=1):
         start = time.time()
         loop = asyncio.get_event_loop()
 
         try:
-            await loop.run_in_executor(None, rl2.acquire, timeout)
+            await loop.run_in_executor(None, rl2.acquire, num, timeout)
         except TimeoutError:
             raise asyncio.TimeoutError("rate limiter acquire timed out")
 
@@ -42,78 +39,467 @@ class TestRateLimiter(asynctest.TestCase):
             wait_s = time.time() - start
             await asyncio.sleep(sleep_s)
         finally:
-            await loop.run_in_executor(None, rl2.release)
+            await loop.run_in_executor(None, rl2.release, num)
 
         return wait_s
 
-    async def test_rate_limiter1(self):
-        # test sequential
-        self._rl = rl = RateLimiter(3, 2, self._logger)
+    @staticmethod
+    async def queue_waiter(rl2: RateLimiter, func, *args) -> asyncio.Future:
+        # runs `func` in a thread and returns once it's waiting on `rl2`
+        waiters = rl2._waiters
+        fut = asyncio.get_event_loop().run_in_executor(None, func, *args)
+        while rl2._waiters == waiters:
+            await asyncio.sleep(0.01)
+        return fut
 
-        await asyncio.wait_for(self.acquire(rl), 0.01)  # 1
-        await asyncio.wait_for(self.acquire(rl), 0.01)  # 2
-        await asyncio.wait_for(self.acquire(rl), 0.01)  # 3
+    @staticmethod
+    def hit(rl2: RateLimiter, clock: VirtualClock, num=1, timeout=5) -> float:
+        # returns the virtual time the hit was admitted at, the timeout keeps a broken test from blocking forever
+        rl2.acquire(num, timeout)
+        rl2.release(num)
+        return clock()
 
-        fut = asyncio.Task(self.acquire(rl))  # 4
+    async def test_rate_limiter1(self):
+        # test sequential
+        clock = VirtualClock(1000)
+        scheduler = ManualScheduler(clock)
+        self._rl = rl = RateLimiter(3, 2, self._logger, scheduler=scheduler, clock=clock)
 
-        with self.assertRaises(asyncio.TimeoutError):
-            await asyncio.wait_for(asyncio.shield(fut), 0.1)  # 4 (fail)
+        for _ in range(3):  # 1, 2, 3
+            self.hit(rl, clock, timeout=0)
 
-        await self.validate_elapsed(fut, 1.95)  # 4 (complete)
-        await asyncio.wait_for(self.acquire(rl), 0.01)  # 5
-        await asyncio.wait_for(self.acquire(rl), 0.01)  # 6
+        fut = await self.queue_waiter(rl, self.hit, rl, clock)  # 4
+        scheduler.advance(1.9)
+        self.assertFalse(fut.done())  # 4 (fail)
 
-        fut = asyncio.Task(self.acquire(rl))  # 7
+        scheduler.advance(0.1)
+        self.assertAlmostEqual(await asyncio.wait_for(fut, 1), 1002)  # 4 (complete)
+        self.hit(rl, clock, timeout=0)  # 5
+        self.hit(rl, clock, timeout=0)  # 6
 
-        with self.assertRaises(asyncio.TimeoutError):
-            await asyncio.wait_for(asyncio.shield(fut), 0.01)  # 7 (fail)
+        fut = await self.queue_waiter(rl, self.hit, rl, clock)  # 7
+        scheduler.advance(1.9)
+        self.assertFalse(fut.done())  # 7 (fail)
 
-        await self.validate_elapsed(fut, 2)  # 7 (complete)
+        scheduler.advance(0.1)
+        self.assertAlmostEqual(await asyncio.wait_for(fut, 1), 1004)  # 7 (complete)
+        scheduler.advance(2)
 
     async def test_rate_limiter2(self):
         # test parallel
-        self._rl = rl = RateLimiter(3, 2, self._logger)
-
-        await asyncio.gather(*[asyncio.wait_for(self.acquire(rl), 0.1) for _ in range(3)])  # 1, 2, 3
+        clock = VirtualClock(1000)
+        scheduler = ManualScheduler(clock)
+        self._rl = rl = RateLimiter(3, 2, self._logger, scheduler=scheduler, clock=clock)
 
-        fut = asyncio.Task(self.acquire(rl))  # 4
+        for _ in range(3):  # 1, 2, 3
+            self.hit(rl, clock, timeout=0)
 
-        # this one should timeout but count
-        with self.assertRaises(asyncio.TimeoutError):
-            await asyncio.wait_for(asyncio.shield(fut), 0.1)  # 4 (fail)
+        futs = [await self.queue_waiter(rl, self.hit, rl, clock) for _ in range(3)]  # 4, 5, 6
+        scheduler.advance(1.9)
+        self.assertFalse(any(fut.done() for fut in futs))
 
         # these should take 2 seconds and pass
-        await asyncio.gather(self.validate_elapsed(fut, 1.95), *[self.validate_elapsed(self.acquire(rl), 1.95) for _ in range(2)])
+        scheduler.advance(0.1)
+        times = await asyncio.wait_for(asyncio.gather(*futs), 1)
+        self.assertRecursiveAlmostEqual(times, [1002] * 3)
+        scheduler.advance(2)
 
     async def test_rate_limiter3(self):
-        self._rl = rl = RateLimiter(1, 1, self._logger)
-        await asyncio.wait_for(self.acquire(rl), 0.01)
+        clock = VirtualClock(1000)
+        scheduler = ManualScheduler(clock)
+        self._rl = rl = RateLimiter(1, 1, self._logger, scheduler=scheduler, clock=clock)
+        self.hit(rl, clock, timeout=0)
 
-        await asyncio.sleep(1.1)
+        scheduler.advance(1.1)
 
-        await asyncio.wait_for(self.acquire(rl), 0.01)
+        self.hit(rl, clock, timeout=0)
+        scheduler.advance(1)
 
     async def test_rate_limiter4(self):
-        self._rl = rl = RateLimiter(3, 2, self._logger)
+        clock = VirtualClock(1000)
+        scheduler = ManualScheduler(clock)
+        self._rl = rl = RateLimiter(3, 2, self._logger, scheduler=scheduler, clock=clock)
 
         # these won't register the call as having happened 1, 2, 3 seconds after
-        await asyncio.gather(*[self.validate_elapsed(self.acquire(rl, i), i + 0.1) for i in range(1, 4)])
+        rl.acquire(3)
+        for _ in range(3):
+            scheduler.advance(1)
+            rl.release()
 
         # we've waited 3s, so 1s one is released, 2nd has 1s wait, 3rd has 2s wait
-        times = sorted(await asyncio.gather(*[asyncio.wait_for(self.acquire(rl), 3) for _ in range(3)]))
-        self.assertRecursiveAlmostEqual(times, [0, 1, 2], delta=0.1)
+        start = clock()
+        times = [self.hit(rl, clock, timeout=0)]
+        futs = [await self.queue_waiter(rl, self.hit, rl, clock) for _ in range(2)]
+        for fut in futs:
+            scheduler.advance(1)
+            times.append(await asyncio.wait_for(fut, 1))
+
+        self.assertRecursiveAlmostEqual([t - start for t in times], [0, 1, 2])
+        scheduler.advance(2)
 
     async def test_rate_limiter5(self):
-        self._rl = rl = RateLimiter(3, 2, self._logger)
+        clock = VirtualClock(1000)
+        scheduler = ManualScheduler(clock)
+        self._rl = rl = RateLimiter(3, 2, self._logger, scheduler=scheduler, clock=clock)
 
-        for i in range(1, 4):
-            asyncio.ensure_future(self.acquire(rl, i))
+        start = clock()
+        rl.acquire(3)
+        futs = [await self.queue_waiter(rl, self.hit, rl, clock) for _ in range(3)]
+        for _ in range(3):
+            scheduler.advance(1)
+            rl.release()
 
         # in this scenario we'll have to wait 1 + 2, 2 + 2, 3 + 2 seconds
-        times = sorted(await asyncio.gather(*[asyncio.wait_for(self.acquire(rl), 5.1) for _ in range(3)]))
-        self.assertRecursiveAlmostEqual(times, [3, 4, 5], delta=0.1)
+        times = [await asyncio.wait_for(futs[0], 1)]
+        for fut in futs[1:]:
+            scheduler.advance(1)
+            times.append(await asyncio.wait_for(fut, 1))
+
+        self.assertRecursiveAlmostEqual([t - start for t in times], [3, 4, 5])
+        scheduler.advance(2)
+
+    async def test_weighted(self):
+        clock = VirtualClock(1000)
+        scheduler = ManualScheduler(clock)
+        self._rl = rl = RateLimiter(5, 1, self._logger, scheduler=scheduler, clock=clock)
+
+        start = clock()
+        self.hit(rl, clock, num=3, timeout=0)
+        self.assertEqual(len(rl._end_time_q), 1)  # one record per weighted hit
+
+        # only 2 units are left so this has to wait for the first hit to expire
+        fut = await self.queue_waiter(rl, self.hit, rl, clock, 3)
+        scheduler.advance(1)
+        self.assertAlmostEqual(await asyncio.wait_for(fut, 1) - start, 1)
+
+        with rl(2):
+            pass
+
+        fut = await self.queue_waiter(rl, self.hit, rl, clock, 2)
+        scheduler.advance(1)
+        self.assertAlmostEqual(await asyncio.wait_for(fut, 1) - start, 2)
+        scheduler.advance(1)
+
+    async def test_bucketed(self):
+        clock = VirtualClock(1000)
+        scheduler = ManualScheduler(clock)
+        self._rl = rl = RateLimiter(3, 1, self._logger, buckets=4, scheduler=scheduler, clock=clock)
+
+        start = clock()
+        for _ in range(3):
+            self.hit(rl, clock, timeout=0)
+        self.assertLessEqual(len(rl._end_time_q), 2)  # hits are coalesced per bucket
+
+        # hits are released at the end of their bucket, so up to period_s / buckets later
+        fut = await self.queue_waiter(rl, self.hit, rl, clock)
+        scheduler.advance(0.95)
+        self.assertFalse(fut.done())
+        scheduler.advance(0.3)
+        wait_s = await asyncio.wait_for(fut, 1) - start
+        self.assertGreaterEqual(wait_s, 0.95)
+        self.assertLessEqual(wait_s, 1.35)
+        scheduler.advance(2)
+
+    async def test_shared_scheduler(self):
+        limiters = [RateLimiter(1, 0.5, self._logger) for _ in range(100)]
+        self._rl = limiters[-1]
+
+        for rl in limiters:
+            rl.acquire()
+            rl.release()
+
+        # every limiter is released from the same thread
+        scheduler_threads = [t for t in threading.enumerate() if t.name == "RateLimiterReleaseScheduler"]
+        self.assertEqual(len(scheduler_threads), 1)
+
+        times = await asyncio.gather(*[asyncio.wait_for(self.acquire(rl), 1) for rl in limiters])
+        self.assertAlmostEqual(max(times), 0.5, delta=0.1)
+
+    async def test_clock(self):
+        clock = VirtualClock(1000)
+        scheduler = ManualScheduler(clock)
+        self._rl = rl = RateLimiter(1, 1, self._logger, scheduler=scheduler, clock=clock)
+
+        with rl:
+            pass
+        self.assertEqual(rl._end_time_q.next_expiry(), 1001)
+
+        with self.assertRaises(TimeoutError):
+            rl.acquire(timeout=0)
+
+        # the hit only expires once the injected clock moves
+        self.assertEqual(rl._release_expired(), 1)
+        clock.advance(1)
+        self.assertIsNone(rl._release_expired())
+
+        rl.acquire(timeout=0)
+        rl.release()
+        scheduler.advance(1)
+
+    async def test_try_acquire_reserve(self):
+        clock = VirtualClock(1000)
+        scheduler = ManualScheduler(clock)
+        self._rl = rl = RateLimiter(2, 1, self._logger, scheduler=scheduler, clock=clock)
+
+        self.assertTrue(rl.try_acquire())
+        self.assertEqual(rl.reserve(), 0)
+        self.assertFalse(rl.try_acquire())
+        # the delay depends on units which haven't been released yet
+        self.assertIsNone(rl.reserve())
+
+        rl.release()
+        clock.advance(0.5)
+        rl.release()
+
+        # reservations are owed from the hits which expire next
+        self.assertEqual(rl.reserve(), 0.5)
+        self.assertEqual(rl.reserve(), 1)
+        self.assertFalse(rl.try_acquire())
+        self.assertEqual(rl._available, -2)
+
+        scheduler.advance(1)
+        self.assertEqual(rl._available, 0)
+        rl.release(2)
+        scheduler.advance(1)
+
+    async def test_max_wait(self):
+        clock = VirtualClock(1000)
+        scheduler = ManualScheduler(clock)
+        self._rl = rl = RateLimiter(1, 1, self._logger, scheduler=scheduler, clock=clock, stats=True, max_wait=0.5)
+
+        rl.acquire()
+        # the unit is still in use, so it can't expire before a full period from now
+        with self.assertRaises(RateLimiter.Rejected):
+            rl.acquire(timeout=0)
+
+        rl.release()
+        clock.advance(0.6)
+
+        # it expires in 0.4s, so we'd wait
+        with self.assertRaises(TimeoutError):
+            rl.acquire(timeout=0)
+        with self.assertRaises(RateLimiter.Rejected):
+            rl.acquire(timeout=0, max_wait=0.1)
+        with self.assertRaises(RateLimiter.Rejected):
+            reserve_all([rl], timeout=0, max_wait=0.1)
+        self.assertEqual(rl.stats["rejected"], 3)
+
+        scheduler.advance(0.4)
+        rl.acquire(timeout=0)
+        rl.release()
+        scheduler.advance(1)
+
+    async def test_max_waiters(self):
+        clock = VirtualClock(1000)
+        scheduler = ManualScheduler(clock)
+        self._rl = rl = RateLimiter(1, 0.3, self._logger, scheduler=scheduler, clock=clock, max_waiters=1)
+        with rl:
+            pass
+
+        waiter = await self.queue_waiter(rl, self.hit, rl, clock)
+        self.assertEqual(rl._waiters, 1)
+
+        with self.assertRaises(RateLimiter.Rejected):
+            rl.acquire()
+
+        scheduler.advance(0.3)
+        self.assertAlmostEqual(await asyncio.wait_for(waiter, 1), 1000.3)
+        scheduler.advance(0.3)
+
+    async def test_priority(self):
+        clock = VirtualClock(1000)
+        self._rl = rl = RateLimiter(1, 1, self._logger, scheduler=ManualScheduler(clock), clock=clock, aging_s=1)
+        order = []
+
+        def _acquire(name, priority):
+            rl.acquire(priority=priority)
+            order.append(name)
+            rl.cancel()
+
+        rl.acquire()
+        futs = [await self.queue_waiter(rl, _acquire, "background", 0)]
+        # after waiting 2 * aging_s the background waiter is ahead of new waiters up to 2 priorities above it
+        clock.advance(2)
+        futs.append(await self.queue_waiter(rl, _acquire, "interactive", 1))
+        futs.append(await self.queue_waiter(rl, _acquire, "urgent", 3))
+
+        rl.cancel()
+        await asyncio.wait_for(asyncio.gather(*futs), 1)
+        self.assertEqual(order, ["urgent", "background", "interactive"])
+
+    async def test_priority_no_overtaking(self):
+        clock = VirtualClock(1000)
+        self._rl = rl = RateLimiter(2, 1, self._logger, scheduler=ManualScheduler(clock), clock=clock)
+
+        rl.acquire(2)
+        waiter = await self.queue_waiter(rl, rl.acquire, 2, None, None, 10)
+        rl.cancel()
+
+        # the unit isn't enough for the waiter, and a lower priority newcomer can't take it from under it
+        self.assertFalse(rl.try_acquire())
+        self.assertIsNone(rl.reserve())
+        with self.assertRaises(TimeoutError):
+            rl.acquire(timeout=0)
+
+        rl.cancel()
+        await asyncio.wait_for(waiter, 1)
+        self.assertEqual(rl._available, 0)
+        rl.cancel(2)
+
+    async def test_fifo(self):
+        clock = VirtualClock(1000)
+        scheduler = ManualScheduler(clock)
+        self._rl = rl = RateLimiter(2, 1, self._logger, scheduler=scheduler, clock=clock, fifo=True)
+
+        with rl:
+            pass
+        clock.advance(0.5)
+        with rl:
+            pass
+
+        waiter = await self.queue_waiter(rl, rl.acquire, 2)
+        scheduler.advance(0.5)
+        self.assertEqual(rl._available, 1)
+
+        # the unit isn't enough for the waiter, and newcomers can't get ahead of it
+        self.assertFalse(rl.try_acquire())
+        with self.assertRaises(TimeoutError):
+            rl.acquire(timeout=0)
+
+        # the next expiry hands both units to the waiter
+        scheduler.advance(0.5)
+        await asyncio.wait_for(waiter, 1)
+        self.assertEqual(rl._available, 0)
+        rl.release(2)
+        scheduler.advance(1)
+
+    async def test_fifo_reserve_all(self):
+        self._rl = rl = RateLimiter(2, 1, self._logger, fifo=True)
+        other = RateLimiter(2, 1, self._logger)
+
+        rl.acquire(2)
+        waiter = await self.queue_waiter(rl, reserve_all, [rl, other], 2)
+        rl.cancel()
+        self.assertFalse(rl.try_acquire())
+
+        # the hand-off takes the units for the group, so a newcomer can't get in before it commits
+        rl.cancel()
+        self.assertEqual(rl._available, 0)
+        self.assertFalse(rl.try_acquire())
+        await asyncio.wait_for(waiter, 1)
+        self.assertEqual((rl._available, other._available), (0, 0))
+        rl.cancel(2)
+        other.cancel(2)
+
+        # units handed over while another limiter of the group is short are given back
+        rl.acquire(2)
+        waiter = await self.queue_waiter(rl, reserve_all, [rl, other], 1)
+        other.acquire(2)
+        rl.cancel()
+        while not other._waiters:
+            await asyncio.sleep(0.01)
+        self.assertEqual(rl._available, 1)
+
+        other.cancel()
+        await asyncio.wait_for(waiter, 1)
+        self.assertEqual((rl._available, other._available), (0, 0))
+        rl.cancel(2)
+        other.cancel(2)
+
+    async def test_reserve_all_priority(self):
+        clock = VirtualClock(1000)
+        scheduler = ManualScheduler(clock)
+        self._rl = rl = RateLimiter(1, 1, self._logger, scheduler=scheduler, clock=clock)
+        other = RateLimiter(1, 1, self._logger, scheduler=scheduler, clock=clock)
+        order = []
+
+        def _reserve_all(name, priority):
+            reserve_all([rl, other], priority=priority)
+            order.append(name)
+            rl.cancel()
+            other.cancel()
+
+        with rl:
+            pass
+
+        # the delay is known, but callers queue up on the limiter rather than all sleeping until it and racing
+        futs = [await self.queue_waiter(rl, _reserve_all, "background", 0)]
+        futs.append(await self.queue_waiter(rl, _reserve_all, "urgent", 10))
+        self.assertEqual(other._available, 1)
+
+        scheduler.advance(1)
+        await asyncio.wait_for(asyncio.gather(*futs), 1)
+        self.assertEqual(order, ["urgent", "background"])
+        self.assertEqual((rl._available, other._available), (1, 1))
+
+    async def test_del_with_pending_hits(self):
+        self._rl = RateLimiter(1, 1, self._logger)
+
+        # finalizing a limiter doesn't wait for hits which nothing will release anymore
+        clock = VirtualClock(1000)
+        rl = RateLimiter(1, 1, self._logger, scheduler=ManualScheduler(clock), clock=clock)
+        with rl:
+            pass
+        ref = weakref.ref(rl)
+        del rl
+        await asyncio.wait_for(asyncio.get_event_loop().run_in_executor(None, gc.collect), 1)
+        self.assertIsNone(ref())
+
+    async def test_num_type(self):
+        self._rl = rl = RateLimiter(3, 1, self._logger)
+
+        # ex: a legacy `acquire(timeout)` call, a fractional `num` would silently corrupt `_available`
+        with self.assertRaises(AssertionError):
+            rl.acquire(2.5)
+        with self.assertRaises(AssertionError):
+            rl.release(2.5)
+        self.assertEqual(rl._available, 3)
+
+    async def test_stats(self):
+        self.assertIsNone(RateLimiter(1, 1, self._logger).stats)
+
+        self._rl = rl = RateLimiter(2, 0.2, self._logger, stats=True)
+        with rl(2):
+            pass
+        rl.acquire()
+        self.assertEqual(rl.stats, {
+            "acquires": 2, "immediate": 1, "waited": 1, "rejected": 0, "peak_waiters": 1, "wait_histogram": [[0.25, 1]],
+            "max_rate": 2, "available": 1, "in_window": 0, "in_use": 1, "waiters": 0,
+        })
+        rl.release()
+        self.assertEqual((rl.stats["in_window"], rl.stats["in_use"]), (1, 0))
+
+    async def test_join(self):
+        self._rl = rl = RateLimiter(1, 0.5, self._logger)
+        loop = asyncio.get_event_loop()
+        await asyncio.wait_for(self.acquire(rl), 0.1)
+
+        waiter = asyncio.ensure_future(self.acquire(rl))
+        await asyncio.sleep(0.1)
+
+        # returns as soon as the waiter is done, without waiting for its hit to be released
+        start = time.time()
+        await asyncio.wait_for(loop.run_in_executor(None, rl.join, False), 1)
+        self.assertAlmostEqual(time.time() - start, 0.4, delta=0.1)
+        await waiter
+
+        # waits until the window is empty
+        start = time.time()
+        await asyncio.wait_for(loop.run_in_executor(None, rl.join), 1)
+        self.assertAlmostEqual(time.time() - start, 0.5, delta=0.1)
+
+    async def test_broken(self):
+        self._rl = rl = RateLimiter(1, 0.5, self._logger)
+        await asyncio.wait_for(self.acquire(rl), 0.1)
+
+        # waiters are woken as soon as the limiter breaks instead of polling for it
+        with mock.patch.object(ExactWindow, 'expire', side_effect=ValueError("boom")):
+            start = time.time()
+            with self.assertRaises(RateLimiter.Error):
+                await asyncio.wait_for(self.acquire(rl), 1)
 
-    # TODO: add test where we break _release_worker
+        self.assertAlmostEqual(time.time() - start, 0.5, delta=0.1)
+        self.assertTrue(rl.is_broken)
 
 
 if __name__ == '__main__':